@@ -67,17 +67,39 @@ DESTINATION = '/home/pi/expolis-sensor-node'
 if not os.path.exists (DESTINATION):
     os.mkdir (DESTINATION)
 files = [
+    'aggregation.py',
+    'accelerometer_sensor.py',
+    'adc_sensor.py',
+    'backends.py',
+    'brokers.py',
+    'bus_trace.py',
     'camera_sensor.py',
+    'command_executor.py',
     'commands.py',
+    'compression.py',
     'configuration.py',
+    'failover_check.py',
+    'frame_store.py',
     'gps_sensor.py',
     'honeywell_sensor.py',
+    'i2c_bus.py',
     'log.py',
     'mqtt_interface.py',
+    'mqtt_standin.py',
+    'network_status.py',
+    'nmea.py',
     'other_sensors.py',
     'pms_sensor_kalman.py',
     'pms_sensor.py',
+    'profiling.py',
+    'sample.py',
+    'sample_history.py',
+    'sampling_policy.py',
+    'scheduler.py',
     'sensor_node.py',
+    'step_benchmark.py',
+    'supervisor.py',
+    'timing.py',
 ]
 print ('Copying source files to {}...'.format (DESTINATION))
 for a_file in files:
@@ -0,0 +1,146 @@
+"""
+This module samples the accelerometer (MSA301) in a background thread and reduces the samples gathered in each
+publish period to vibration features.
+
+Samples are stored in a preallocated ring buffer.  The features computed over the samples since the previous call to
+get_values are the RMS and peak of the acceleration magnitude (after removing gravity and the mean of each axis), the
+dominant vibration frequency and whether the vehicle is moving.
+"""
+import adafruit_msa301
+import numpy as np
+import threading
+from time import monotonic, sleep
+
+import configuration
+import i2c_bus
+
+BUFFER_SECONDS = 30
+"""Number of seconds of samples kept in the ring buffer."""
+
+MOVING_THRESHOLD = 0.3
+"""RMS acceleration in m/s^2 above which the vehicle is considered to be moving."""
+
+HEALTH_TIMEOUT = 5.0
+"""Time in seconds without a sample after which the accelerometer is unhealthy."""
+
+RESTART_JOIN_TIMEOUT = 2.0
+
+I2C_PRIORITY = 0
+"""Priority of the accelerometer transactions on the I2C bus, as the sample rate must be steady."""
+
+accelerometer = None
+
+samples = None  # type: np.ndarray
+"""Ring buffer with the acceleration of the three axis of each sample."""
+sample_times = None  # type: np.ndarray
+"""Ring buffer with the monotonic clock time of each sample."""
+number_samples = 0
+"""Total number of samples written in the ring buffer."""
+number_reduced = 0
+"""Number of samples that have been reduced by get_values."""
+number_errors = 0
+
+stop_sample_thread = False
+sample_thread = None  # type: threading.Thread
+start_time = 0.0
+"""Monotonic clock time at which the sample thread was started."""
+
+
+def init_sensor ():
+    global samples, sample_times
+
+    capacity = configuration.ACCELEROMETER_RATE * BUFFER_SECONDS
+    samples = np.zeros ((capacity, 3), dtype=np.float32)
+    sample_times = np.zeros (capacity, dtype=np.float64)
+    start_sensor ()
+
+
+def start_sensor ():
+    global accelerometer, sample_thread, start_time
+
+    accelerometer = adafruit_msa301.MSA301 (i2c_bus.client ('accelerometer', I2C_PRIORITY))
+    start_time = monotonic ()
+    sample_thread = threading.Thread (target=thread_sample_run, daemon=True)
+    sample_thread.start ()
+
+
+def is_healthy ():
+    """
+    Return whether the sample thread is running and read a sample in the last HEALTH_TIMEOUT seconds.
+    """
+    last_time = sample_times [(number_samples - 1) % len (samples)] if number_samples > 0 else 0.0
+    return sample_thread is not None and sample_thread.is_alive () and \
+        monotonic () - max (last_time, start_time) < HEALTH_TIMEOUT
+
+
+def restart ():
+    """
+    Stop the sample thread and open the accelerometer again.  The samples in the ring buffer are kept.
+
+    :raises RuntimeError: if the sample thread is stuck.
+    """
+    global stop_sample_thread
+
+    stop_sample_thread = True
+    if sample_thread is not None:
+        sample_thread.join (RESTART_JOIN_TIMEOUT)
+        if sample_thread.is_alive ():
+            raise RuntimeError ('accelerometer sample thread did not stop')
+    stop_sample_thread = False
+    start_sensor ()
+
+
+def thread_sample_run ():
+    global number_samples, number_errors
+
+    period = 1 / configuration.ACCELEROMETER_RATE
+    capacity = len (samples)
+    deadline = monotonic ()
+    while not stop_sample_thread:
+        try:
+            index = number_samples % capacity
+            samples [index] = accelerometer.acceleration
+            sample_times [index] = monotonic ()
+            number_samples += 1
+        except OSError:
+            number_errors += 1
+        deadline += period
+        delay = deadline - monotonic ()
+        if delay > 0:
+            sleep (delay)
+        else:
+            # we are late, do not try to catch up with a burst of samples
+            deadline = monotonic ()
+
+
+def get_values ():
+    """
+    Reduce the samples gathered since the previous call to vibration features.
+    :return: a tuple with the RMS and peak acceleration in m/s^2, the dominant frequency in Hz and 1 if the vehicle is
+    moving or 0 otherwise.  If there are not enough samples, we return (-1, -1, -1, -1).
+    """
+    global number_reduced
+
+    end = number_samples
+    capacity = len (samples)
+    # leave a margin so that the sampling thread does not overwrite the oldest samples while we read them
+    count = min (end - number_reduced, capacity - configuration.ACCELEROMETER_RATE)
+    number_reduced = end
+    if count < 8:
+        return -1, -1, -1, -1
+    indexes = np.arange (end - count, end) % capacity
+    window = samples [indexes]
+    times = sample_times [indexes]
+    window = window - window.mean (axis=0)
+    magnitude = np.sqrt (np.einsum ('ij,ij->i', window, window))
+    rms = float (np.sqrt (np.mean (magnitude * magnitude)))
+    peak = float (magnitude.max ())
+    duration = times [-1] - times [0]
+    # the power spectrum is summed over the three axis, as the magnitude would double the vibration frequency
+    spectrum = np.fft.rfft (window, axis=0)
+    power = np.einsum ('ij,ij->i', spectrum.real, spectrum.real) + np.einsum ('ij,ij->i', spectrum.imag, spectrum.imag)
+    if duration > 0 and len (power) > 1:
+        dominant_frequency = float ((np.argmax (power [1:]) + 1) * (count - 1) / duration / count)
+    else:
+        dominant_frequency = -1
+    return round (rms, 4), round (peak, 4), round (dominant_frequency, 2), int (rms > MOVING_THRESHOLD)
@@ -0,0 +1,136 @@
+"""
+This module samples the four channels of the ADC (ADS1115) that read the CO and NO2 sensors in a background thread.
+
+The ADC runs in continuous mode at the configured data rate.  The thread visits each channel in turn and reads a burst
+of conversions before switching to the next one, since after switching channels the ADC needs two conversion cycles
+to settle.  Samples are accumulated between calls to get_values, which returns the mean, standard deviation and number
+of samples of each channel.
+"""
+import adafruit_ads1x15.ads1115
+import adafruit_ads1x15.analog_in
+import math
+import threading
+from adafruit_ads1x15.ads1x15 import Mode
+from time import monotonic, sleep
+
+import configuration
+import i2c_bus
+
+BURST_SIZE = 4
+"""Number of conversions read from a channel before switching to the next one."""
+
+NUMBER_CHANNELS = 4
+
+HEALTH_TIMEOUT = 5.0
+"""Time in seconds without a burst read after which the ADC is unhealthy."""
+
+RESTART_JOIN_TIMEOUT = 2.0
+
+I2C_PRIORITY = 1
+"""Priority of the ADC transactions on the I2C bus, see module i2c_bus."""
+
+channels = []
+
+accumulators = [[0, 0.0, 0.0] for _ in range (NUMBER_CHANNELS)]
+"""Number of samples, sum and sum of squares of the samples of each channel since the last call to get_values."""
+accumulators_lock = threading.Lock ()
+
+number_errors = 0
+
+stop_sample_thread = False
+sample_thread = None  # type: threading.Thread
+last_read_time = 0.0
+"""Monotonic clock time at which the sample thread last read a burst without error."""
+
+
+def init_sensor ():
+    """
+    Start sampling the ADC in continuous mode if it is enabled in the configuration file.
+    """
+    global channels, sample_thread, last_read_time
+
+    if not configuration.ADC_CONTINUOUS:
+        return
+    i2c = i2c_bus.client ('adc', I2C_PRIORITY)
+    ads = adafruit_ads1x15.ads1115.ADS1115 (i2c, data_rate=configuration.ADC_DATA_RATE, mode=Mode.CONTINUOUS)
+    channels = [
+        adafruit_ads1x15.analog_in.AnalogIn (ads, pin)
+        for pin in (
+            adafruit_ads1x15.ads1115.P0,
+            adafruit_ads1x15.ads1115.P1,
+            adafruit_ads1x15.ads1115.P2,
+            adafruit_ads1x15.ads1115.P3,
+        )
+    ]
+    last_read_time = monotonic ()
+    sample_thread = threading.Thread (target=thread_sample_run, daemon=True)
+    sample_thread.start ()
+
+
+def thread_sample_run ():
+    global number_errors, last_read_time
+
+    period = 1 / configuration.ADC_DATA_RATE
+    burst = [0.0] * BURST_SIZE
+    while not stop_sample_thread:
+        for index, a_channel in enumerate (channels):
+            try:
+                # the first read switches the channel and waits for the ADC to settle
+                burst [0] = a_channel.voltage
+                for sample in range (1, BURST_SIZE):
+                    sleep (period)
+                    burst [sample] = a_channel.voltage
+            except OSError:
+                number_errors += 1
+                continue
+            last_read_time = monotonic ()
+            with accumulators_lock:
+                accumulator = accumulators [index]
+                accumulator [0] += BURST_SIZE
+                accumulator [1] += sum (burst)
+                accumulator [2] += sum (v * v for v in burst)
+
+
+def is_healthy ():
+    """
+    Return whether the sample thread is running and read a burst in the last HEALTH_TIMEOUT seconds.
+    """
+    return sample_thread is not None and sample_thread.is_alive () and monotonic () - last_read_time < HEALTH_TIMEOUT
+
+
+def restart ():
+    """
+    Stop the sample thread and open the ADC again.  The samples accumulated are kept.
+
+    :raises RuntimeError: if the sample thread is stuck.
+    """
+    global stop_sample_thread
+
+    stop_sample_thread = True
+    if sample_thread is not None:
+        sample_thread.join (RESTART_JOIN_TIMEOUT)
+        if sample_thread.is_alive ():
+            raise RuntimeError ('ADC sample thread did not stop')
+    stop_sample_thread = False
+    init_sensor ()
+
+
+def get_values ():
+    """
+    Return the statistics of the samples of each channel gathered since the previous call.
+    :return: a list with a tuple per channel containing the mean, the standard deviation and the number of samples.  If
+    a channel has no samples, its tuple is (-1, -1, 0).
+    """
+    global accumulators
+
+    with accumulators_lock:
+        current = accumulators
+        accumulators = [[0, 0.0, 0.0] for _ in range (NUMBER_CHANNELS)]
+    result = []
+    for count, total, total_squares in current:
+        if count == 0:
+            result.append ((-1, -1, 0))
+        else:
+            mean = total / count
+            result.append ((mean, math.sqrt (max (0.0, total_squares / count - mean * mean)), count))
+    return result
@@ -0,0 +1,157 @@
+"""
+Aggregates the sensor values read every second over the publish rate period.
+
+When the publish rate period is above one second, the sensors are still read every second.  Each reading, a
+sub-sample, is stored in a row of a preallocated NumPy array.  At the end of the period, function reduce computes for
+each channel the mean, minimum, maximum, standard deviation and number of valid sub-samples with a few vectorised
+operations.  Missing readings, which the sensor modules report as -1, are stored as NaN and ignored.
+
+The published sample holds the reduction of each channel given by CHANNELS.  The CO and NO2 standard deviation and
+number of samples are pooled over the ADC samples of the whole period.  The full statistics of each channel are
+formatted by format_aggregates.
+"""
+import math
+
+import numpy as np
+
+import sample
+
+MEAN, MAXIMUM, RMS = range (3)
+
+CHANNELS = [
+    ('co_1', MEAN),
+    ('co_2', MEAN),
+    ('no2_1', MEAN),
+    ('no2_2', MEAN),
+    ('pm1_opc', MEAN),
+    ('pm25_opc', MEAN),
+    ('pm10_opc', MEAN),
+    ('pm1_opc_filtered', MEAN),
+    ('pm25_opc_filtered', MEAN),
+    ('pm10_opc_filtered', MEAN),
+    ('temperature', MEAN),
+    ('pressure', MEAN),
+    ('humidity', MEAN),
+    ('power', MEAN),
+    ('acceleration_rms', RMS),
+    ('acceleration_peak', MAXIMUM),
+    ('acceleration_frequency', MEAN),
+    ('moving', MAXIMUM),
+    ('pm1_honeywell', MEAN),
+    ('pm25_honeywell', MEAN),
+    ('pm4_honeywell', MEAN),
+    ('pm10_honeywell', MEAN),
+]
+"""Channels aggregated over the period and the reduction stored in the published sample."""
+
+ADC_CHANNELS = ['co_1', 'co_2', 'no2_1', 'no2_2']
+"""Channels whose standard deviation and number of samples are pooled over the ADC samples."""
+
+INTEGER_CHANNELS = {'moving', 'pm1_honeywell', 'pm25_honeywell', 'pm4_honeywell', 'pm10_honeywell'}
+"""Channels whose reduction is rounded to an integer, as they are integers in the sample history."""
+
+MINIMUM_CAPACITY = 60
+
+values = np.zeros ((MINIMUM_CAPACITY, len (CHANNELS)))
+"""The channel values of each sub-sample of the current period."""
+adc_statistics = np.zeros ((MINIMUM_CAPACITY, len (ADC_CHANNELS), 2))
+"""The standard deviation and number of ADC samples of each sub-sample of the current period."""
+number_sub_samples = 0
+
+
+def add (sub_sample: sample.Sample) -> None:
+    """
+    Store the channel values of a sub-sample.
+    """
+    global values, adc_statistics, number_sub_samples
+
+    if number_sub_samples == len (values):
+        values = np.concatenate ((values, np.zeros_like (values)))
+        adc_statistics = np.concatenate ((adc_statistics, np.zeros_like (adc_statistics)))
+    row = values [number_sub_samples]
+    for index, (attribute, _reduction) in enumerate (CHANNELS):
+        value = getattr (sub_sample, attribute)
+        row [index] = math.nan if value is None or value == -1 else value
+    for index, attribute in enumerate (ADC_CHANNELS):
+        adc_statistics [number_sub_samples, index] = (
+            getattr (sub_sample, attribute + '_std'), getattr (sub_sample, attribute + '_count'))
+    number_sub_samples += 1
+
+
+def reduce (a_sample: sample.Sample):
+    """
+    Compute the statistics of the sub-samples of the period, store the reduction of each channel in the given sample
+    and start a new period.
+
+    :return: an array with a row per channel containing the mean, minimum, maximum, standard deviation and number of
+    valid sub-samples.  The statistics of a channel without valid sub-samples are -1 and its count is 0.
+    """
+    global number_sub_samples
+
+    data = values [:number_sub_samples]
+    valid = ~np.isnan (data)
+    count = valid.sum (axis=0)
+    has_values = count > 0
+    divisor = np.maximum (count, 1)
+    filled = np.where (valid, data, 0.0)
+    mean = filled.sum (axis=0) / divisor
+    mean_squares = (filled * filled).sum (axis=0) / divisor
+    std = np.sqrt (np.maximum (mean_squares - mean * mean, 0.0))
+    minimum = np.where (valid, data, np.inf).min (axis=0, initial=np.inf)
+    maximum = np.where (valid, data, -np.inf).max (axis=0, initial=-np.inf)
+    statistics = np.column_stack ((
+        np.where (has_values, mean, -1),
+        np.where (has_values, minimum, -1),
+        np.where (has_values, maximum, -1),
+        np.where (has_values, std, -1),
+        count,
+    ))
+    reductions = {MEAN: mean, MAXIMUM: maximum, RMS: np.sqrt (mean_squares)}
+    for index, (attribute, reduction) in enumerate (CHANNELS):
+        if not has_values [index]:
+            value = -1
+        elif attribute in INTEGER_CHANNELS:
+            value = int (round (reductions [reduction][index]))
+        else:
+            value = float (reductions [reduction][index])
+        setattr (a_sample, attribute, value)
+    reduce_adc_statistics (a_sample, data, valid)
+    number_sub_samples = 0
+    return statistics
+
+
+def reduce_adc_statistics (a_sample: sample.Sample, data, valid) -> None:
+    """
+    Pool the standard deviation and number of ADC samples of each sub-sample over the period.
+
+    The pooled variance is the mean of the variance of each sub-sample plus the variance of the sub-sample means,
+    both weighted by the number of ADC samples.
+    """
+    indexes = [index for index, (attribute, _reduction) in enumerate (CHANNELS) if attribute in ADC_CHANNELS]
+    means = np.where (valid [:, indexes], data [:, indexes], 0.0)
+    stds = adc_statistics [:number_sub_samples, :, 0]
+    counts = np.where (valid [:, indexes], adc_statistics [:number_sub_samples, :, 1], 0)
+    total = counts.sum (axis=0)
+    divisor = np.maximum (total, 1)
+    mean = (counts * means).sum (axis=0) / divisor
+    variance = (counts * (stds * stds + means * means)).sum (axis=0) / divisor - mean * mean
+    std = np.sqrt (np.maximum (variance, 0.0))
+    for index, attribute in enumerate (ADC_CHANNELS):
+        if total [index] > 0:
+            setattr (a_sample, attribute + '_std', float (std [index]))
+            setattr (a_sample, attribute + '_count', int (total [index]))
+        else:
+            setattr (a_sample, attribute + '_std', -1)
+            setattr (a_sample, attribute + '_count', 0)
+
+
+def format_aggregates (a_sample: sample.Sample, statistics) -> str:
+    """
+    Format the statistics of the period.  The message contains the sensor node id and the sample number followed by
+    the mean, minimum, maximum, standard deviation and number of valid sub-samples of each channel in the order of
+    CHANNELS.
+    """
+    parts = [str (a_sample.sensor_node_id), str (a_sample.iteration)]
+    for mean, minimum, maximum, std, count in statistics:
+        parts.append ('{:.6g} {:.6g} {:.6g} {:.6g} {}'.format (mean, minimum, maximum, std, int (count)))
+    return ' '.join (parts)
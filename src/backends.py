@@ -0,0 +1,225 @@
+"""
+Opens the devices of the sensor node: the SPI bus of the OPC-N3, the I2C bus, the UART of the Honeywell sensor and
+the camera.
+
+The backend is chosen with option device_backend in the configuration file:
+
+* hardware: the devices of the Raspberry Pi;
+* record: the devices of the Raspberry Pi, and every transfer on the buses is recorded in full, from the start of the
+  sensor node until it stops, in a trace file written in the folder traces of the USB pen, see module bus_trace;
+* replay: no device is opened.  Each bus answers with the transfers of its devices read from the trace file given by
+  option device_trace, in the order they were recorded, after the time the recorded transfer took.  A recorded error
+  is raised again.  When the transfers of a device run out, its transfers raise an error.  The camera returns a
+  placeholder frame.
+
+The hardware libraries are only imported when a device is opened by the hardware or record backend, so that the sensor
+node runs on a computer with the replay backend.
+"""
+import collections
+import errno
+import time
+from typing import Deque, Dict
+
+import bus_trace
+
+HARDWARE, RECORD, REPLAY = 'hardware', 'record', 'replay'
+BACKENDS = [HARDWARE, RECORD, REPLAY]
+
+STAND_IN_FRAME = bytes.fromhex ('ffd8ffd9')
+"""The frame returned by the camera of the replay backend, an empty JPEG image."""
+
+backend = HARDWARE
+
+recorded = {}  # type: Dict[str, Deque[bus_trace.Record]]
+"""The recorded transfers not yet replayed, indexed by device name."""
+
+number_replayed = 0
+number_skipped = 0
+"""Number of recorded transfers dropped because their operation was not the one replayed."""
+number_exhausted = 0
+"""Number of transfers that failed because the recorded transfers of their device ran out."""
+
+
+def init_backend (name: str, trace_file: str = '') -> None:
+    """
+    Select the backend used to open the devices.
+
+    :param name: one of BACKENDS.
+    :param trace_file: the trace file replayed by the replay backend.
+    :raises ValueError: if the backend is unknown or the trace file is not a trace file.
+    """
+    global backend
+    if name not in BACKENDS:
+        raise ValueError ('unknown device backend {}'.format (name))
+    backend = name
+    if backend == RECORD:
+        bus_trace.start_recording ()
+    elif backend == REPLAY:
+        recorded.clear ()
+        _names, records = bus_trace.read_trace (trace_file)
+        for a_record in records:
+            recorded.setdefault (a_record.device, collections.deque ()).append (a_record)
+
+
+def open_spi (name: str, bus: int, device: int, mode: int, max_speed_hz: int):
+    """
+    Open an SPI device.
+
+    :param name: the name of the device in bus traces.
+    """
+    if backend == REPLAY:
+        return ReplaySpi (name)
+    import spidev
+    spi = spidev.SpiDev ()
+    spi.open (bus, device)
+    spi.mode = mode
+    spi.max_speed_hz = max_speed_hz
+    return bus_trace.wrap_spi (spi, name)
+
+
+def open_i2c (names: dict):
+    """
+    Open the I2C bus.
+
+    :param names: the names of the devices on the bus indexed by address.
+    """
+    if backend == REPLAY:
+        return ReplayI2C (names)
+    import board
+    import busio
+    return bus_trace.wrap_i2c (busio.I2C (board.SCL, board.SDA), names)
+
+
+def open_uart (name: str, port: str, baudrate: int, timeout: float):
+    """
+    Open a serial port.
+
+    :param name: the name of the device in bus traces.
+    """
+    if backend == REPLAY:
+        return ReplayUart (name)
+    import serial
+    return bus_trace.wrap_uart (serial.Serial (port, baudrate=baudrate, timeout=timeout), name)
+
+
+def open_camera ():
+    if backend == REPLAY:
+        return StandInCamera ()
+    import picamera
+    return picamera.PiCamera ()
+
+
+def replay (name: str, operation: int) -> bus_trace.Record:
+    """
+    Return the next recorded transfer of a device with the given operation, after the time it took.
+
+    :raises OSError: if the recorded transfer failed or there are no more recorded transfers.
+    """
+    global number_replayed, number_skipped, number_exhausted
+    queue = recorded.get (name)
+    while queue and queue [0].operation != operation:
+        queue.popleft ()
+        number_skipped += 1
+    if not queue:
+        number_exhausted += 1
+        raise OSError (errno.ENODATA, 'no more recorded transfers of {}'.format (name))
+    a_record = queue.popleft ()
+    number_replayed += 1
+    time.sleep (a_record.duration)
+    if a_record.flags & bus_trace.ERROR:
+        raise OSError (
+            errno.ETIMEDOUT if a_record.flags & bus_trace.TIMEOUT else errno.EIO,
+            'recorded error of {}'.format (name))
+    return a_record
+
+
+class ReplaySpi:
+    """
+    Stands in for a spidev.SpiDev object.
+    """
+    def __init__ (self, name: str):
+        self.name = name
+        self.mode = 0
+        self.max_speed_hz = 0
+
+    def xfer (self, _data, *_args):
+        return list (replay (self.name, bus_trace.SPI_XFER).data_in)
+
+    def close (self):
+        pass
+
+
+class ReplayUart:
+    """
+    Stands in for a serial.Serial object.
+    """
+    def __init__ (self, name: str):
+        self.name = name
+
+    @property
+    def in_waiting (self):
+        queue = recorded.get (self.name)
+        for a_record in queue or ():
+            if a_record.operation == bus_trace.UART_READ:
+                return len (a_record.data_in)
+        return 0
+
+    def write (self, data):
+        replay (self.name, bus_trace.UART_WRITE)
+        return len (data)
+
+    def read (self, _size=1):
+        return replay (self.name, bus_trace.UART_READ).data_in
+
+    def reset_input_buffer (self):
+        pass
+
+    def close (self):
+        pass
+
+
+class ReplayI2C:
+    """
+    Stands in for a busio.I2C object.
+    """
+    def __init__ (self, names: dict):
+        self.names = names
+
+    def scan (self):
+        return [address for address in self.names if recorded.get (self.names [address])]
+
+    def readfrom_into (self, address, buffer, *, start=0, end=None):
+        data_in = replay (bus_trace.device_name (self.names, address), bus_trace.I2C_READ).data_in
+        memoryview (buffer) [start:end] [:len (data_in)] = data_in
+
+    def writeto (self, address, _buffer, *, start=0, end=None):
+        replay (bus_trace.device_name (self.names, address), bus_trace.I2C_WRITE)
+
+    def writeto_then_readfrom (self, address, _buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0,
+                               in_end=None):
+        data_in = replay (bus_trace.device_name (self.names, address), bus_trace.I2C_WRITE_READ).data_in
+        memoryview (buffer_in) [in_start:in_end] [:len (data_in)] = data_in
+
+    def deinit (self):
+        pass
+
+
+class StandInCamera:
+    """
+    Stands in for a picamera.PiCamera object.
+    """
+    def __init__ (self):
+        self.resolution = (0, 0)
+
+    def start_preview (self):
+        pass
+
+    def capture (self, output, _format='jpeg', **_options):
+        if isinstance (output, str):
+            with open (output, 'wb') as fd:
+                fd.write (STAND_IN_FRAME)
+        else:
+            output.write (STAND_IN_FRAME)
+
+    def close (self):
+        pass
@@ -0,0 +1,227 @@
+"""
+Chooses the ExpoLIS broker the public MQTT client connects to.
+
+The brokers are listed in order of preference in the mqtt_broker setting.  Coroutine monitor probes every broker every
+broker_probe_period seconds: it opens a connection, sends an MQTT CONNECT packet and measures the time until the
+CONNACK packet arrives.  The round trip times are smoothed with an exponential moving average.  A broker is
+unreachable after MAX_FAILURES probes failed in a row.
+
+The public client connects to the first reachable broker in the list whose round trip time is within
+broker_switch_margin_ms of the fastest reachable broker.  So the client prefers the brokers earlier in the list, fails
+back to them when they are reachable again, and only leaves them for a broker that is faster by more than the margin.
+When the connection to the current broker is lost, while the client is disconnected and after a probe of the current
+broker failed, the brokers are probed every DISCONNECTED_PROBE_PERIOD seconds, so that the client fails over in a few
+seconds.
+
+Messages published with QoS 1 or 2 while the client is disconnected or switching broker stay in the outbound queue of
+the paho client, and are sent to the new broker once it connects.  Messages that the old broker received but did not
+acknowledge completely are sent again, so a switch may duplicate a message but does not lose it.
+
+With a single broker nothing is probed.
+"""
+import asyncio
+import time
+from typing import List, Optional
+
+import configuration
+
+DEFAULT_PORT = 1883
+
+PROBE_TIMEOUT = 2.0
+"""Time in seconds after which a probe fails."""
+
+DISCONNECTED_PROBE_PERIOD = 2.0
+"""Time in seconds between probes while the public client is disconnected."""
+
+RTT_SMOOTHING = 0.3
+"""Weight of the last round trip time in the moving average."""
+
+MAX_FAILURES = 2
+"""Number of probes failed in a row after which a broker is unreachable."""
+
+CONNECT_PACKET = bytes ([
+    0x10, 22,
+    0x00, 0x04, ord ('M'), ord ('Q'), ord ('T'), ord ('T'),
+    0x04,  # protocol level 3.1.1
+    0x02,  # clean session
+    0x00, 0x0A,  # keepalive
+    0x00, 0x0A]) + 'probe_{:04d}'.format (configuration.SENSOR_NODE_ID % 10000).encode ()
+DISCONNECT_PACKET = bytes ([0xE0, 0x00])
+
+
+class Broker:
+    def __init__ (self, address: str):
+        host, _, port = address.strip ().partition (':')
+        self.host = host
+        self.port = int (port) if port else DEFAULT_PORT
+        self.rtt = None  # type: Optional[float]
+        """Smoothed round trip time in seconds, None until the broker answers a probe."""
+        self.last_rtt = None  # type: Optional[float]
+        self.reachable = False
+        self.consecutive_failures = 0
+        self.number_probes = 0
+        self.number_failures = 0
+
+    def __str__ (self):
+        return '{}:{}'.format (self.host, self.port)
+
+    def update (self, rtt: Optional[float]) -> None:
+        self.number_probes += 1
+        self.last_rtt = rtt
+        if rtt is None:
+            self.number_failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= MAX_FAILURES:
+                self.reachable = False
+                self.rtt = None
+        else:
+            self.consecutive_failures = 0
+            self.reachable = True
+            self.rtt = rtt if self.rtt is None else (1 - RTT_SMOOTHING) * self.rtt + RTT_SMOOTHING * rtt
+
+
+brokers = []  # type: List[Broker]
+current = None  # type: Optional[Broker]
+"""The broker the public client connects to."""
+
+connected = False
+connected_since = 0.0
+connected_time = 0.0
+"""Total time in seconds the public client was connected, not counting the current connection."""
+number_connects = 0
+number_disconnects = 0
+number_switches = 0
+number_failovers = 0
+"""Number of switches because the current broker became unreachable, which are also counted in number_switches."""
+
+wake = None  # type: Optional[asyncio.Event]
+loop = None  # type: Optional[asyncio.AbstractEventLoop]
+
+verbose = 1
+
+
+def init_brokers (addresses: List[str]) -> Broker:
+    """
+    Create the broker list.
+
+    :return: the first broker, to which the public client connects at start.
+    """
+    global brokers, current
+    brokers = [Broker (address) for address in addresses]
+    current = brokers [0]
+    return current
+
+
+async def probe (broker: Broker) -> Optional[float]:
+    """
+    Measure the time between sending a CONNECT packet to a broker and receiving its CONNACK packet.
+
+    :return: the round trip time in seconds, or None if the broker cannot be reached, does not answer in time or
+    refuses the connection.
+    """
+    try:
+        reader, writer = await asyncio.wait_for (asyncio.open_connection (broker.host, broker.port), PROBE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        time_start = time.monotonic ()
+        writer.write (CONNECT_PACKET)
+        reply = await asyncio.wait_for (reader.readexactly (4), PROBE_TIMEOUT)
+        rtt = time.monotonic () - time_start
+        if reply [0] != 0x20 or reply [3] != 0:
+            return None
+        writer.write (DISCONNECT_PACKET)
+        await writer.drain ()
+        return rtt
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return None
+    finally:
+        writer.close ()
+
+
+def best_broker () -> Optional[Broker]:
+    """
+    Return the broker the public client should move to, or None if it should stay with the current broker.
+    """
+    reachable = [broker for broker in brokers if broker.reachable]
+    if len (reachable) == 0:
+        return None
+    fastest = min (broker.rtt for broker in reachable)
+    best = next (broker for broker in reachable if broker.rtt <= fastest + configuration.BROKER_SWITCH_MARGIN)
+    return None if best is current else best
+
+
+async def monitor (switch) -> None:
+    """
+    Probe the brokers and move the public client to the best one until the coroutine is cancelled.
+
+    :param switch: function called with the broker the public client must connect to.
+    """
+    global wake, loop, current, number_switches, number_failovers
+    loop = asyncio.get_event_loop ()
+    wake = asyncio.Event ()
+    if len (brokers) < 2:
+        return
+    while True:
+        rtts = await asyncio.gather (*(probe (broker) for broker in brokers))
+        for broker, rtt in zip (brokers, rtts):
+            broker.update (rtt)
+        broker = best_broker ()
+        if broker is not None:
+            if verbose > 0:
+                print ('Switching from broker {} to {}'.format (current, broker))
+            number_switches += 1
+            if not current.reachable:
+                number_failovers += 1
+            current = broker
+            switch (broker)
+        if connected and current.consecutive_failures == 0:
+            period = configuration.BROKER_PROBE_PERIOD
+        else:
+            period = DISCONNECTED_PROBE_PERIOD
+        try:
+            await asyncio.wait_for (wake.wait (), period)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear ()
+
+
+def connection_up () -> None:
+    """
+    Called when the public client connects to the current broker.
+    """
+    global connected, connected_since, number_connects
+    if not connected:
+        connected = True
+        connected_since = time.monotonic ()
+        number_connects += 1
+
+
+def connection_down (rc: int) -> None:
+    """
+    Called when the public client disconnects.  An unexpected disconnection triggers a probe of all brokers.
+
+    :param rc: the disconnection reason, 0 if the client asked to disconnect.
+    """
+    global connected, connected_time, number_disconnects
+    if connected:
+        connected = False
+        connected_time += time.monotonic () - connected_since
+        number_disconnects += 1
+    if rc != 0 and wake is not None:
+        loop.call_soon_threadsafe (wake.set)
+
+
+def statistics () -> str:
+    """
+    Return the connection state and the state of each broker as text for the telemetry topic.
+    """
+    total_time = connected_time + (time.monotonic () - connected_since if connected else 0.0)
+    result = 'current={} connected={} connects={} disconnects={} switches={} failovers={} connected_time={:.0f}'.format (
+        current, int (connected), number_connects, number_disconnects, number_switches, number_failovers, total_time)
+    for broker in brokers:
+        result += ' {}:reachable={},rtt={},probes={},failures={}'.format (
+            broker, int (broker.reachable),
+            'nan' if broker.rtt is None else '{:.4f}'.format (broker.rtt),
+            broker.number_probes, broker.number_failures)
+    return result
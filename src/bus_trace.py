@@ -0,0 +1,453 @@
+"""
+Traces the calls made on the SPI, UART and I2C bus handles of the sensors.
+
+Tracing is enabled with option bus_trace in the configuration file.  When it is disabled, the wrap functions return the
+bus handles themselves, so the sensors pay nothing.  When it is enabled, they return a proxy that times each transfer
+and counts, per device, the calls, the bytes written and read, the errors, the timeouts and the latency in a
+fixed-bucket histogram.  A UART read that returns some bytes but fewer than asked for is a timeout.  A UART read that
+returns no bytes is an idle poll: it is counted apart and its duration, which is the UART timeout, is not added to the
+latency.
+
+Each call is also stored in a ring buffer of RECORDS preallocated slots, with the bytes written and read truncated to
+PAYLOAD_SIZE bytes.  Function dump writes the ring buffer to a binary trace file, which function read_trace reads back
+in call order.  The module does not import the configuration, so trace files can be read on a computer.
+
+The record backend of module backends also keeps every call in full from the start of the sensor node, up to
+RECORD_LIMIT bytes, so that the trace file written by function write_recording can be replayed.
+
+The trace file starts with the header:
+
+    magic (10 bytes) version (u16) payload size (u16) number of devices (u16) start wall clock time (f64)
+    number of records (u32)
+
+followed by each device name as a length (u8) and UTF-8 text, and by the records:
+
+    time since the start (f64) duration (f32) device (u16) operation (u8) flags (u8) length written (u16)
+    length read (u16) bytes written bytes read
+
+All numbers are little-endian.  Only the first payload size bytes of each record are stored, bytes written first.  A
+payload size of zero means that the records are stored in full.
+
+Usage, to summarise a trace file:
+
+    python3 bus_trace.py trace_file
+"""
+import array
+import bisect
+import collections
+import datetime
+import errno
+import os
+import struct
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+
+SPI_XFER, UART_WRITE, UART_READ, I2C_READ, I2C_WRITE, I2C_WRITE_READ = range (6)
+OPERATION_NAMES = ['spi_xfer', 'uart_write', 'uart_read', 'i2c_read', 'i2c_write', 'i2c_write_read']
+
+ERROR = 1
+TIMEOUT = 2
+TRUNCATED = 4
+IDLE = 8
+
+BUCKET_LIMITS = [
+    0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5]
+"""Upper limit in seconds of each histogram bucket.  The last bucket has no upper limit."""
+
+RECORDS = 8192
+"""Number of calls kept in the ring buffer."""
+PAYLOAD_SIZE = 64
+"""Number of bytes written and read kept per call."""
+
+RECORD_LIMIT = 64 * 1024 * 1024
+"""Maximum number of bytes of a recording."""
+
+MAGIC = b'EXPOLISBUS'
+VERSION = 2
+FILE_HEADER = struct.Struct ('<10sHHHdI')
+RECORD_HEADER = struct.Struct ('<dfHBBHH')
+SLOT_SIZE = RECORD_HEADER.size + PAYLOAD_SIZE
+
+Record = collections.namedtuple (
+    'Record', ['time', 'duration', 'device', 'operation', 'flags', 'length_out', 'length_in', 'data_out', 'data_in'])
+
+
+class Device:
+    __slots__ = (
+        'name', 'index', 'number_calls', 'bytes_out', 'bytes_in', 'number_errors', 'number_timeouts', 'number_idle',
+        'total_time', 'max_time', 'histogram',
+    )
+
+    def __init__ (self, name, index):
+        self.name = name
+        self.index = index
+        self.number_calls = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.number_errors = 0
+        self.number_timeouts = 0
+        self.number_idle = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = array.array ('Q', [0] * (len (BUCKET_LIMITS) + 1))
+
+
+enabled = False
+devices = []  # type: List[Device]
+ring = bytearray ()
+number_records = 0
+"""Number of calls recorded since tracing started."""
+start_time = 0.0
+"""Value of time.perf_counter when tracing started."""
+start_wall_time = 0.0
+lock = threading.Lock ()
+
+recording = None  # type: Optional[bytearray]
+"""The calls recorded in full since recording started, or None."""
+number_recorded = 0
+
+
+def init_trace (enable: bool) -> None:
+    """
+    Enable tracing of the bus handles wrapped afterwards.
+    """
+    global enabled, ring, start_time, start_wall_time
+    enabled = enable
+    if enabled:
+        ring = bytearray (RECORDS * SLOT_SIZE)
+        start_time = time.perf_counter ()
+        start_wall_time = time.time ()
+
+
+def start_recording () -> None:
+    """
+    Enable tracing and keep every call in full.
+    """
+    global recording
+    if not enabled:
+        init_trace (True)
+    recording = bytearray ()
+
+
+def device (name: str) -> Device:
+    """
+    Return the device with the given name, created on the first call.
+    """
+    for a_device in devices:
+        if a_device.name == name:
+            return a_device
+    a_device = Device (name, len (devices))
+    devices.append (a_device)
+    return a_device
+
+
+def record (a_device: Device, operation: int, start: float, data_out, data_in, flags: int) -> None:
+    """
+    Count a call that started at the given value of time.perf_counter and store it in the ring buffer.
+    """
+    global number_records, number_recorded
+    duration = time.perf_counter () - start
+    length_out = len (data_out)
+    length_in = len (data_in)
+    stored_out = min (length_out, PAYLOAD_SIZE)
+    stored_in = min (length_in, PAYLOAD_SIZE - stored_out)
+    if stored_out + stored_in < length_out + length_in:
+        flags |= TRUNCATED
+    with lock:
+        if flags & IDLE:
+            a_device.number_idle += 1
+        else:
+            a_device.number_calls += 1
+            a_device.bytes_out += length_out
+            a_device.bytes_in += length_in
+            a_device.number_errors += flags & ERROR
+            a_device.number_timeouts += (flags & TIMEOUT) >> 1
+            a_device.total_time += duration
+            if duration > a_device.max_time:
+                a_device.max_time = duration
+            a_device.histogram [bisect.bisect_left (BUCKET_LIMITS, duration)] += 1
+        offset = (number_records % RECORDS) * SLOT_SIZE
+        number_records += 1
+        RECORD_HEADER.pack_into (
+            ring, offset, start - start_time, duration, a_device.index, operation, flags, length_out, length_in)
+        offset += RECORD_HEADER.size
+        ring [offset:offset + stored_out] = data_out [:stored_out]
+        offset += stored_out
+        ring [offset:offset + stored_in] = data_in [:stored_in]
+        if recording is not None and len (recording) < RECORD_LIMIT:
+            recording.extend (RECORD_HEADER.pack (
+                start - start_time, duration, a_device.index, operation, flags, length_out, length_in))
+            recording.extend (data_out)
+            recording.extend (data_in)
+            number_recorded += 1
+
+
+class TracedSpi:
+    """
+    Stands in for a spidev.SpiDev object.
+    """
+    def __init__ (self, spi, name: str):
+        self.spi = spi
+        self.device = device (name)
+
+    def __getattr__ (self, name):
+        return getattr (self.spi, name)
+
+    def xfer (self, data, *args):
+        start = time.perf_counter ()
+        try:
+            result = self.spi.xfer (data, *args)
+        except OSError:
+            record (self.device, SPI_XFER, start, bytes (data), b'', ERROR)
+            raise
+        record (self.device, SPI_XFER, start, bytes (data), bytes (result), 0)
+        return result
+
+
+class TracedUart:
+    """
+    Stands in for a serial.Serial object.
+    """
+    def __init__ (self, uart, name: str):
+        self.uart = uart
+        self.device = device (name)
+
+    def __getattr__ (self, name):
+        return getattr (self.uart, name)
+
+    def write (self, data):
+        start = time.perf_counter ()
+        try:
+            result = self.uart.write (data)
+        except OSError:
+            record (self.device, UART_WRITE, start, data, b'', ERROR)
+            raise
+        record (self.device, UART_WRITE, start, data, b'', 0)
+        return result
+
+    def read (self, size=1):
+        start = time.perf_counter ()
+        try:
+            result = self.uart.read (size)
+        except OSError:
+            record (self.device, UART_READ, start, b'', b'', ERROR)
+            raise
+        record (
+            self.device, UART_READ, start, b'', result,
+            IDLE if len (result) == 0 else TIMEOUT if len (result) < size else 0)
+        return result
+
+
+class TracedI2C:
+    """
+    Stands in for a busio.I2C object.  Calls are counted against the device at the address they use.
+    """
+    def __init__ (self, i2c, names: dict):
+        self.i2c = i2c
+        self.names = names
+        self.devices = {}
+
+    def __getattr__ (self, name):
+        return getattr (self.i2c, name)
+
+    def device (self, address: int) -> Device:
+        result = self.devices.get (address)
+        if result is None:
+            result = device (device_name (self.names, address))
+            self.devices [address] = result
+        return result
+
+    def transfer (self, operation: int, address: int, function, args, data_out, data_in, kwargs):
+        start = time.perf_counter ()
+        try:
+            function (address, *args, **kwargs)
+        except OSError as e:
+            record (self.device (address), operation, start, data_out, b'',
+                    ERROR | (TIMEOUT if e.errno == errno.ETIMEDOUT else 0))
+            raise
+        record (self.device (address), operation, start, data_out, data_in, 0)
+
+    def readfrom_into (self, address, buffer, *, start=0, end=None):
+        data_in = memoryview (buffer) [start:end]
+        self.transfer (
+            I2C_READ, address, self.i2c.readfrom_into, (buffer, ), b'', data_in, {'start': start, 'end': end})
+
+    def writeto (self, address, buffer, *, start=0, end=None):
+        data_out = memoryview (buffer) [start:end]
+        self.transfer (I2C_WRITE, address, self.i2c.writeto, (buffer, ), data_out, b'', {'start': start, 'end': end})
+
+    def writeto_then_readfrom (self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0,
+                               in_end=None):
+        data_out = memoryview (buffer_out) [out_start:out_end]
+        data_in = memoryview (buffer_in) [in_start:in_end]
+        self.transfer (
+            I2C_WRITE_READ, address, self.i2c.writeto_then_readfrom, (buffer_out, buffer_in), data_out, data_in,
+            {'out_start': out_start, 'out_end': out_end, 'in_start': in_start, 'in_end': in_end})
+
+
+def device_name (names: dict, address: int) -> str:
+    """
+    Return the name of the I2C device at the given address.
+    """
+    return names.get (address, '0x{:02X}'.format (address))
+
+
+def wrap_spi (spi, name: str):
+    """
+    Return the given SPI handle, traced as the given device if tracing is enabled.
+    """
+    return TracedSpi (spi, name) if enabled else spi
+
+
+def wrap_uart (uart, name: str):
+    """
+    Return the given UART handle, traced as the given device if tracing is enabled.
+    """
+    return TracedUart (uart, name) if enabled else uart
+
+
+def wrap_i2c (i2c, names: dict):
+    """
+    Return the given I2C handle, traced if tracing is enabled.
+
+    :param names: the device names indexed by address.
+    """
+    return TracedI2C (i2c, names) if enabled else i2c
+
+
+def percentile (histogram, total: int, fraction: float) -> float:
+    """
+    Return the upper limit of the bucket that contains the given percentile.
+    """
+    target = total * fraction
+    accumulated = 0
+    for index, count in enumerate (histogram):
+        accumulated += count
+        if accumulated >= target:
+            return BUCKET_LIMITS [index] if index < len (BUCKET_LIMITS) else float ('inf')
+    return float ('inf')
+
+
+def statistics ():
+    """
+    :return: a list with a tuple per device containing its name, number of calls, bytes written, bytes read, number
+    of errors, timeouts and idle polls, mean, 50th and 95th percentile bucket limits and maximum duration in seconds.
+    """
+    result = []
+    for a_device in devices:
+        calls = a_device.number_calls
+        result.append ((
+            a_device.name, calls, a_device.bytes_out, a_device.bytes_in, a_device.number_errors,
+            a_device.number_timeouts, a_device.number_idle, a_device.total_time / calls if calls > 0 else 0.0,
+            percentile (a_device.histogram, calls, 0.5),
+            percentile (a_device.histogram, calls, 0.95),
+            a_device.max_time))
+    return result
+
+
+def dump (folder: str) -> str:
+    """
+    Write the calls in the ring buffer to a trace file in the given folder.
+
+    :return: the trace file name.
+    """
+    with lock:
+        snapshot = bytes (ring)
+        total = number_records
+        names = [a_device.name for a_device in devices]
+    first = max (0, total - RECORDS)
+    records = bytearray ()
+    for index in range (first, total):
+        offset = (index % RECORDS) * SLOT_SIZE
+        _time, _duration, _device, _operation, _flags, length_out, length_in = RECORD_HEADER.unpack_from (
+            snapshot, offset)
+        stored_out = min (length_out, PAYLOAD_SIZE)
+        stored_in = min (length_in, PAYLOAD_SIZE - stored_out)
+        records.extend (snapshot [offset:offset + RECORD_HEADER.size + stored_out + stored_in])
+    return write_trace (folder, 'bus', PAYLOAD_SIZE, names, total - first, records)
+
+
+def write_recording (folder: str) -> str:
+    """
+    Write the recorded calls to a trace file in the given folder.
+
+    :return: the trace file name.
+    """
+    with lock:
+        records = bytes (recording)
+        number = number_recorded
+        names = [a_device.name for a_device in devices]
+    return write_trace (folder, 'recording', 0, names, number, records)
+
+
+def write_trace (folder: str, kind: str, payload_size: int, names: List[str], number: int, records: bytes) -> str:
+    os.makedirs (folder, exist_ok=True)
+    filename = os.path.join (folder, '{}_{}.trace'.format (
+        kind, datetime.datetime.now ().strftime ('%Y_%m_%d__%H_%M_%S')))
+    with open (filename, 'wb') as fd:
+        fd.write (FILE_HEADER.pack (MAGIC, VERSION, payload_size, len (names), start_wall_time, number))
+        for name in names:
+            encoded = name.encode ()
+            fd.write (bytes ([len (encoded)]) + encoded)
+        fd.write (records)
+    return filename
+
+
+def read_trace (filename: str) -> Tuple[List[str], List[Record]]:
+    """
+    Read a trace file written by function dump or write_recording.
+
+    :return: the device names and the records in call order.
+    :raises ValueError: if the file is not a trace file.
+    """
+    with open (filename, 'rb') as fd:
+        content = fd.read ()
+    magic, version, payload_size, number_devices, _start_wall_time, number = FILE_HEADER.unpack_from (content, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError ('{} is not a bus trace file'.format (filename))
+    offset = FILE_HEADER.size
+    names = []
+    for _ in range (number_devices):
+        length = content [offset]
+        names.append (content [offset + 1:offset + 1 + length].decode ())
+        offset += 1 + length
+    records = []
+    for _ in range (number):
+        time_, duration, device_index, operation, flags, length_out, length_in = RECORD_HEADER.unpack_from (
+            content, offset)
+        offset += RECORD_HEADER.size
+        if payload_size == 0:
+            stored_out, stored_in = length_out, length_in
+        else:
+            stored_out = min (length_out, payload_size)
+            stored_in = min (length_in, payload_size - stored_out)
+        records.append (Record (
+            time_, duration, names [device_index], operation, flags, length_out, length_in,
+            content [offset:offset + stored_out], content [offset + stored_out:offset + stored_out + stored_in]))
+        offset += stored_out + stored_in
+    return names, records
+
+
+def main ():
+    names, records = read_trace (sys.argv [1])
+    print ('{} records'.format (len (records)))
+    for name in names:
+        device_records = [a_record for a_record in records if a_record.device == name]
+        for operation, operation_name in enumerate (OPERATION_NAMES):
+            operation_records = [a_record for a_record in device_records if a_record.operation == operation]
+            durations = sorted (a_record.duration for a_record in operation_records if not a_record.flags & IDLE)
+            if len (durations) == 0:
+                continue
+            flags = [a_record.flags for a_record in operation_records]
+            print ('{} {}: n={} errors={} timeouts={} idle={} mean={:.6f} p50={:.6f} p95={:.6f} max={:.6f}'.format (
+                name, operation_name, len (durations),
+                sum (1 for flag in flags if flag & ERROR), sum (1 for flag in flags if flag & TIMEOUT),
+                sum (1 for flag in flags if flag & IDLE),
+                sum (durations) / len (durations), durations [len (durations) // 2],
+                durations [int (len (durations) * 0.95)], durations [-1]))
+
+
+if __name__ == '__main__':
+    main ()
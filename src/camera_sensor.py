@@ -1,51 +1,144 @@
 import datetime
-import picamera
+import threading
 import time
 from io import BytesIO
-import base64
 
+import paho.mqtt.client as mqtt
+
+import backends
 import configuration as cfg
+import frame_store
 
 camera = None
 
+camera_lock = threading.Lock ()
+"""Serialises access to the camera between the main loop and frame requests."""
+
 capture_frames = False
 
 image_file = 'none'
 
 capture_frames_period = 5
+"""Period in ticks of the scheduler task that captures frames."""
+
+TASK_BUDGET = 0.5
+"""Time in seconds the scheduler task is expected to take."""
+
+FRAME_LADDER = [
+    ((160, 120), 10),
+    ((320, 240), 15),
+    ((640, 480), 25),
+    ((1024, 768), 40),
+    ((1024, 768), 85),
+]
+"""Resolution and JPEG quality of each frame level, from the smallest to the largest."""
+
+MAX_RESOLUTION = FRAME_LADDER [-1][0]
+"""Resolution the camera is opened with, the largest frame that can be requested."""
+
+FRAME_TARGET_TIME = 1.0
+"""Time in seconds in which we want a frame to reach the broker."""
+
+frame_level = 1
+"""Current level in the frame ladder used when a client does not request a specific one."""
+
+frame_sizes = [4000, 10000, 25000, 50000, 120000]
+"""Estimated size in bytes of a frame at each level in the frame ladder."""
+
+link_throughput = 8000.0
+"""Estimated throughput in bytes per second of the link to the broker."""
 
 
 def init_camera ():
     global camera
 
-    camera = picamera.PiCamera ()
-    camera.resolution = (1024, 768)
+    camera = backends.open_camera ()
+    camera.resolution = MAX_RESOLUTION
     camera.start_preview()
     time.sleep (2)
 
 
-def command_get_one_frame (mqtt_client):
-    my_stream = BytesIO ()
-    camera.capture (my_stream, 'jpeg')
-    my_stream.seek (0)
-    value = base64.b64encode (my_stream.read ())
-    mqtt_client.publish (cfg.TOPIC_IMAGE_DATA, value, qos=0)
+def command_get_one_frame (mqtt_client: mqtt.Client, *args):
+    """
+    Send one frame to the image topic.
+
+    Without arguments, the frame level is picked automatically from the estimated link throughput.  A single argument
+    selects a level in the frame ladder.  Three arguments select the width, height and JPEG quality.  The width and
+    height must be positive; a frame larger than MAX_RESOLUTION is scaled down to fit it, keeping its aspect ratio.
+    Any other number of arguments is rejected.
+    """
+    try:
+        if len (args) == 0:
+            level = select_frame_level ()
+            resolution, quality = FRAME_LADDER [level]
+        elif len (args) == 1:
+            level = max (0, min (int (args [0]), len (FRAME_LADDER) - 1))
+            resolution, quality = FRAME_LADDER [level]
+        elif len (args) == 3:
+            width, height = int (args [0]), int (args [1])
+            if width <= 0 or height <= 0:
+                raise ValueError ('frame size must be positive')
+            scale = min (1.0, MAX_RESOLUTION [0] / width, MAX_RESOLUTION [1] / height)
+            resolution = (max (1, int (width * scale)), max (1, int (height * scale)))
+            quality = max (1, min (int (args [2]), 100))
+            level = None
+        else:
+            raise ValueError ('expected 0, 1 or 3 arguments')
+    except ValueError:
+        mqtt_client.publish (cfg.TOPIC_LOG, 'invalid arguments to get one frame', qos=2)
+        return
+    threading.Thread (
+        target=thread_send_frame_run,
+        args=(mqtt_client, resolution, quality, level),
+    ).start ()
+
+
+def select_frame_level ():
+    """
+    Return the largest level in the frame ladder whose frame is expected to reach the broker in the target time.
+    """
+    global frame_level
+
+    frame_level = 0
+    for level, size in enumerate (frame_sizes):
+        if size / link_throughput <= FRAME_TARGET_TIME:
+            frame_level = level
+    return frame_level
+
+
+def thread_send_frame_run (mqtt_client: mqtt.Client, resolution, quality, level):
+    global link_throughput
+
+    stream = BytesIO ()
+    with camera_lock:
+        camera.capture (stream, 'jpeg', resize=resolution, quality=quality, use_video_port=True)
+    data = stream.getbuffer ()
+    elapsed = frame_store.publish_frame (mqtt_client, data)
+    if elapsed is None:
+        link_throughput = len (data) / frame_store.FRAME_SEND_TIMEOUT
+        return
+    # exponential moving average so that a single fast or slow frame does not swing the ladder
+    link_throughput = 0.7 * link_throughput + 0.3 * len (data) / elapsed
+    if level is not None:
+        frame_sizes [level] = len (data)
 
 
 def step_camera (iteration):
     global image_file
 
-    if capture_frames and iteration % capture_frames_period == 0:
+    if capture_frames:
+        now = datetime.datetime.now ()
         image_file = cfg.IMAGE_FILE_TEMPLATE.format (
             iteration=iteration,
-            datetime=str (datetime.datetime.now ())
+            datetime=str (now)
                 .replace (' ', '__')
                 .split ('.')[0]
                 .replace (':', '_')
                 .replace ('-', '_'),
         )
-        camera.capture (image_file)
+        with camera_lock:
+            camera.capture (image_file)
+        frame_store.add_frame (iteration, now.timestamp (), image_file)
         print ('Frame captured: {}'.format(image_file))
     else:
         pass
-
@@ -0,0 +1,229 @@
+"""
+Runs the commands received on the management MQTT topic in worker threads.
+
+Commands used to run directly in the network loop thread of the paho client that received them.  Some of them block
+for several seconds, during which that client could not send keepalives or receive messages.  Function submit
+acknowledges a command immediately on the log topic and queues it.  At most MAX_WORKERS commands run at the same time,
+each in its own thread.  When the command finishes, a completion message is published on the log topic.
+
+Commands that conflict with each other, for instance those that talk to the OPC-N3 or those that write the
+configuration file, belong to the same conflict group and are run one at a time.  While a command of a group runs,
+the other commands of that group wait in the queue of the group, without taking a worker, so that they do not delay
+the commands of other groups.  A command that waited in the queue of its group for longer than its timeout is dropped
+with a timeout completion message.
+
+A command that takes longer than its timeout is reported on the log topic.  Python threads cannot be cancelled, so
+the command keeps running and its group stays busy, but it no longer counts against MAX_WORKERS, so that a stuck
+command does not delay unrelated commands.  Each command gets a single completion message: a command that finishes
+after its timeout was reported publishes a late message instead.
+
+The commands in SILENT_COMMANDS, such as the PING the sensor node receives back from the brokers, are run without
+acknowledgement or completion messages.
+"""
+import collections
+import itertools
+import threading
+import time
+import traceback
+
+import paho.mqtt.client as mqtt
+
+import configuration
+
+MAX_WORKERS = 4
+"""Number of commands that run at the same time, not counting those that timed out."""
+
+DEFAULT_TIMEOUT = 30.0
+"""Time in seconds after which a command is reported as timed out."""
+
+COMMAND_TIMEOUTS = {
+    'START_SENSORS': 60.0,
+    'STOP_SENSORS': 60.0,
+    'DELETE_LOGS': 120.0,
+    'DELETE_FRAMES': 120.0,
+}
+
+CONFLICT_GROUPS = {
+    'START_SENSORS': 'opc',
+    'STOP_SENSORS': 'opc',
+    'TEST_FILTER': 'configuration',
+    'SAVE_FILTER': 'configuration',
+    'SET_SAMPLING_PERIOD': 'configuration',
+    'START_CAPTURE_FRAMES': 'configuration',
+    'START_LOGGING': 'configuration',
+    'STOP_LOGGING': 'configuration',
+    'DELETE_LOGS': 'configuration',
+    'DELETE_FRAMES': 'frames',
+    'SET_TIMEDATE': 'system',
+    'SET_WIFI': 'system',
+    'POWER_OFF': 'system',
+    'REBOOT': 'system',
+}
+"""Commands in the same group are run one at a time."""
+
+SILENT_COMMANDS = {'PING', 'REGISTER_EVENT'}
+"""Commands that are not acknowledged, as they do nothing or reply themselves."""
+
+Command = collections.namedtuple (
+    'Command', ['mqtt_client', 'command_id', 'name', 'function', 'args', 'time_submitted'])
+
+pending_commands = collections.deque ()
+"""Commands waiting for a worker."""
+
+group_queues = {group: collections.deque () for group in set (CONFLICT_GROUPS.values ())}
+"""Commands waiting for the running command of their group to finish, indexed by group."""
+
+busy_groups = set ()
+"""Groups with a running or pending command."""
+
+number_workers = 0
+"""Number of running commands that have not timed out."""
+
+command_ids = itertools.count (1)
+
+running_commands = {}
+"""Start time of each running command indexed by command id."""
+timed_out_commands = set ()
+"""Ids of the running commands whose timeout was reported."""
+running_commands_lock = threading.Lock ()
+"""Protects the queues, the busy groups, the number of workers and the running commands."""
+
+stopped = False
+
+verbose = 1
+
+
+def submit (mqtt_client: mqtt.Client, name: str, function, args) -> None:
+    """
+    Acknowledge a command and queue it.
+
+    :param mqtt_client: the client that received the command, where acknowledgement and completion messages are
+        published.
+    :param name: the command keyword.
+    :param function: the function that implements the command.
+    :param args: the command arguments.
+    """
+    command = Command (mqtt_client, next (command_ids), name, function, args, time.monotonic ())
+    if name not in SILENT_COMMANDS:
+        mqtt_client.publish (configuration.TOPIC_LOG, 'accepted {} {}'.format (name, command.command_id), qos=2)
+    group = CONFLICT_GROUPS.get (name)
+    with running_commands_lock:
+        if group in busy_groups:
+            group_queues [group].append (command)
+            return
+        if group is not None:
+            busy_groups.add (group)
+        pending_commands.append (command)
+        start_workers ()
+
+
+def start_workers () -> None:
+    """
+    Start a thread for each pending command while fewer than MAX_WORKERS commands run.
+
+    Must be called with running_commands_lock held.
+    """
+    global number_workers
+    while not stopped and number_workers < MAX_WORKERS and len (pending_commands) > 0:
+        number_workers += 1
+        threading.Thread (target=run_command, args=(pending_commands.popleft (),), name='command', daemon=True).start ()
+
+
+def next_in_group (group: str):
+    """
+    Move the next command queued in a group to the pending commands, or mark the group free if none is queued.
+
+    Must be called with running_commands_lock held.
+
+    :return: the commands dropped because they waited in the queue for longer than their timeout.
+    """
+    expired = []
+    queue = group_queues [group]
+    now = time.monotonic ()
+    while len (queue) > 0:
+        command = queue.popleft ()
+        if now - command.time_submitted > COMMAND_TIMEOUTS.get (command.name, DEFAULT_TIMEOUT):
+            expired.append (command)
+        else:
+            pending_commands.append (command)
+            return expired
+    busy_groups.discard (group)
+    return expired
+
+
+def run_command (command: Command) -> None:
+    global number_workers
+    mqtt_client, command_id, name, function, args, _time_submitted = command
+    timeout = COMMAND_TIMEOUTS.get (name, DEFAULT_TIMEOUT)
+    group = CONFLICT_GROUPS.get (name)
+    time_start = time.monotonic ()
+    with running_commands_lock:
+        running_commands [command_id] = time_start
+    watchdog = threading.Timer (timeout, report_timeout, args=(mqtt_client, command_id, name))
+    watchdog.daemon = True
+    watchdog.start ()
+    try:
+        if verbose > 0:
+            print ('*************** Running [{} {}]...'.format (name, ' '.join (args)))
+        function (mqtt_client, *args)
+        status = 'ok {:.1f}s'.format (time.monotonic () - time_start)
+    except TypeError as e:
+        print ('--------------- error {}'.format (e))
+        status = 'error {}'.format (e)
+    except Exception as e:
+        traceback.print_exc ()
+        status = 'error {}'.format (e)
+    finally:
+        watchdog.cancel ()
+        with running_commands_lock:
+            del running_commands [command_id]
+            late = command_id in timed_out_commands
+            if late:
+                timed_out_commands.discard (command_id)
+            else:
+                number_workers -= 1
+            expired = next_in_group (group) if group is not None else []
+            start_workers ()
+    if late:
+        publish_log (mqtt_client, 'late {} {} {}'.format (name, command_id, status), name)
+    else:
+        publish_completion (mqtt_client, command_id, name, status)
+    for command in expired:
+        publish_completion (
+            command.mqtt_client, command.command_id, command.name, 'timeout waiting for {} commands'.format (group))
+
+
+def report_timeout (mqtt_client: mqtt.Client, command_id: int, name: str) -> None:
+    """
+    Publish the completion of a command that is still running after its timeout, unless it has just finished, and
+    free its worker for the pending commands.
+    """
+    global number_workers
+    with running_commands_lock:
+        if command_id not in running_commands:
+            return
+        timed_out_commands.add (command_id)
+        number_workers -= 1
+        start_workers ()
+    publish_completion (mqtt_client, command_id, name, 'timeout')
+
+
+def publish_completion (mqtt_client: mqtt.Client, command_id: int, name: str, status: str) -> None:
+    publish_log (mqtt_client, 'completed {} {} {}'.format (name, command_id, status), name)
+
+
+def publish_log (mqtt_client: mqtt.Client, msg: str, name: str) -> None:
+    if name not in SILENT_COMMANDS:
+        mqtt_client.publish (configuration.TOPIC_LOG, msg, qos=2)
+
+
+def shutdown () -> None:
+    """
+    Stop accepting commands and drop the queued ones.  Running commands are not waited for.
+    """
+    global stopped
+    with running_commands_lock:
+        stopped = True
+        pending_commands.clear ()
+        for queue in group_queues.values ():
+            queue.clear ()
@@ -10,29 +10,28 @@ mqtt payload.
 
 from subprocess import call
 from time import sleep
-from threading import Thread
 import paho.mqtt.client as mqtt
 
 import configuration as c
 
 
 def command_ping (_mqtt_client: mqtt.Client, *_args):
-    c.WATCHDOG_PATH.touch ()
+    """
+    PING messages are received back from the brokers.  They used to touch the watchdog file, which is now touched by
+    the supervisor while the main loop is ticking, so that losing the brokers does not kill the process.
+    """
+    pass
 
 
 def command_set_time (mqtt_client: mqtt.Client, t_year, t_month, t_day, t_hour, t_minute, t_seconds):
-    def thread_set_time ():
-        msg_time_date = 'sudo date -s "{}-{}-{} {}:{}:{}"'.format (t_year, t_month, t_day, t_hour, t_minute, t_seconds)
-        print ("time/date set: " + msg_time_date)
-        call (msg_time_date, shell=True)
-        sleep (1)
-        # noinspection SpellCheckingInspection
-        call ("sudo hwclock -w", shell=True)
-        mqtt_client.publish (c.TOPIC_LOG, "time and date set.", qos=2)
-
     mqtt_client.publish (c.TOPIC_LOG, "received set time date", qos=2)
-    thread_time = Thread (target=thread_set_time)
-    thread_time.start ()
+    msg_time_date = 'sudo date -s "{}-{}-{} {}:{}:{}"'.format (t_year, t_month, t_day, t_hour, t_minute, t_seconds)
+    print ("time/date set: " + msg_time_date)
+    call (msg_time_date, shell=True)
+    sleep (1)
+    # noinspection SpellCheckingInspection
+    call ("sudo hwclock -w", shell=True)
+    mqtt_client.publish (c.TOPIC_LOG, "time and date set.", qos=2)
 
 
 def command_power_off (mqtt_client: mqtt.Client):
@@ -0,0 +1,188 @@
+"""
+Change-driven compression of the sensor data stream.
+
+When compression is enabled, a full sensor data message, a keyframe, is published every KEYFRAME_PERIOD samples on
+the sensor data topic, so that clients that do not know about compression still receive data.  The other samples
+are published on the deltas topic as a delta message that only contains the fields whose value moved beyond the
+field deadband since the keyframe.  A delta message is:
+
+    sensor_node_id sample keyframe_sample date time index=value index=value ...
+
+where index is the position of the field in sample.MQTT_FIELDS and value is the text of the field exactly as in the
+full message.  Deltas are relative to the keyframe and not to the previous delta, so a lost delta does not corrupt the
+following ones.  A keyframe is also sent when a delta would contain more than half of the fields.
+
+The Decoder class rebuilds the full message of each sample.  Fields sent in the delta are rebuilt bit-exactly, the
+other fields have the keyframe text, which is within the deadband of the true value.
+"""
+import collections
+
+import sample
+
+DEADBANDS = {
+    'latitude': 0.00001,
+    'longitude': 0.00001,
+    'co_1': 0.001,
+    'co_2': 0.001,
+    'no2_1': 0.001,
+    'no2_2': 0.001,
+    'pm1_opc': 0.5,
+    'pm25_opc': 0.5,
+    'pm10_opc': 0.5,
+    'pm1_opc_filt': 0.2,
+    'pm2_opc_filt': 0.2,
+    'pm_10_opc_filt': 0.2,
+    'temperature': 0.1,
+    'pressure': 0.1,
+    'humidity': 0.5,
+    'gps_error': 1.0,
+    'power': 0.01,
+    'acceleration_rms': 0.05,
+    'acceleration_peak': 0.1,
+    'acceleration_frequency': 0.5,
+    'pm1_honwell': 1,
+    'pm25_honwell': 1,
+    'pm4_honwell': 1,
+    'pm10_honwell': 1,
+    'gps_fix_age': 1.0,
+    'gps_speed': 0.3,
+    'co_1_std': 0.001,
+    'co_2_std': 0.001,
+    'no2_1_std': 0.001,
+    'no2_2_std': 0.001,
+    'co_1_count': 10,
+    'co_2_count': 10,
+    'no2_1_count': 10,
+    'no2_2_count': 10,
+}
+"""
+Maximum difference between the value of a field and its keyframe value that is not sent.  Fields not listed here are
+sent whenever their text changes.
+"""
+
+HEADER_LENGTH = 4
+"""Number of leading tokens of a full message: sensor node id, sample and the date and time."""
+
+FIELDS = sample.MQTT_FIELDS [3:]
+"""The fields that follow the header in a full message."""
+FIELD_DEADBANDS = [DEADBANDS.get (name, 0) for name in FIELDS]
+
+MAX_KEYFRAMES = 16
+"""Number of keyframes kept by the decoder to decode late or resent deltas."""
+
+keyframe = None
+"""The field texts of the last keyframe."""
+keyframe_values = None
+keyframe_sample = None
+samples_since_keyframe = 0
+
+number_keyframes = 0
+number_deltas = 0
+number_fields_sent = 0
+number_bytes_full = 0
+number_bytes_sent = 0
+"""Number of bytes of the full messages and of the messages published instead."""
+
+
+def to_number (text: str):
+    try:
+        return float (text)
+    except ValueError:
+        return None
+
+
+def moved (index: int, text: str, value) -> bool:
+    """
+    Check if a field moved beyond its deadband since the keyframe.
+    """
+    if text == keyframe [index]:
+        return False
+    reference = keyframe_values [index]
+    if value is None or reference is None or value == -1 or reference == -1:
+        return True
+    return abs (value - reference) > FIELD_DEADBANDS [index]
+
+
+def encode (message: str, keyframe_period: int):
+    """
+    Compress a full sensor data message.
+
+    :param message: the full message formatted by sample.format_sample.
+    :param keyframe_period: the maximum number of samples between keyframes.
+    :return: a tuple with a boolean that is true if the message is a keyframe and the message to publish.
+    """
+    global keyframe, keyframe_values, keyframe_sample, samples_since_keyframe
+    global number_keyframes, number_deltas, number_fields_sent, number_bytes_full, number_bytes_sent
+
+    number_bytes_full += len (message)
+    tokens = message.split (' ')
+    header, texts = tokens [:HEADER_LENGTH], tokens [HEADER_LENGTH:]
+    if keyframe is not None and samples_since_keyframe < keyframe_period:
+        changes = []
+        for index, text in enumerate (texts):
+            if moved (index, text, to_number (text)):
+                changes.append ('{}={}'.format (index + 3, text))
+        if len (changes) <= len (texts) // 2:
+            samples_since_keyframe += 1
+            number_deltas += 1
+            number_fields_sent += len (changes)
+            delta = ' '.join (header [:2] + [keyframe_sample] + header [2:] + changes)
+            number_bytes_sent += len (delta)
+            return False, delta
+    keyframe = texts
+    keyframe_values = [to_number (text) for text in texts]
+    keyframe_sample = header [1]
+    samples_since_keyframe = 1
+    number_keyframes += 1
+    number_bytes_sent += len (message)
+    return True, message
+
+
+def reset () -> None:
+    """
+    Send a keyframe with the next sample.
+    """
+    global keyframe
+    keyframe = None
+
+
+def statistics () -> str:
+    """
+    Return the number of keyframes and deltas, the fields sent in deltas and the bytes of the full messages and of the
+    messages published as text for the telemetry topic.
+    """
+    return 'keyframes={} deltas={} fields_sent={} bytes_full={} bytes_sent={}'.format (
+        number_keyframes, number_deltas, number_fields_sent, number_bytes_full, number_bytes_sent)
+
+
+class Decoder:
+    """
+    Rebuilds the full messages of a compressed sensor data stream.
+
+    Full messages received on the sensor data topic are passed to ``decode_keyframe`` and delta messages received on
+    the deltas topic are passed to ``decode_delta``.
+    """
+    def __init__ (self):
+        self.keyframes = collections.OrderedDict ()
+
+    def decode_keyframe (self, message: str) -> str:
+        tokens = message.split (' ')
+        self.keyframes [tokens [1]] = tokens [HEADER_LENGTH:]
+        self.keyframes.move_to_end (tokens [1])
+        while len (self.keyframes) > MAX_KEYFRAMES:
+            self.keyframes.popitem (last=False)
+        return message
+
+    def decode_delta (self, message: str):
+        """
+        :return: the full message of the sample, or None if its keyframe was not received.
+        """
+        tokens = message.split (' ')
+        texts = self.keyframes.get (tokens [2])
+        if texts is None:
+            return None
+        texts = list (texts)
+        for change in tokens [HEADER_LENGTH + 1:]:
+            index, text = change.split ('=', 1)
+            texts [int (index) - 3] = text
+        return ' '.join (tokens [:2] + tokens [3:HEADER_LENGTH + 1] + texts)
@@ -4,18 +4,46 @@ import pathlib
 
 BASE_PATH = '/home/pi/SensorNode/'
 
-CONFIG_PATH = BASE_PATH + 'Sensor_Node.ini'
+CONFIG_PATH = os.environ.get ('SENSOR_NODE_CONFIG', BASE_PATH + 'Sensor_Node.ini')
 
 config = configparser.ConfigParser ()
 config.read (CONFIG_PATH)
 
-BROKER_ADDRESS = config['BASE']['mqtt_broker']
+BROKER_ADDRESSES = [address.strip () for address in config['BASE']['mqtt_broker'].split (',') if address.strip ()]
+BROKER_PROBE_PERIOD = max (2, config.getint ('BASE', 'broker_probe_period', fallback=5))
+BROKER_SWITCH_MARGIN = max (0, config.getint ('BASE', 'broker_switch_margin_ms', fallback=50)) / 1000
 STORAGE_FOLDER = config['BASE']['storage']
 SENSOR_NODE_ID = config.getint ('BASE', 'sensor_node_id')
 PUBLISH_RATE_PERIOD = int (config['BASE']['publish_rate_period'])
+GPS_RATE = max (1, min (config.getint ('BASE', 'gps_rate_hz', fallback=1), 10))
+ACCELEROMETER_RATE = max (50, min (config.getint ('BASE', 'accelerometer_rate_hz', fallback=100), 200))
+ADC_CONTINUOUS = config.getboolean ('BASE', 'adc_continuous', fallback=False)
+ADC_DATA_RATES = (8, 16, 32, 64, 128, 250, 475, 860)
+ADC_DATA_RATE = config.getint ('BASE', 'adc_data_rate', fallback=475)
+if ADC_DATA_RATE not in ADC_DATA_RATES:
+    print ('ADC data rate {} is not one of {}, using 475.'.format (ADC_DATA_RATE, ADC_DATA_RATES))
+    ADC_DATA_RATE = 475
+PUBLIC_IP_URL = config.get ('BASE', 'public_ip_url', fallback='https://v4.ident.me')
+TELEMETRY_PERIOD = config.getint ('BASE', 'telemetry_period_minutes', fallback=10)
+FRAMES_QUOTA = config.getint ('BASE', 'frames_quota_mb', fallback=512) * 1024 * 1024
+HISTORY_HOURS = max (1, min (config.getint ('BASE', 'history_hours', fallback=1), 24))
+COMPRESSION = config.getboolean ('BASE', 'compression', fallback=False)
+KEYFRAME_PERIOD = max (1, config.getint ('BASE', 'keyframe_period', fallback=60))
+ADAPTIVE_SAMPLING = config.getboolean ('BASE', 'adaptive_sampling', fallback=False)
+PARKED_SPEED = config.getfloat ('BASE', 'parked_speed', fallback=1.0)
+PARKED_DELAY = config.getint ('BASE', 'parked_delay', fallback=120)
+PARKED_ACQUISITION_PERIOD = max (1, min (config.getint ('BASE', 'parked_acquisition_period', fallback=5), 60))
+PARKED_PUBLISH_PERIOD = max (1, min (config.getint ('BASE', 'parked_publish_period', fallback=30), 3600))
+LOW_POWER_VOLTAGE = config.getfloat ('BASE', 'low_power_voltage', fallback=0.0)
+OPC_DUTY_PERIOD = max (60, config.getint ('BASE', 'opc_duty_period', fallback=300))
+OPC_DUTY_ON = max (30, min (config.getint ('BASE', 'opc_duty_on', fallback=60), OPC_DUTY_PERIOD))
+BUS_TRACE = config.getboolean ('BASE', 'bus_trace', fallback=False)
+DEVICE_BACKEND = config.get ('BASE', 'device_backend', fallback='hardware')
+DEVICE_TRACE = config.get ('BASE', 'device_trace', fallback='')
 
 LOGS_FOLDER = os.path.join (STORAGE_FOLDER, 'logs/')
 IMAGES_FOLDER = os.path.join (STORAGE_FOLDER, 'images/')
+TRACES_FOLDER = os.path.join (STORAGE_FOLDER, 'traces/')
 
 WATCHDOG_PATH = pathlib.Path (os.path.join (STORAGE_FOLDER, 'watchdog'))
 
@@ -26,6 +54,10 @@ TOPIC_LOG = 'expolis_project/sensor_nodes/logs/sn_{}'.format (SENSOR_NODE_ID)
 TOPIC_CSV_FILES = 'expolis_project/sensor_nodes/csvfiles/sn_{}'.format (SENSOR_NODE_ID)
 TOPIC_MANAGEMENT = 'expolis_project/sensor_nodes/management/sn_{}'.format (SENSOR_NODE_ID)
 TOPIC_SENSOR_DATA = 'expolis_project/sensor_nodes/sn_{}'.format (SENSOR_NODE_ID)
+TOPIC_SENSOR_AGGREGATES = 'expolis_project/sensor_nodes/aggregates/sn_{}'.format (SENSOR_NODE_ID)
+TOPIC_SENSOR_DELTAS = 'expolis_project/sensor_nodes/deltas/sn_{}'.format (SENSOR_NODE_ID)
+TOPIC_TELEMETRY = 'expolis_project/sensor_nodes/telemetry/sn_{}'.format (SENSOR_NODE_ID)
+TOPIC_PROFILES = 'expolis_project/sensor_nodes/profiles/sn_{}'.format (SENSOR_NODE_ID)
 TOPIC_IMAGE_DATA = 'expolis_project/sensor_nodes/images/sn_{}'.format (SENSOR_NODE_ID)
 
 
@@ -0,0 +1,102 @@
+"""
+Checks the broker selection of module brokers against two MQTT stand-ins listening on this computer.
+
+The first stand-in is the preferred broker and the second one the backup.  The script runs coroutine brokers.monitor,
+pauses the preferred stand-in so that it stops answering, and measures the time until the monitor moves the public
+client to the backup.  It then resumes the preferred stand-in and measures the time until the monitor moves back.  It
+fails if either time exceeds the limit given by the probe period, the probe timeout and the number of failed probes
+after which a broker is unreachable.
+
+Usage:
+
+    python3 failover_check.py [latency_ms [first_port]]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import mqtt_standin
+
+PROBE_PERIOD = 2
+"""Value of the broker_probe_period setting, in seconds."""
+
+MARGIN = 1.0
+"""Time in seconds added to the limits for the scheduling of the coroutines."""
+
+CONFIGURATION = """[BASE]
+mqtt_broker = 127.0.0.1:{port_preferred}, 127.0.0.1:{port_backup}
+storage = {storage}
+sensor_node_id = 0
+publish_rate_period = 1
+broker_probe_period = {probe_period}
+"""
+
+
+async def wait_for_broker (brokers, port: int, limit: float) -> float:
+    """
+    Wait until the monitor chose the broker on the given port.
+
+    :return: the time in seconds it took.
+    :raises AssertionError: if it took longer than the limit.
+    """
+    start = time.monotonic ()
+    while brokers.current.port != port:
+        elapsed = time.monotonic () - start
+        assert elapsed < limit, 'broker on port {} not chosen after {:.1f} s'.format (port, elapsed)
+        await asyncio.sleep (0.05)
+    return time.monotonic () - start
+
+
+async def run (latency: float, port_preferred: int, storage: str) -> None:
+    port_backup = port_preferred + 1
+    config_path = os.path.join (storage, 'Sensor_Node.ini')
+    with open (config_path, 'w') as fd:
+        fd.write (CONFIGURATION.format (
+            port_preferred=port_preferred, port_backup=port_backup, storage=storage, probe_period=PROBE_PERIOD))
+    os.environ ['SENSOR_NODE_CONFIG'] = config_path
+    # the configuration is read when module brokers is imported
+    import brokers
+
+    def switch (_broker):
+        # the public client would connect to the new broker
+        brokers.connection_up ()
+
+    preferred = mqtt_standin.StandIn (port_preferred, latency)
+    backup = mqtt_standin.StandIn (port_backup, latency)
+    await preferred.start ()
+    await backup.start ()
+    brokers.init_brokers (['127.0.0.1:{}'.format (port_preferred), '127.0.0.1:{}'.format (port_backup)])
+    brokers.connection_up ()
+    monitor = asyncio.get_event_loop ().create_task (brokers.monitor (switch))
+    try:
+        await asyncio.sleep (PROBE_PERIOD + 2 * latency + MARGIN)
+        assert brokers.current.port == port_preferred, 'preferred broker not chosen at start'
+        preferred.paused = True
+        # the probe period, then a failed probe and a failed probe after the disconnected probe period
+        limit = PROBE_PERIOD + brokers.MAX_FAILURES * brokers.PROBE_TIMEOUT \
+            + (brokers.MAX_FAILURES - 1) * brokers.DISCONNECTED_PROBE_PERIOD + MARGIN
+        failover = await wait_for_broker (brokers, port_backup, limit)
+        print ('failover after {:.1f} s, limit {:.1f} s'.format (failover, limit))
+        preferred.paused = False
+        limit = PROBE_PERIOD + 2 * latency + MARGIN
+        failback = await wait_for_broker (brokers, port_preferred, limit)
+        print ('failback after {:.1f} s, limit {:.1f} s'.format (failback, limit))
+        print (brokers.statistics ())
+    finally:
+        monitor.cancel ()
+        await asyncio.gather (monitor, return_exceptions=True)
+        await preferred.stop ()
+        await backup.stop ()
+
+
+def main ():
+    latency = float (sys.argv [1]) / 1000 if len (sys.argv) > 1 else 0.0
+    port = int (sys.argv [2]) if len (sys.argv) > 2 else 18831
+    with tempfile.TemporaryDirectory () as storage:
+        asyncio.run (run (latency, port, storage))
+
+
+if __name__ == '__main__':
+    main ()
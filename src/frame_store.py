@@ -0,0 +1,264 @@
+"""Keeps an index of the camera frames stored in the backup pen.
+
+Frames captured by the camera are written to the images folder with the
+configured file template.  This module keeps an in-memory index of these
+frames, ordered by capture time, that is rebuilt at startup from the file
+names in the images folder.  Whenever a frame is added, the oldest frames are
+removed until the images folder fits in the configured disk quota.
+
+Frames are published on the image topic in chunks.  Each chunk starts with a
+header containing the frame number, the chunk sequence number and the number
+of chunks in the frame.
+
+Command Functions
+-----------------
+
+command_get_all_frames
+    Sends all stored frames, optionally restricted to a time interval.
+
+command_get_next_frame
+    Moves the cursor to the next stored frame and sends it.
+
+command_get_previous_frame
+    Moves the cursor to the previous stored frame and sends it.
+
+command_delete_frames
+    Deletes all stored frames.
+"""
+
+import bisect
+import collections
+import datetime
+import os
+import re
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import configuration
+
+FrameEntry = collections.namedtuple ('FrameEntry', ['timestamp', 'iteration', 'path', 'size'])
+
+FRAME_CHUNK_SIZE = 4096
+"""Maximum number of JPEG bytes in each message published on the image topic."""
+
+FRAME_CHUNK_HEADER = struct.Struct ('>IHH')
+"""Header of each frame chunk: frame number, chunk sequence number and number of chunks."""
+
+FRAME_SEND_TIMEOUT = 10.0
+"""Time in seconds after which we give up waiting for the chunks of a frame to be acknowledged."""
+
+FRAME_FILE_PATTERN = re.compile (r'Frame_(\d+)_\d+_(\d{4}_\d\d_\d\d__\d\d_\d\d_\d\d)\.jpg$')
+
+frames = []  # type: list
+"""Stored frames sorted by capture time."""
+timestamps = []  # type: list
+"""Capture time of each stored frame, used to search frames by time."""
+total_size = 0
+"""Number of bytes used by the stored frames."""
+cursor = -1
+"""Index of the last frame sent with the next and previous frame commands."""
+mutex = threading.Lock ()
+
+frame_number = 0
+publish_mutex = threading.Lock ()
+
+
+def init_frame_store () -> None:
+    """Rebuilds the frame index from the file names in the images folder."""
+    global frames, timestamps, total_size, cursor
+
+    entries = []
+    if os.path.isdir (configuration.IMAGES_FOLDER):
+        with os.scandir (configuration.IMAGES_FOLDER) as it:
+            for a_file in it:
+                match = FRAME_FILE_PATTERN.search (a_file.name)
+                if match is None or not a_file.is_file ():
+                    continue
+                try:
+                    timestamp = datetime.datetime.strptime (match.group (2), '%Y_%m_%d__%H_%M_%S').timestamp ()
+                except ValueError:
+                    timestamp = a_file.stat ().st_mtime
+                entries.append (FrameEntry (timestamp, int (match.group (1)), a_file.path, a_file.stat ().st_size))
+    entries.sort ()
+    with mutex:
+        frames = entries
+        timestamps = [e.timestamp for e in entries]
+        total_size = sum (e.size for e in entries)
+        cursor = -1
+        evict_frames ()
+    print ('Frame store has {} frames using {} bytes.'.format (len (frames), total_size))
+
+
+def add_frame (iteration: int, timestamp: float, path: str) -> None:
+    """Adds a frame written by the camera to the index and enforces the disk quota.
+
+    :param iteration: the iteration in which the frame was captured.
+    :param timestamp: the capture time.
+    :param path: the frame file name.
+    """
+    global total_size
+    try:
+        size = os.path.getsize (path)
+    except OSError:
+        return
+    with mutex:
+        index = bisect.bisect_right (timestamps, timestamp)
+        frames.insert (index, FrameEntry (timestamp, iteration, path, size))
+        timestamps.insert (index, timestamp)
+        total_size += size
+        evict_frames ()
+
+
+def evict_frames () -> None:
+    """Deletes the oldest frames until the stored frames fit in the disk quota.
+
+    Must be called with the mutex held.
+    """
+    global total_size, cursor
+    number_evicted = 0
+    while number_evicted < len (frames) and total_size > configuration.FRAMES_QUOTA:
+        entry = frames [number_evicted]
+        try:
+            os.remove (entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print ('Could not delete frame {}: {}'.format (entry.path, e))
+            break
+        total_size -= entry.size
+        number_evicted += 1
+    if number_evicted > 0:
+        del frames [:number_evicted]
+        del timestamps [:number_evicted]
+        cursor = max (-1, cursor - number_evicted)
+
+
+def publish_frame (mqtt_client: mqtt.Client, data) -> float:
+    """
+    Publishes a frame on the image topic in chunks and waits for them to be acknowledged.
+
+    :param mqtt_client: the mqtt client where the frame is published.
+    :param data: the JPEG bytes.
+    :return: the time in seconds taken to deliver the frame, or ``None`` if
+        the chunks were not acknowledged in time.
+    """
+    global frame_number
+    with publish_mutex:
+        frame_number = (frame_number + 1) % 0x100000000
+        number = frame_number
+    view = memoryview (data)
+    number_chunks = (len (view) + FRAME_CHUNK_SIZE - 1) // FRAME_CHUNK_SIZE
+    time_start = time.monotonic ()
+    messages = []
+    for sequence in range (number_chunks):
+        payload = FRAME_CHUNK_HEADER.pack (number, sequence, number_chunks) + \
+            view [sequence * FRAME_CHUNK_SIZE:(sequence + 1) * FRAME_CHUNK_SIZE]
+        messages.append (mqtt_client.publish (configuration.TOPIC_IMAGE_DATA, payload, qos=1))
+    while not all (m.is_published () for m in messages):
+        if time.monotonic () - time_start > FRAME_SEND_TIMEOUT:
+            mqtt_client.publish (configuration.TOPIC_LOG, 'frame {} not acknowledged'.format (number), qos=2)
+            return None
+        time.sleep (0.02)
+    elapsed = max (time.monotonic () - time_start, 0.001)
+    print ('Frame {} sent: {} bytes in {} chunks, {:.2f}s'.format (number, len (view), number_chunks, elapsed))
+    return elapsed
+
+
+def send_stored_frame (mqtt_client: mqtt.Client, entry: FrameEntry) -> None:
+    try:
+        with open (entry.path, 'rb') as fd:
+            data = fd.read ()
+    except FileNotFoundError:
+        print ('Frame {} has been deleted!'.format (entry.path))
+        return
+    mqtt_client.publish (
+        configuration.TOPIC_LOG,
+        'sending frame {} {}'.format (
+            os.path.basename (entry.path),
+            datetime.datetime.fromtimestamp (entry.timestamp).isoformat (timespec='seconds')),
+        qos=2)
+    publish_frame (mqtt_client, data)
+
+
+def thread_send_frames_run (mqtt_client: mqtt.Client, selected) -> None:
+    for entry in selected:
+        send_stored_frame (mqtt_client, entry)
+    mqtt_client.publish (configuration.TOPIC_LOG, 'all frames sent', qos=2)
+
+
+def command_get_all_frames (mqtt_client: mqtt.Client, *interval) -> None:
+    """
+    Sends all stored frames, or the frames captured between the given unix timestamps.
+
+    :param mqtt_client: mqtt client where frames are published.
+    :param interval: optional start and end timestamps.
+    """
+    mqtt_client.publish (configuration.TOPIC_LOG, 'received get all frames', qos=2)
+    try:
+        time_from = float (interval [0]) if len (interval) > 0 else float ('-inf')
+        time_to = float (interval [1]) if len (interval) > 1 else float ('inf')
+    except ValueError:
+        mqtt_client.publish (configuration.TOPIC_LOG, 'invalid arguments to get all frames', qos=2)
+        return
+    with mutex:
+        selected = frames [bisect.bisect_left (timestamps, time_from):bisect.bisect_right (timestamps, time_to)]
+    threading.Thread (
+        target=thread_send_frames_run,
+        args=(mqtt_client, selected),
+    ).start ()
+
+
+def move_cursor (mqtt_client: mqtt.Client, step: int) -> None:
+    global cursor
+    with mutex:
+        if len (frames) == 0:
+            entry = None
+        else:
+            cursor = max (0, min (cursor + step, len (frames) - 1))
+            entry = frames [cursor]
+    if entry is None:
+        mqtt_client.publish (configuration.TOPIC_LOG, 'no frames stored', qos=2)
+    else:
+        threading.Thread (
+            target=send_stored_frame,
+            args=(mqtt_client, entry),
+        ).start ()
+
+
+def command_get_next_frame (mqtt_client: mqtt.Client) -> None:
+    """Sends the frame after the one sent previously.
+
+    :param mqtt_client: mqtt client where frames are published.
+    """
+    move_cursor (mqtt_client, 1)
+
+
+def command_get_previous_frame (mqtt_client: mqtt.Client) -> None:
+    """Sends the frame before the one sent previously.
+
+    :param mqtt_client: mqtt client where frames are published.
+    """
+    move_cursor (mqtt_client, -1)
+
+
+def command_delete_frames (mqtt_client: mqtt.Client) -> None:
+    """Deletes all stored frames.
+
+    :param mqtt_client: mqtt client where log messages are published.
+    """
+    global frames, timestamps, total_size, cursor
+    mqtt_client.publish (configuration.TOPIC_LOG, 'received delete frames', qos=2)
+    with mutex:
+        for entry in frames:
+            try:
+                os.remove (entry.path)
+            except OSError:
+                pass
+        frames = []
+        timestamps = []
+        total_size = 0
+        cursor = -1
+    mqtt_client.publish (configuration.TOPIC_LOG, 'frames deleted', qos=2)
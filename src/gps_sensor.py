@@ -1,55 +1,239 @@
 import adafruit_gps
-import board
-import busio
+import collections
+import math
+import threading
+from adafruit_bus_device.i2c_device import I2CDevice
 
 from threading import Thread
-from time import sleep
+from time import monotonic, sleep
+
+import configuration
+import i2c_bus
+import nmea
 
 
 gps = None
 stop_update_gps_thread = False
+update_thread = None  # type: threading.Thread
+last_read_time = 0.0
+"""Monotonic clock time at which the update thread last read the GPS sensor without error."""
+
+gps_i2c = None
+parser = None  # type: nmea.NmeaParser
+
+Fix = collections.namedtuple ('Fix', ['time', 'latitude', 'longitude', 'gps_error', 'speed'])
+
+fixes = collections.deque (maxlen=32)
+"""The most recent GPS fixes stamped with the monotonic clock time at which they were read."""
+fixes_lock = threading.Lock ()
+
+UPDATE_PERIOD = 0.05
+"""Time in seconds between polls of the GPS sensor for new sentences."""
+
+FIX_TIMEOUT = 10.0
+"""Age in seconds after which the last fix is considered lost."""
+
+MAX_EXTRAPOLATION = 2.0
+"""Maximum time in seconds that a position is extrapolated past the last fix."""
+
+EARTH_RADIUS = 6371000.0
+
+KNOTS_TO_MS = 0.514444
+
+HEALTH_TIMEOUT = 10.0
+"""Time in seconds without a successful read after which the GPS sensor is unhealthy."""
+
+RESTART_JOIN_TIMEOUT = 2.0
+
+GPS_I2C_ADDRESS = 0x10
+
+I2C_PRIORITY = 2
+"""Priority of the GPS transactions on the I2C bus, see module i2c_bus."""
+
+STREAM_READ_SIZE = 64
+"""Number of bytes read from the GPS sensor in each I2C transaction when streaming."""
+
+TASK_PERIOD = 1
+"""Period of the scheduler task that reads the position, in acquisition periods."""
+TASK_BUDGET = 0.005
+"""Time in seconds the scheduler task is expected to take."""
+TASK_FIELDS = ['latitude', 'longitude', 'gps_error', 'gps_fix_age', 'gps_speed']
+"""Sample fields set from the values returned by get_values."""
 
 
 # noinspection SpellCheckingInspection
 def init_gps ():
-    global gps
+    """
+    Initialise the GPS sensor.
+    With a fix rate of 1 Hz, sentences are parsed by the adafruit_gps module.  With higher fix rates, sentences are
+    read in bulk from the I2C bus and parsed by the incremental NMEA parser.
+    """
+    global gps, gps_i2c, parser, update_thread, last_read_time
 
-    i2c = busio.I2C (board.SCL, board.SDA)
+    last_read_time = monotonic ()
+    gps_i2c = i2c_bus.client ('gps', I2C_PRIORITY)
     # Create a GPS module instance.
-    gps = adafruit_gps.GPS_GtopI2C (i2c, debug=False)
+    gps = adafruit_gps.GPS_GtopI2C (gps_i2c, debug=False, address=GPS_I2C_ADDRESS)
     gps.send_command (b'PMTK314,0,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0')
+    if configuration.GPS_RATE > 1:
+        gps.send_command ('PMTK220,{}'.format (1000 // configuration.GPS_RATE).encode ())
+        parser = nmea.NmeaParser ()
+        update_thread = Thread (target=thread_stream_gps_run, daemon=True)
+        update_thread.start ()
+        return
     gps.send_command (b'PMTK220,1000')
     gps.update ()
     for _ in range (3):
         sleep (0.5)
         gps.update ()
-    Thread (target=thread_update_gps_run).start ()
+    update_thread = Thread (target=thread_update_gps_run, daemon=True)
+    update_thread.start ()
 
 
 # noinspection PyUnresolvedReferences
 def thread_update_gps_run ():
+    """
+    Read the sentences sent by the GPS sensor and store a new fix whenever the sensor reports a new fix time.
+    """
+    global last_read_time
+
+    last_fix_time = None
     while not stop_update_gps_thread:
-        gps.update ()
-        sleep (0.5)
+        while gps.update ():
+            pass
+        last_read_time = monotonic ()
+        if gps.has_fix and gps.timestamp_utc is not None and gps.timestamp_utc != last_fix_time:
+            last_fix_time = gps.timestamp_utc
+            speed = gps.speed_knots
+            with fixes_lock:
+                fixes.append (Fix (
+                    monotonic (),
+                    gps.latitude,
+                    gps.longitude,
+                    gps.horizontal_dilution,
+                    speed * KNOTS_TO_MS if speed is not None else None,
+                ))
+        sleep (UPDATE_PERIOD)
 
 
-# noinspection PyUnresolvedReferences
-def get_values ():
+def thread_stream_gps_run ():
+    """
+    Read the byte stream sent by the GPS sensor into the NMEA parser and store a new fix for each valid RMC sentence.
+    The GPS error comes from the most recent GGA sentence.
+    """
+    global last_read_time
+
+    device = I2CDevice (gps_i2c, GPS_I2C_ADDRESS)
+    gps_error = None
+    idle_period = 1 / (4 * configuration.GPS_RATE)
+    while not stop_update_gps_thread:
+        buffer = parser.receive_buffer (STREAM_READ_SIZE)
+        try:
+            with device as i2c:
+                i2c.readinto (buffer)
+        except OSError:
+            sleep (idle_period)
+            continue
+        now = monotonic ()
+        last_read_time = now
+        # the sensor sends 0x0A filler bytes when it has nothing to send
+        idle = buffer [-1] == 0x0A
+        for fields in parser.commit (STREAM_READ_SIZE):
+            try:
+                if fields [0] == 'GGA' and fields [8] != '':
+                    gps_error = float (fields [8])
+                elif fields [0] == 'RMC' and fields [2] == 'A':
+                    with fixes_lock:
+                        fixes.append (Fix (
+                            now,
+                            nmea.parse_coordinate (fields [3], fields [4]),
+                            nmea.parse_coordinate (fields [5], fields [6]),
+                            gps_error,
+                            float (fields [7]) * KNOTS_TO_MS if fields [7] != '' else None,
+                        ))
+            except (IndexError, ValueError):
+                parser.sentences_dropped += 1
+        if idle:
+            sleep (idle_period)
+
+
+def is_healthy ():
+    """
+    Return whether the update thread is running and reading the GPS sensor.  A missing fix is not a failure.
+    """
+    return update_thread is not None and update_thread.is_alive () and monotonic () - last_read_time < HEALTH_TIMEOUT
+
+
+def restart ():
+    """
+    Stop the update thread and initialise the GPS sensor again.
+
+    :raises RuntimeError: if the update thread is stuck.
+    """
+    global stop_update_gps_thread
+
+    stop_update_gps_thread = True
+    if update_thread is not None:
+        update_thread.join (RESTART_JOIN_TIMEOUT)
+        if update_thread.is_alive ():
+            raise RuntimeError ('GPS update thread did not stop')
+    stop_update_gps_thread = False
+    init_gps ()
+
+
+def parser_statistics ():
+    """
+    Return the counters of the NMEA parser, or None if the GPS sentences are parsed by the adafruit_gps module.
+    """
+    return parser.statistics () if parser is not None else None
+
+
+def distance (fix_a: Fix, fix_b: Fix):
+    """
+    Return the distance in metres between two fixes, using the equirectangular approximation.
+    """
+    x = math.radians (fix_b.longitude - fix_a.longitude) * math.cos (math.radians (fix_a.latitude + fix_b.latitude) / 2)
+    y = math.radians (fix_b.latitude - fix_a.latitude)
+    return EARTH_RADIUS * math.hypot (x, y)
+
+
+def get_values (sample_time=None):
     """
-    Return a tuple with the GPS readings.
-    The first two arguments contain the latitude and longitude, and the third argument contains the GPS error.
-    If the GPS sensor doesn't have a reading, we return the tuple (-1, -1, -1).  Sometimes, the sensor cannot compute
-    the GPS error, and this case, we return -1 as the third argument of the tuple.
+    Return a tuple with the GPS readings at the given monotonic clock time.
+    The first two arguments contain the latitude and longitude, the third argument contains the GPS error, the fourth
+    argument contains the age in seconds of the most recent fix at the sample time and the fifth argument contains the
+    speed in metres per second.
+    The position is interpolated between the two fixes around the sample time, or extrapolated from the last two fixes
+    for at most MAX_EXTRAPOLATION seconds.
+    If the GPS sensor doesn't have a reading, we return the tuple (-1, -1, -1, -1, -1).  Sometimes, the sensor cannot
+    compute the GPS error, and this case, we return None as the third argument of the tuple.
+    :param sample_time: the monotonic clock time of the sample, by default the current time.
     :return: a tuple with the GPS readings.
     """
-    if gps.has_fix:
-        latitude_ = gps.latitude
-        longitude_ = gps.longitude
-        gps_error_ = gps.horizontal_dilution
-        # if gps_error_ is None:
-        #     gps_error_ = -1
+    if sample_time is None:
+        sample_time = monotonic ()
+    with fixes_lock:
+        history = list (fixes)
+    if len (history) == 0 or sample_time - history [-1].time > FIX_TIMEOUT:
+        return -1, -1, -1, -1, -1
+    last = history [-1]
+    age = max (0.0, sample_time - last.time)
+    if len (history) == 1:
+        return last.latitude, last.longitude, last.gps_error, age, last.speed if last.speed is not None else -1
+    if sample_time >= last.time:
+        before, after = history [-2], last
     else:
-        latitude_ = -1
-        longitude_ = -1
-        gps_error_ = -1
-    return latitude_, longitude_, gps_error_
+        index = len (history) - 1
+        while index > 1 and history [index - 1].time > sample_time:
+            index -= 1
+        before, after = history [index - 1], history [index]
+        age = max (0.0, sample_time - before.time)
+    interval = after.time - before.time
+    if interval <= 0:
+        return after.latitude, after.longitude, after.gps_error, age, after.speed if after.speed is not None else -1
+    ratio = (min (sample_time, after.time + MAX_EXTRAPOLATION) - before.time) / interval
+    ratio = max (0.0, ratio)
+    latitude_ = before.latitude + (after.latitude - before.latitude) * ratio
+    longitude_ = before.longitude + (after.longitude - before.longitude) * ratio
+    speed_ = after.speed if after.speed is not None else distance (before, after) / interval
+    return latitude_, longitude_, after.gps_error, age, speed_
@@ -1,11 +1,114 @@
-import board
-import busio
-import serial
+"""
+This module reads the Honeywell PM sensor (HPMA115C0) connected to the UART.
+
+The sensor runs in auto-send mode, sending a 32 byte frame every second.  A background thread feeds the bytes read from
+the UART to a state machine that synchronises on the frame header and validates the checksum incrementally.  The latest
+valid sample is kept with its timestamp, so get_values never blocks on the UART.
+"""
+import threading
 import time
-import struct
+
+import backends
 
 uart = None
 
+FRAME_HEAD_1 = 0x42
+FRAME_HEAD_2 = 0x4D
+FRAME_LENGTH = 28
+"""Number of bytes in a frame after the header and length fields."""
+
+SAMPLE_TIMEOUT = 5.0
+"""Age in seconds after which the latest sample is considered stale."""
+
+RESTART_TIMEOUT = 30.0
+"""Time in seconds without a valid frame after which the sensor is sent the start commands again."""
+
+HEALTH_TIMEOUT = 60.0
+"""Time in seconds without a valid frame after which the sensor is unhealthy and the UART is opened again."""
+
+RESTART_JOIN_TIMEOUT = 2.0
+
+latest_sample = (-1, -1, -1, -1)
+latest_sample_time = None
+"""Monotonic clock time at which the latest valid sample was received."""
+
+number_frames = 0
+number_checksum_errors = 0
+number_restarts = 0
+
+stop_read_thread = False
+read_thread = None  # type: threading.Thread
+start_time = 0.0
+"""Monotonic clock time at which the read thread was started."""
+
+TASK_PERIOD = 1
+"""Period of the scheduler task that reads the latest sample, in acquisition periods."""
+TASK_BUDGET = 0.005
+"""Time in seconds the scheduler task is expected to take."""
+TASK_FIELDS = ['pm1_honeywell', 'pm25_honeywell', 'pm4_honeywell', 'pm10_honeywell']
+"""Sample fields set from the values returned by get_values."""
+
+
+class FrameParser:
+    """
+    State machine that extracts auto-send frames from the byte stream sent by the sensor.
+    """
+    WAIT_HEAD_1, WAIT_HEAD_2, WAIT_LENGTH_HIGH, WAIT_LENGTH_LOW, DATA = range (5)
+
+    def __init__ (self):
+        self.state = FrameParser.WAIT_HEAD_1
+        self.data = bytearray (FRAME_LENGTH)
+        self.index = 0
+        self.checksum = 0
+
+    def feed (self, chunk):
+        """
+        Process the bytes read from the UART.
+        :return: a list with the (pm1, pm2.5, pm4, pm10) values of each valid frame found.
+        """
+        global number_frames, number_checksum_errors
+
+        result = []
+        for a_byte in chunk:
+            state = self.state
+            if state == FrameParser.DATA:
+                if self.index < FRAME_LENGTH - 2:
+                    self.checksum += a_byte
+                self.data [self.index] = a_byte
+                self.index += 1
+                if self.index == FRAME_LENGTH:
+                    data = self.data
+                    # the last two bytes hold the sum of all the previous bytes in the frame
+                    if self.checksum & 0xFFFF == (data [-2] << 8) | data [-1]:
+                        number_frames += 1
+                        result.append ((
+                            (data [0] << 8) | data [1],
+                            (data [2] << 8) | data [3],
+                            (data [4] << 8) | data [5],
+                            (data [6] << 8) | data [7],
+                        ))
+                    else:
+                        number_checksum_errors += 1
+                    self.state = FrameParser.WAIT_HEAD_1
+            elif state == FrameParser.WAIT_HEAD_1:
+                if a_byte == FRAME_HEAD_1:
+                    self.state = FrameParser.WAIT_HEAD_2
+            elif state == FrameParser.WAIT_HEAD_2:
+                if a_byte == FRAME_HEAD_2:
+                    self.state = FrameParser.WAIT_LENGTH_HIGH
+                elif a_byte != FRAME_HEAD_1:
+                    self.state = FrameParser.WAIT_HEAD_1
+            elif state == FrameParser.WAIT_LENGTH_HIGH:
+                self.state = FrameParser.WAIT_LENGTH_LOW if a_byte == 0 else FrameParser.WAIT_HEAD_1
+            elif state == FrameParser.WAIT_LENGTH_LOW:
+                if a_byte == FRAME_LENGTH:
+                    self.checksum = FRAME_HEAD_1 + FRAME_HEAD_2 + FRAME_LENGTH
+                    self.index = 0
+                    self.state = FrameParser.DATA
+                else:
+                    self.state = FrameParser.WAIT_HEAD_1
+        return result
+
 
 def comm (command, reply_length):
     rcv = None
@@ -19,51 +122,90 @@ def comm (command, reply_length):
         pass
 
 
-def calc_cs (data):
-    total = 0
-    for j in range (12):
-        total = total + data [j]
-    cs = (65536 - total) % 256
-    return cs
-
-
 def init_sensor ():
-    global uart
+    global uart, read_thread, start_time
+
+    uart = backends.open_uart ('honeywell', '/dev/ttyAMA0', 9600, 0.2)
+    start_sensor ()
+    start_time = time.monotonic ()
+    read_thread = threading.Thread (target=thread_read_run, daemon=True)
+    read_thread.start ()
 
-    uart = serial.Serial ("/dev/ttyAMA0", baudrate=9600, timeout=0.2)
-    uart.read (100)
 
-    # stop auto send
-    print (comm ('68012077', 2))
+def start_sensor ():
+    uart.reset_input_buffer ()
 
     # starting particle measurement
     print (comm ('68010196', 2))
 
+    # enable auto send
+    print (comm ('68014057', 2))
+
+
+def thread_read_run ():
+    global latest_sample, latest_sample_time, number_restarts
+
+    parser = FrameParser ()
+    last_frame_time = time.monotonic ()
+    while not stop_read_thread:
+        try:
+            chunk = uart.read (max (1, uart.in_waiting))
+        except OSError as e:
+            print ('Honeywell sensor: {}'.format (e))
+            chunk = b''
+            time.sleep (1)
+        now = time.monotonic ()
+        for sample in parser.feed (chunk):
+            latest_sample = sample
+            latest_sample_time = now
+            last_frame_time = now
+        if now - last_frame_time > RESTART_TIMEOUT:
+            number_restarts += 1
+            print ('No frames from Honeywell sensor, restarting it')
+            start_sensor ()
+            last_frame_time = now
+
+
+def is_healthy ():
+    """
+    Return whether the read thread is running and received a valid frame in the last HEALTH_TIMEOUT seconds.
+    """
+    last_time = latest_sample_time if latest_sample_time is not None else start_time
+    return read_thread is not None and read_thread.is_alive () and time.monotonic () - last_time < HEALTH_TIMEOUT
+
+
+def restart ():
+    """
+    Stop the read thread, close the UART and initialise the sensor again.
+
+    :raises RuntimeError: if the read thread is stuck.
+    """
+    global stop_read_thread
+
+    stop_read_thread = True
+    if read_thread is not None:
+        read_thread.join (RESTART_JOIN_TIMEOUT)
+        if read_thread.is_alive ():
+            raise RuntimeError ('Honeywell read thread did not stop')
+    stop_read_thread = False
+    if uart is not None:
+        uart.close ()
+    init_sensor ()
 
-def get_values (debug=True):
-    if uart is None:
-        init_sensor ()
-        return -1, -1, -1, -1
-
-    output = comm ('68010493', 16)
-
-    if output is None or len (output) < 16:
-        init_sensor ()
-        return -1, -1, -1, -1
 
-    pm1 = output [3] * 256 + output [4]
-    pm25 = output [5] * 256 + output [6]
-    pm4 = output [7] * 256 + output [8]
-    pm10 = output [9] * 256 + output [10]
-    cs = output [14] * 256 + output [15]
-
-    if cs != calc_cs (output):
-        pm1 = pm25 = pm4 = pm10 = -1
-        init_sensor ()
+def get_values (debug=True):
+    """
+    Return the latest sample read from the sensor.
+    :return: a tuple with the PM1, PM2.5, PM4 and PM10 values.  If there is no sample newer than SAMPLE_TIMEOUT
+    seconds, we return the tuple (-1, -1, -1, -1).
+    """
+    sample_time = latest_sample_time
+    if sample_time is None or time.monotonic () - sample_time > SAMPLE_TIMEOUT:
+        result = (-1, -1, -1, -1)
+    else:
+        result = latest_sample
 
     if debug:
-        print (' '.join ([hex (b) for b in output]) + "\n")
-        print ('CS ' + str (cs) + "  " + str (calc_cs (output)))
-        print (str (pm1) + " " + str (pm25) + " " + str (pm4) + " " + str (pm10))
+        print ('{} {} {} {}, {} frames, {} checksum errors'.format (*result, number_frames, number_checksum_errors))
 
-    return pm1, pm25, pm4, pm10
+    return result
@@ -0,0 +1,183 @@
+"""
+Owns the I2C bus shared by the GPS, the accelerometer, the ADC and the temperature, humidity and pressure sensors, and
+serialises their transactions.
+
+Each sensor module gets a client from function client, which it passes to the Adafruit drivers instead of a busio.I2C
+object.  A transaction starts when a driver locks the client and ends when it unlocks it.  When the bus is busy, the
+threads waiting for it are served by priority, lower values first, and in arrival order within the same priority.  A
+driver that cannot lock the bus within ACQUIRE_TIMEOUT seconds retries, as it does with a busio.I2C object.
+
+Each transaction is counted against the device whose address it used, with the time spent waiting for the bus, the
+time the bus was held and whether a transfer raised an error.
+"""
+import heapq
+import itertools
+import threading
+import time
+from typing import Optional
+
+import backends
+
+ACQUIRE_TIMEOUT = 1.0
+"""Time in seconds a driver waits for the bus before try_lock returns False."""
+
+DEVICE_NAMES = {
+    0x10: 'gps',
+    0x26: 'msa301',
+    0x48: 'ads1115',
+    0x5D: 'lps25',
+    0x70: 'shtc3',
+}
+"""Names of the devices on the bus indexed by address."""
+
+
+class Device:
+    __slots__ = (
+        'name', 'number_transactions', 'number_errors', 'total_time', 'max_time', 'total_wait', 'max_wait',
+    )
+
+    def __init__ (self, name):
+        self.name = name
+        self.number_transactions = 0
+        self.number_errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class Client:
+    """
+    Stands in for busio.I2C in the drivers of a sensor module.
+    """
+    def __init__ (self, name: str, priority: int):
+        self.name = name
+        self.priority = priority
+        self.wait_time = 0.0
+        self.lock_time = 0.0
+        self.address = None  # type: Optional[int]
+        """Address used by the current transaction."""
+        self.failed = False
+
+    def try_lock (self) -> bool:
+        return acquire (self)
+
+    def unlock (self) -> None:
+        release (self)
+
+    def scan (self):
+        return bus.scan ()
+
+    def readfrom_into (self, address, buffer, **kwargs):
+        self.transfer (address, bus.readfrom_into, address, buffer, **kwargs)
+
+    def writeto (self, address, buffer, **kwargs):
+        self.transfer (address, bus.writeto, address, buffer, **kwargs)
+
+    def writeto_then_readfrom (self, address, buffer_out, buffer_in, **kwargs):
+        self.transfer (address, bus.writeto_then_readfrom, address, buffer_out, buffer_in, **kwargs)
+
+    def transfer (self, address, function, *args, **kwargs):
+        self.address = address
+        try:
+            function (*args, **kwargs)
+        except OSError:
+            self.failed = True
+            raise
+
+    def deinit (self):
+        """
+        The bus is shared, so it is not closed.
+        """
+        pass
+
+
+bus = None  # type: busio.I2C
+clients = {}
+"""The clients indexed by name."""
+devices = {}
+"""The devices that were used indexed by address."""
+
+condition = threading.Condition ()
+owner = None  # type: Optional[Client]
+waiting = []
+"""Heap with the priority and arrival number of the threads waiting for the bus."""
+tickets = itertools.count ()
+number_timeouts = 0
+"""Number of times a driver did not get the bus within ACQUIRE_TIMEOUT seconds."""
+
+
+def init_bus ():
+    global bus
+    bus = backends.open_i2c (DEVICE_NAMES)
+
+
+def client (name: str, priority: int) -> Client:
+    """
+    Return the client of a sensor module, created on the first call, to be passed to its drivers.
+
+    :param name: the name of the sensor module.
+    :param priority: the priority of its transactions, lower values are served first.
+    """
+    result = clients.get (name)
+    if result is None:
+        result = Client (name, priority)
+        clients [name] = result
+    return result
+
+
+def acquire (a_client: Client) -> bool:
+    global owner, number_timeouts
+    start = time.perf_counter ()
+    with condition:
+        ticket = (a_client.priority, next (tickets))
+        heapq.heappush (waiting, ticket)
+        if not condition.wait_for (lambda: owner is None and waiting [0] == ticket, ACQUIRE_TIMEOUT):
+            waiting.remove (ticket)
+            heapq.heapify (waiting)
+            number_timeouts += 1
+            # the next waiter may be the first one now
+            condition.notify_all ()
+            return False
+        heapq.heappop (waiting)
+        owner = a_client
+    now = time.perf_counter ()
+    a_client.wait_time = now - start
+    a_client.lock_time = now
+    a_client.address = None
+    a_client.failed = False
+    return True
+
+
+def release (a_client: Client) -> None:
+    global owner
+    if owner is not a_client:
+        return
+    if a_client.address is not None:
+        elapsed = time.perf_counter () - a_client.lock_time
+        device = devices.get (a_client.address)
+        if device is None:
+            device = Device (DEVICE_NAMES.get (a_client.address, '0x{:02X}'.format (a_client.address)))
+            devices [a_client.address] = device
+        device.number_transactions += 1
+        device.number_errors += a_client.failed
+        device.total_time += elapsed
+        device.max_time = max (device.max_time, elapsed)
+        device.total_wait += a_client.wait_time
+        device.max_wait = max (device.max_wait, a_client.wait_time)
+    with condition:
+        owner = None
+        condition.notify_all ()
+
+
+def statistics ():
+    """
+    :return: a list with a tuple per device containing its name, number of transactions and failed transactions, mean
+    and maximum transaction duration in seconds, and mean and maximum wait for the bus in seconds.
+    """
+    return [
+        (device.name, device.number_transactions, device.number_errors,
+         device.total_time / device.number_transactions if device.number_transactions > 0 else 0.0, device.max_time,
+         device.total_wait / device.number_transactions if device.number_transactions > 0 else 0.0, device.max_wait)
+        for device in list (devices.values ())
+    ]
@@ -12,6 +12,10 @@ new entry is added to the current log file.
 Log files have a limit on the number of entries, which is stored in the
 configuration file.  Function start_log_csv creates a new log file.
 
+Errors writing the log file, for instance when the backup pen is removed, are
+counted and make the logger unhealthy.  The supervisor then calls function
+restart_log, which starts a new log file.
+
 This module also provides functions that implement the commands that the
 sensor node can receive on the management mqtt topic.
 
@@ -26,10 +30,9 @@ Main Function
 -------------
 
 step_log_csv
-    The main function of this module receives the iteration number, current
-    timestamp, sensor data, current event, and current grabbed image name. If
-    logging is enabled, writes the above data in the current log file. If the
-    line limit has been reached, starts a new log file.
+    The main function of this module receives the current sample formatted
+    as a CSV row.  If logging is enabled, writes the row in the current log
+    file. If the line limit has been reached, starts a new log file.
 
 Command Functions
 -----------------
@@ -88,11 +91,11 @@ import subprocess
 
 import paho.mqtt.client as mqtt
 import threading
-from typing import Optional, Tuple
+from typing import Optional
 from typing.io import IO
 
 import configuration
-import pms_sensor_kalman
+import sample
 
 log_data = False  # type: bool
 """Whether logging is enabled or not."""
@@ -104,6 +107,9 @@ last_csv_open = None  # type: Optional[str]
 """The file name of the current log file."""
 mutex = threading.Semaphore ()
 # Mutex used when writing sensor data and manipulating corresponding log variables
+write_failed = False
+"""Whether the last write to the log file failed."""
+number_write_errors = 0
 
 uploading_logs = False
 """Whether we are currently uploading the log files or not."""
@@ -148,63 +154,48 @@ def finish_log () -> None:
     client_answered.release ()
 
 
-def step_log_csv (
-        iteration: int,
-        step_timestamp: float,
-        gps_data: Tuple,
-        pms_data: Tuple,
-        pm_honeywell_data: Tuple,
-        other_sensor_data: Tuple,
-        event: str,
-        image_file: str,
-        ip: str,
-        sampling_period: int,
-) -> None:
-    """Writes the current iteration, timestamp, event and grabbed image, and
-    sensor data to the log file.
+def step_log_csv (csv_row: str) -> None:
+    """Writes a sample to the log file.
 
     Starts a new log file if the maximum number of lines has been reached.
     Log files are written to the backup pen in the sensor node.
 
-    :param iteration: the current iteration counted from the start of the
-        program.
-    :param step_timestamp: the current time stamp.
-    :param gps_data: the gps data.
-    :param pms_data: the PM raw and filtered data.
-    :param pm_honeywell_data: the PM data gathered by the Honeywell sensor.
-    :param other_sensor_data: other sensor data (CO, NO2, temperature,
-       pressure, humidity and power voltage.
-    :param event: the current registered event.
-    :param image_file: the current grabbed image.
-    :param ip:
-    :param sampling_period: time between sampling the sensors (in seconds).
+    :param csv_row: the sample formatted by ``sample.format_sample``, with
+        the fields in the order of ``sample.CSV_HEADER``.
     """
-    global number_lines_log_file
-    if log_data and number_lines_log_file > 3600 * 4:
-        start_log_csv ()
-    mutex.acquire ()
+    global number_lines_log_file, number_write_errors, write_failed
+    try:
+        if log_data and number_lines_log_file > 3600 * 4:
+            start_log_csv ()
+        mutex.acquire ()
+        try:
+            if log_data and current_log_file is not None:
+                current_log_file.write (csv_row + '\n')
+                current_log_file.flush ()
+                number_lines_log_file += 1
+        finally:
+            mutex.release ()
+    except OSError as e:
+        number_write_errors += 1
+        if not write_failed:
+            print ('Failed to write the log file: {}'.format (e))
+        write_failed = True
+
+
+def is_healthy () -> bool:
+    """Returns whether the last write to the log file succeeded."""
+    return not write_failed
+
+
+def restart_log () -> None:
+    """Starts a new log file after a write error.
+
+    :raises OSError: if the log file cannot be created.
+    """
+    global write_failed
     if log_data:
-        gas_co_value_1, gas_co_value_2, gas_no2_value_1, gas_no2_value_2, \
-            temperature_value, pressure_value, humidity_value, \
-            power_supply_value, \
-            acceleration_value_1, acceleration_value_2, acceleration_value_3 = other_sensor_data
-        time = datetime.datetime.fromtimestamp (step_timestamp).isoformat (timespec='seconds')
-        fields = [
-                     iteration, time,
-                 ] + list (gps_data) + [
-                     gas_co_value_1, gas_co_value_2, gas_no2_value_1, gas_no2_value_2
-                 ] + list (pms_data) + [
-                     temperature_value, pressure_value, humidity_value, power_supply_value,
-                     pms_sensor_kalman.kp_base, pms_sensor_kalman.kd_base, event, image_file,
-                     acceleration_value_1, acceleration_value_2, acceleration_value_3
-                 ] + list (pm_honeywell_data)
-        fields = [str (s).replace ('.', ',') for s in fields]
-        fields = fields + [ip, str(sampling_period)]
-        line = ' '.join (fields)
-        current_log_file.write (line + '\n')
-        current_log_file.flush ()
-        number_lines_log_file += 1
-    mutex.release ()
+        start_log_csv ()
+    write_failed = False
 
 
 def thread_upload_logs_run (mqtt_client: mqtt.Client) -> None:
@@ -272,35 +263,30 @@ def start_log_csv () -> None:
 
     print ("creating log file ...")
     mutex.acquire ()
-    log_data = True
-    close_log_csv ()
-
-    initial_datetime = str (datetime.datetime.now ()) \
-        .replace (' ', '__') \
-        .split ('.')[0] \
-        .replace (':', '_') \
-        .replace ('-', '_')
-    csv_filename = '{}Node_{}_Remote_Log___{}.csv'.format (
-        configuration.LOGS_FOLDER, configuration.SENSOR_NODE_ID, initial_datetime)
-    current_log_file = open (csv_filename, 'w+')
-    description = 'Node_{}_Remote_Log___{}\n'.format (configuration.SENSOR_NODE_ID, initial_datetime)
-    current_log_file.write (description)
-    # noinspection SpellCheckingInspection
-    header = 'sample date_time ' \
-             'latitude longitude gps_error ' \
-             'co_1 co_2 no2_1 no2_2 ' \
-             'pm1_opc pm25_opc pm10_opc pm1_opc_filt pm2_opc_filt pm_10_opc_filt ' \
-             'temperature pressure humidity ' \
-             'power kp_base kd_base event image_file ' \
-             'acceleration_1 acceleration_2 acceleration_3 ' \
-             'pm1_honwell pm25_honwell pm4_honwell pm10_honwell ip sampling_period\n'
-    current_log_file.write (header)
-    last_csv_open = csv_filename
-    number_lines_log_file = 0
-    # update configuration
-    configuration.config['BASE']['current_csv'] = csv_filename
-    configuration.save_config ()
-    mutex.release ()
+    try:
+        log_data = True
+        close_log_csv ()
+
+        initial_datetime = str (datetime.datetime.now ()) \
+            .replace (' ', '__') \
+            .split ('.')[0] \
+            .replace (':', '_') \
+            .replace ('-', '_')
+        csv_filename = '{}Node_{}_Remote_Log___{}.csv'.format (
+            configuration.LOGS_FOLDER, configuration.SENSOR_NODE_ID, initial_datetime)
+        current_log_file = open (csv_filename, 'w+')
+        description = 'Node_{}_Remote_Log___{}\n'.format (configuration.SENSOR_NODE_ID, initial_datetime)
+        current_log_file.write (description)
+        # noinspection SpellCheckingInspection
+        header = sample.CSV_HEADER + '\n'
+        current_log_file.write (header)
+        last_csv_open = csv_filename
+        number_lines_log_file = 0
+        # update configuration
+        configuration.config['BASE']['current_csv'] = csv_filename
+        configuration.save_config ()
+    finally:
+        mutex.release ()
 
 
 def restart_log_csv (csv_filename: str) -> None:
@@ -327,8 +313,10 @@ def close_log_csv () -> None:
     """Closes the current log file."""
     global current_log_file
     if current_log_file is not None:
-        current_log_file.close ()
-        current_log_file = None
+        try:
+            current_log_file.close ()
+        finally:
+            current_log_file = None
 
 
 def command_delete_logs (mqtt_client: mqtt.Client) -> None:
@@ -1,31 +1,170 @@
+"""
+The two MQTT clients of the sensor node: the private client connects to the broker running in the sensor node and the
+public client connects to the ExpoLIS broker.
+
+The clients are driven by the asyncio event loop of the sensor node instead of the network thread of each client.  The
+socket callbacks of the paho client register its socket in the event loop, which calls loop_read and loop_write when
+the socket is ready.  Coroutine network_loop calls loop_misc to send keepalives, and reconnects with exponential backoff
+when the connection is lost.  The socket callbacks may be called from any thread that publishes or connects, in which
+case they schedule the registration in the event loop.
+
+The ExpoLIS broker is chosen from a list by the brokers module.  Coroutine broker_monitor runs the selection, and the
+network loop of the public client moves it to the chosen broker.
+"""
+import asyncio
+import threading
 from typing import Optional
 
 import paho.mqtt.client as mqtt
 
+import brokers
+import compression
 import configuration
 
 
 client_private = None  # type: Optional[mqtt.Client]
 client_public = None  # type: Optional[mqtt.Client]
 
+MISC_PERIOD = 1.0
+"""Time in seconds between calls to loop_misc, which sends keepalives and checks timeouts."""
+
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 120.0
+
+KEEPALIVE = 20
+"""Keepalive interval in seconds.  A connection that stopped answering is closed after one and a half intervals."""
+
+wake_events = {}
+"""Event of each client that interrupts the wait of its network loop."""
+pending_brokers = {}
+"""Broker to which the network loop of a client must move it."""
+
 debug = False
 
 
-def init_mqtt_interface (on_message):
+def init_mqtt_interface (on_message, loop: asyncio.AbstractEventLoop = None):
+    """
+    Create the MQTT clients.
+
+    :param on_message: callback invoked when a message is received.
+    :param loop: the event loop that drives the clients.  If None, each client starts its own network thread.
+    """
     global client_private, client_public
-    client_private = mqtt.Client (client_id=None, clean_session=True)
-    client_private.on_publish = on_publish
-    client_private.on_message = on_message
-    client_private.on_connect = on_connect
-    client_private.connect_async ('localhost')
-    client_private.loop_start ()
+    broker = brokers.init_brokers (configuration.BROKER_ADDRESSES)
+    client_private = create_client (on_message, 'localhost', 1883, loop)
+    client_public = create_client (on_message, broker.host, broker.port, loop)
+
+
+def create_client (on_message, host: str, port: int, loop: Optional[asyncio.AbstractEventLoop]) -> mqtt.Client:
+    mqtt_client = mqtt.Client (client_id=None, clean_session=True)
+    mqtt_client.on_publish = on_publish
+    mqtt_client.on_message = on_message
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.connect_async (host, port, KEEPALIVE)
+    if loop is None:
+        mqtt_client.loop_start ()
+    else:
+        attach_to_loop (mqtt_client, loop)
+    return mqtt_client
+
+
+def attach_to_loop (mqtt_client: mqtt.Client, loop: asyncio.AbstractEventLoop) -> None:
+    """
+    Register the socket of a client in the event loop.  Must be called from the event loop thread.
+    """
+    loop_thread = threading.get_ident ()
+
+    def call_in_loop (function, *args):
+        if threading.get_ident () == loop_thread:
+            function (*args)
+        else:
+            loop.call_soon_threadsafe (function, *args)
+
+    # the sockets are registered by file descriptor, as paho closes the socket right after the close callback
+    def on_socket_open (client, _userdata, sock):
+        call_in_loop (loop.add_reader, sock.fileno (), client.loop_read)
+
+    def on_socket_close (_client, _userdata, sock):
+        call_in_loop (loop.remove_reader, sock.fileno ())
 
-    client_public = mqtt.Client (client_id=None, clean_session=True)
-    client_public.on_publish = on_publish
-    client_public.on_message = on_message
-    client_public.on_connect = on_connect
-    client_public.connect_async (configuration.BROKER_ADDRESS)
-    client_public.loop_start ()
+    def on_socket_register_write (client, _userdata, sock):
+        call_in_loop (loop.add_writer, sock.fileno (), client.loop_write)
+
+    def on_socket_unregister_write (_client, _userdata, sock):
+        call_in_loop (loop.remove_writer, sock.fileno ())
+
+    mqtt_client.on_socket_open = on_socket_open
+    mqtt_client.on_socket_close = on_socket_close
+    mqtt_client.on_socket_register_write = on_socket_register_write
+    mqtt_client.on_socket_unregister_write = on_socket_unregister_write
+
+
+async def network_loop (mqtt_client: mqtt.Client) -> None:
+    """
+    Keep a client connected until the coroutine is cancelled.  The blocking connect runs in the default executor.
+    """
+    loop = asyncio.get_event_loop ()
+    wake = wake_events [mqtt_client] = asyncio.Event ()
+    backoff = RECONNECT_MIN
+    while True:
+        broker = pending_brokers.pop (mqtt_client, None)
+        if broker is not None:
+            # the queued messages are kept and sent to the new broker after connecting
+            mqtt_client.disconnect ()
+            mqtt_client.connect_async (broker.host, broker.port, KEEPALIVE)
+            backoff = RECONNECT_MIN
+        if mqtt_client.loop_misc () == mqtt.MQTT_ERR_NO_CONN:
+            try:
+                await loop.run_in_executor (None, mqtt_client.reconnect)
+                backoff = RECONNECT_MIN
+            except (OSError, ValueError) as e:
+                print ('MQTT connection failed: {}'.format (e))
+                await wait (wake, backoff)
+                backoff = min (backoff * 2, RECONNECT_MAX)
+                continue
+        await wait (wake, MISC_PERIOD)
+
+
+async def wait (event: asyncio.Event, timeout: float) -> None:
+    """
+    Wait until the timeout expires or the event is set, and clear the event.
+    """
+    try:
+        await asyncio.wait_for (event.wait (), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear ()
+
+
+async def broker_monitor () -> None:
+    """
+    Move the public client to the broker chosen by the brokers module until the coroutine is cancelled.
+    """
+    await brokers.monitor (switch_broker)
+
+
+def switch_broker (broker: brokers.Broker) -> None:
+    # the clients of the new broker may not have the last keyframe
+    compression.reset ()
+    pending_brokers [client_public] = broker
+    wake = wake_events.get (client_public)
+    if wake is not None:
+        wake.set ()
+
+
+async def close (timeout: float = 2.0) -> None:
+    """
+    Disconnect both clients and wait until the messages queued before are sent and the sockets are closed.
+    """
+    clients = [mqtt_client for mqtt_client in (client_public, client_private) if mqtt_client is not None]
+    for mqtt_client in clients:
+        mqtt_client.disconnect ()
+    deadline = asyncio.get_event_loop ().time () + timeout
+    while any (mqtt_client.socket () is not None for mqtt_client in clients):
+        if asyncio.get_event_loop ().time () > deadline:
+            break
+        await asyncio.sleep (0.05)
 
 
 # callback invoked with MQTT message is sent
@@ -36,5 +175,12 @@ def on_publish (_client, _userdata, mid):
 
 def on_connect (mqtt_client: mqtt.Client, _user_data, _flags, rc):
     print ('Connected with result code {}'.format (rc))
+    if mqtt_client is client_public and rc == 0:
+        brokers.connection_up ()
     print ('Subscribing to topic {}'.format (configuration.TOPIC_MANAGEMENT))
     mqtt_client.subscribe (configuration.TOPIC_MANAGEMENT, qos=2)
+
+
+def on_disconnect (mqtt_client: mqtt.Client, _user_data, rc):
+    if mqtt_client is client_public:
+        brokers.connection_down (rc)
@@ -0,0 +1,176 @@
+"""
+A minimal MQTT 3.1.1 broker that stands in for the ExpoLIS broker when testing the sensor node on a computer.
+
+It accepts any client, acknowledges publishes with QoS 0, 1 and 2, forwards them with QoS 0 to the clients subscribed
+to matching topic filters, and answers keepalive pings.  Sessions are not kept.  Every packet it sends is delayed by
+the injected latency.  It can be paused, so that it stops answering without closing the connections, to emulate a
+broker that became unreachable.  The publishes received are kept in list messages.
+
+Usage:
+
+    python3 mqtt_standin.py [port [latency_ms]]
+"""
+import asyncio
+import sys
+from typing import List, Tuple
+
+CONNACK = bytes ([0x20, 0x02, 0x00, 0x00])
+PINGRESP = bytes ([0xD0, 0x00])
+
+
+def encode_length (length: int) -> bytes:
+    result = bytearray ()
+    while True:
+        digit = length % 128
+        length //= 128
+        result.append (digit | 0x80 if length > 0 else digit)
+        if length == 0:
+            return bytes (result)
+
+
+async def read_length (reader: asyncio.StreamReader) -> int:
+    length = 0
+    multiplier = 1
+    while True:
+        digit = (await reader.readexactly (1)) [0]
+        length += (digit & 0x7F) * multiplier
+        if digit & 0x80 == 0:
+            return length
+        multiplier *= 128
+
+
+def matches (topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split ('/')
+    topic_levels = topic.split ('/')
+    for index, level in enumerate (filter_levels):
+        if level == '#':
+            return True
+        if index >= len (topic_levels) or (level != '+' and level != topic_levels [index]):
+            return False
+    return len (filter_levels) == len (topic_levels)
+
+
+class StandIn:
+    def __init__ (self, port: int = 1883, latency: float = 0.0, host: str = '127.0.0.1'):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        """Time in seconds every packet sent is delayed."""
+        self.paused = False
+        self.messages = []  # type: List[Tuple[str, bytes, int]]
+        """Topic, payload and QoS of the publishes received."""
+        self.subscriptions = {}
+        self.server = None
+        self.writers = set ()
+        self.handlers = set ()
+        """The tasks that serve the connections."""
+        self.number_connections = 0
+
+    async def start (self) -> None:
+        self.server = await asyncio.start_server (self.handle, self.host, self.port)
+
+    async def stop (self) -> None:
+        """
+        Close the listening socket and all the connections, including those waiting while paused.
+        """
+        self.server.close ()
+        for writer in list (self.writers):
+            writer.close ()
+        handlers = list (self.handlers)
+        for handler in handlers:
+            handler.cancel ()
+        await asyncio.gather (*handlers, return_exceptions=True)
+        await self.server.wait_closed ()
+
+    async def send (self, writer: asyncio.StreamWriter, packet: bytes) -> None:
+        if self.latency > 0:
+            await asyncio.sleep (self.latency)
+        if not writer.is_closing ():
+            writer.write (packet)
+
+    async def handle (self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.number_connections += 1
+        self.writers.add (writer)
+        self.handlers.add (asyncio.current_task ())
+        try:
+            while True:
+                header = (await reader.readexactly (1)) [0]
+                length = await read_length (reader)
+                body = await reader.readexactly (length)
+                while self.paused:
+                    await asyncio.sleep (0.05)
+                if not await self.process (writer, header, body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # stop was called
+            pass
+        finally:
+            self.handlers.discard (asyncio.current_task ())
+            self.writers.discard (writer)
+            self.subscriptions.pop (writer, None)
+            writer.close ()
+
+    async def process (self, writer: asyncio.StreamWriter, header: int, body: bytes) -> bool:
+        """
+        Answer a packet.
+
+        :return: False if the client disconnected.
+        """
+        packet_type = header >> 4
+        if packet_type == 1:
+            await self.send (writer, CONNACK)
+        elif packet_type == 3:
+            qos = (header >> 1) & 3
+            topic_length = int.from_bytes (body [0:2], 'big')
+            topic = body [2:2 + topic_length].decode ()
+            index = 2 + topic_length
+            if qos > 0:
+                packet_id = body [index:index + 2]
+                index += 2
+            payload = body [index:]
+            self.messages.append ((topic, payload, qos))
+            for subscriber, filters in list (self.subscriptions.items ()):
+                if not subscriber.is_closing () and any (matches (topic_filter, topic) for topic_filter in filters):
+                    encoded_topic = len (topic.encode ()).to_bytes (2, 'big') + topic.encode ()
+                    subscriber.write (
+                        bytes ([0x30]) + encode_length (len (encoded_topic) + len (payload)) + encoded_topic + payload)
+            if qos == 1:
+                await self.send (writer, bytes ([0x40, 0x02]) + packet_id)
+            elif qos == 2:
+                await self.send (writer, bytes ([0x50, 0x02]) + packet_id)
+        elif packet_type == 6:
+            await self.send (writer, bytes ([0x70, 0x02]) + body [0:2])
+        elif packet_type == 8:
+            index = 2
+            granted = bytearray ()
+            while index < len (body):
+                filter_length = int.from_bytes (body [index:index + 2], 'big')
+                self.subscriptions.setdefault (writer, []).append (body [index + 2:index + 2 + filter_length].decode ())
+                index += 3 + filter_length
+                granted.append (0)
+            await self.send (writer, bytes ([0x90]) + encode_length (2 + len (granted)) + body [0:2] + granted)
+        elif packet_type == 12:
+            await self.send (writer, PINGRESP)
+        elif packet_type == 14:
+            return False
+        return True
+
+
+async def main ():
+    port = int (sys.argv [1]) if len (sys.argv) > 1 else 1883
+    latency = float (sys.argv [2]) / 1000 if len (sys.argv) > 2 else 0.0
+    stand_in = StandIn (port, latency, '0.0.0.0')
+    await stand_in.start ()
+    print ('MQTT stand-in listening on port {} with {} ms latency'.format (port, latency * 1000))
+    received = 0
+    while True:
+        await asyncio.sleep (1)
+        for topic, payload, qos in stand_in.messages [received:]:
+            print ('{} qos={} {}'.format (topic, qos, payload [:80]))
+        received = len (stand_in.messages)
+
+
+if __name__ == '__main__':
+    asyncio.run (main ())
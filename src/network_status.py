@@ -0,0 +1,172 @@
+"""
+Keeps the network status of the sensor node: the address of the access point interface and the public IP address.
+
+Coroutine monitor, run by the event loop of the sensor node, watches the network interfaces and their addresses.  The
+checks run in the default executor, as the lookup blocks.  The public IP address is only looked up when the addresses
+change, or periodically to detect changes made by the network operator.  Lookups have a timeout, and failed lookups
+are retried with exponential backoff.  The results are cached in the variables ip and external_ip, which are read by
+the PING message and the CSV log.
+
+The timeout of urllib does not cover the name resolution of the service, which can block for a long time on a flaky
+cellular link.  The name is therefore resolved in a separate thread, which is waited for at most RESOLVE_TIMEOUT
+seconds, and the connection is made to the resolved address.  At most one such thread exists.  Each later step, the
+connection, the TLS handshake and each read of the answer, is bounded by LOOKUP_TIMEOUT, so a check that stalls at
+every step holds its executor thread for about RESOLVE_TIMEOUT plus four times LOOKUP_TIMEOUT, 25 seconds.
+"""
+import asyncio
+import http.client
+import socket
+import threading
+import time
+import urllib.parse
+
+import netifaces
+
+import configuration
+
+CHECK_PERIOD = 5.0
+"""Time in seconds between checks of the network interfaces."""
+
+REFRESH_PERIOD = 1800.0
+"""Time in seconds after which the public IP address is looked up even if the interfaces did not change."""
+
+LOOKUP_TIMEOUT = 5.0
+"""Timeout in seconds of each network operation of the public IP address lookup."""
+
+RESOLVE_TIMEOUT = 5.0
+"""Time in seconds we wait for the name resolution of the public IP address service."""
+
+BACKOFF_MIN = 10.0
+BACKOFF_MAX = 600.0
+
+# noinspection SpellCheckingInspection
+AP_INTERFACE = 'uap0'
+
+ip = 'unknown'
+"""The address of the access point interface."""
+external_ip = 'unknown'
+"""The public IP address."""
+
+number_lookups = 0
+number_lookup_errors = 0
+
+snapshot = None
+next_lookup = 0.0
+backoff = BACKOFF_MIN
+
+resolve_thread = None  # type: threading.Thread
+"""The thread of the last name resolution, which may still be stuck."""
+
+verbose = 1
+
+
+async def monitor () -> None:
+    """
+    Check the network status every CHECK_PERIOD seconds until the coroutine is cancelled.
+    """
+    loop = asyncio.get_event_loop ()
+    while True:
+        await loop.run_in_executor (None, check)
+        await asyncio.sleep (CHECK_PERIOD)
+
+
+def interface_addresses ():
+    """
+    Return a hashable snapshot of the IPv4 addresses of each network interface.
+    """
+    result = []
+    for interface in netifaces.interfaces ():
+        addresses = netifaces.ifaddresses (interface).get (netifaces.AF_INET, [])
+        result.append ((interface, tuple (a.get ('addr') for a in addresses)))
+    return tuple (result)
+
+
+def resolve (host: str, port: int) -> str:
+    """
+    Return an IPv4 address of the host, waiting at most RESOLVE_TIMEOUT seconds.
+
+    The name is resolved in a separate thread, as the resolution has no timeout.  While the thread of a previous
+    resolution is still running, the resolution fails immediately instead of starting another thread.
+
+    :raises OSError: if the name cannot be resolved in time.
+    """
+    global resolve_thread
+
+    if resolve_thread is not None and resolve_thread.is_alive ():
+        raise OSError ('previous name resolution of {} still running'.format (host))
+    result = []
+
+    def run ():
+        try:
+            result.append (socket.getaddrinfo (host, port, socket.AF_INET, socket.SOCK_STREAM) [0][4][0])
+        except OSError as e:
+            result.append (e)
+
+    resolve_thread = threading.Thread (target=run, name='resolve', daemon=True)
+    resolve_thread.start ()
+    resolve_thread.join (RESOLVE_TIMEOUT)
+    if len (result) == 0:
+        raise OSError ('name resolution of {} timed out'.format (host))
+    if isinstance (result [0], OSError):
+        raise result [0]
+    return result [0]
+
+
+def lookup_public_ip () -> str:
+    """
+    Return the public IP address reported by the configured service.
+
+    :raises OSError: if the service cannot be reached, times out or does not answer with status 200.
+    """
+    url = urllib.parse.urlsplit (configuration.PUBLIC_IP_URL)
+    secure = url.scheme == 'https'
+    port = url.port or (443 if secure else 80)
+    address = resolve (url.hostname, port)
+    connection_class = http.client.HTTPSConnection if secure else http.client.HTTPConnection
+    connection = connection_class (url.hostname, port, timeout=LOOKUP_TIMEOUT)
+    # connect to the resolved address, the host name is still used in the Host header and to check the certificate
+    connection._create_connection = lambda _address, *args: socket.create_connection ((address, port), *args)
+    try:
+        connection.request ('GET', (url.path or '/') + ('?' + url.query if url.query else ''))
+        response = connection.getresponse ()
+        if response.status != 200:
+            raise OSError ('public IP service answered {} {}'.format (response.status, response.reason))
+        return response.read (64).decode ('utf8').strip ()
+    finally:
+        connection.close ()
+
+
+def check () -> None:
+    """
+    Update the address of the access point interface, and look up the public IP address if it is due.
+    """
+    global ip, external_ip, number_lookups, number_lookup_errors, snapshot, next_lookup, backoff
+
+    now = time.monotonic ()
+    try:
+        new_snapshot = interface_addresses ()
+    except ValueError:
+        # an interface disappeared while we were reading its addresses
+        new_snapshot = snapshot
+    if new_snapshot != snapshot:
+        snapshot = new_snapshot
+        addresses = dict (snapshot or ()).get (AP_INTERFACE, ())
+        ip = addresses [0] if len (addresses) > 0 else 'unavailable'
+        # the addresses changed, the public address may have changed too
+        next_lookup = now
+        backoff = BACKOFF_MIN
+    if now >= next_lookup:
+        number_lookups += 1
+        try:
+            external_ip = lookup_public_ip ()
+            next_lookup = now + REFRESH_PERIOD
+            backoff = BACKOFF_MIN
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            number_lookup_errors += 1
+            external_ip = 'unavailable'
+            next_lookup = now + backoff
+            backoff = min (backoff * 2, BACKOFF_MAX)
+            if verbose > 1:
+                print ('Public IP lookup failed: {}'.format (e))
+        if verbose > 0:
+            print ('IP: ' + ip + ' Public IP: ' + external_ip)
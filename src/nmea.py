@@ -0,0 +1,117 @@
+"""
+Incremental parser of NMEA sentences received from the GPS sensor as a byte stream.
+
+Bytes are read by the caller directly into the parser buffer (see ``NmeaParser.receive_buffer``), so a sentence split
+across several reads is completed in place.  Only the bytes of an incomplete sentence are moved to the start of the
+buffer after each read.  Sentences with a wrong checksum or that do not fit in the buffer are dropped and counted.
+"""
+import time
+
+
+class NmeaParser:
+    def __init__ (self, buffer_size=512):
+        self.buffer = bytearray (buffer_size)
+        self.view = memoryview (self.buffer)
+        self.length = 0
+        self.bytes_received = 0
+        self.sentences_parsed = 0
+        self.sentences_dropped = 0
+        self.parse_time = 0.0
+
+    def receive_buffer (self, size):
+        """
+        Return a view of the free space at the end of the buffer where the caller reads at most ``size`` bytes.
+        If the buffer is full, the incomplete sentence is dropped.
+        """
+        if self.length + size > len (self.buffer):
+            self.sentences_dropped += 1
+            self.length = 0
+        return self.view [self.length:self.length + size]
+
+    def commit (self, size):
+        """
+        Process ``size`` bytes that the caller has read into the view returned by ``receive_buffer``.
+        :return: a list with the fields of each complete sentence with a valid checksum.  The fields are strings and
+        the first one is the sentence type without the talker identifier, for instance ``RMC``.
+        """
+        time_start = time.perf_counter ()
+        self.bytes_received += size
+        self.length += size
+        buffer = self.buffer
+        result = []
+        position = 0
+        while True:
+            start = buffer.find (b'$', position, self.length)
+            if start == -1:
+                position = self.length
+                break
+            end = buffer.find (b'\r', start, self.length)
+            if end == -1:
+                position = start
+                break
+            position = end + 1
+            sentence = self.check (start, end)
+            if sentence is None:
+                self.sentences_dropped += 1
+            else:
+                self.sentences_parsed += 1
+                result.append (sentence)
+        # move the incomplete sentence to the start of the buffer
+        remaining = self.length - position
+        if remaining > 0 and position > 0:
+            buffer [:remaining] = self.view [position:self.length]
+        self.length = remaining
+        self.parse_time += time.perf_counter () - time_start
+        return result
+
+    def feed (self, data):
+        """
+        Process bytes that were read into some other buffer.
+        """
+        result = []
+        for index in range (0, len (data), len (self.buffer) // 2):
+            chunk = data [index:index + len (self.buffer) // 2]
+            self.receive_buffer (len (chunk)) [:len (chunk)] = chunk
+            result.extend (self.commit (len (chunk)))
+        return result
+
+    def check (self, start, end):
+        """
+        Validate the checksum of the sentence between the given indexes of the buffer and split it into fields.
+        """
+        star = end - 3
+        if star <= start or self.buffer [star] != 0x2A:
+            return None
+        checksum = 0
+        for a_byte in self.view [start + 1:star]:
+            checksum ^= a_byte
+        try:
+            if checksum != int (bytes (self.view [star + 1:end]), 16):
+                return None
+            fields = bytes (self.view [start + 3:star]).decode ('ascii').split (',')
+        except ValueError:
+            return None
+        return fields
+
+    def statistics (self):
+        """
+        Return a dictionary with the parser counters.
+        """
+        return {
+            'bytes_received': self.bytes_received,
+            'sentences_parsed': self.sentences_parsed,
+            'sentences_dropped': self.sentences_dropped,
+            'parse_time': self.parse_time,
+            'sentences_per_second': self.sentences_parsed / self.parse_time if self.parse_time > 0 else 0,
+        }
+
+
+def parse_coordinate (value, hemisphere):
+    """
+    Convert a NMEA coordinate in the format (d)ddmm.mmmm and its hemisphere to decimal degrees.
+    """
+    if value == '':
+        return None
+    dot = value.index ('.')
+    result = int (value [:dot - 2]) + float (value [dot - 2:]) / 60
+    return -result if hemisphere in ('S', 'W') else result
@@ -2,37 +2,80 @@
 This module handles sensors whose API to get values is simple.
 
 The sensor data handled in this module is: carbon monoxide, nitric dioxide, power supply voltage, temperature,
-pressure and humidity.
+pressure and humidity.  The vibration features computed by the accelerometer_sensor module are appended to these values.
+
+If the ADC continuous mode is enabled, the CO and NO2 values are the mean of the samples gathered by the adc_sensor
+module since the previous call.  Otherwise, each channel is read once.  The standard deviation and the number of samples
+of the four channels are appended to the returned values.
+
+The sensors are opened by init_sensors.  When reading them fails, the supervisor calls init_sensors again.
 """
 import adafruit_ads1x15.ads1115
 import adafruit_ads1x15.analog_in
 import adafruit_shtc3
 import adafruit_lps2x
-import adafruit_msa301
-import board
-import busio
 
+import accelerometer_sensor
+import adc_sensor
+import configuration
+import i2c_bus
 
-def get_values ():
-    # initialisation
-    i2c = busio.I2C (board.SCL, board.SDA)
-    ads = adafruit_ads1x15.ads1115.ADS1115 (i2c)
-    gas_co_reading_1 = adafruit_ads1x15.analog_in.AnalogIn (ads, adafruit_ads1x15.ads1115.P0)
-    gas_co_reading_2 = adafruit_ads1x15.analog_in.AnalogIn (ads, adafruit_ads1x15.ads1115.P1)
-    gas_no2_reading_1 = adafruit_ads1x15.analog_in.AnalogIn (ads, adafruit_ads1x15.ads1115.P2)
-    gas_no2_reading_2 = adafruit_ads1x15.analog_in.AnalogIn (ads, adafruit_ads1x15.ads1115.P3)
-    power_supply_reading = adafruit_ads1x15.analog_in.AnalogIn (ads, adafruit_ads1x15.ads1115.P3)
+I2C_PRIORITY = 3
+"""Priority of the transactions of these sensors on the I2C bus, see module i2c_bus."""
+
+TASK_PERIOD = 1
+"""Period of the scheduler task that reads the sensors, in acquisition periods."""
+TASK_BUDGET = 0.1
+"""Time in seconds the scheduler task is expected to take."""
+TASK_FIELDS = [
+    'co_1', 'co_2', 'no2_1', 'no2_2', 'temperature', 'pressure', 'humidity', 'power',
+    'acceleration_rms', 'acceleration_peak', 'acceleration_frequency', 'moving',
+    'co_1_std', 'co_2_std', 'no2_1_std', 'no2_2_std', 'co_1_count', 'co_2_count', 'no2_1_count', 'no2_2_count',
+]
+"""Sample fields set from the values returned by get_values."""
+
+humidity_temperature_reading = None
+pressure_reading = None
+adc_channels = []
+"""The ADC channels read once per call when the ADC continuous mode is disabled."""
+
+
+def init_sensors ():
+    """
+    Open the temperature, humidity and pressure sensors, and the ADC when it is not read by the adc_sensor module.
+    """
+    global humidity_temperature_reading, pressure_reading, adc_channels
+
+    i2c = i2c_bus.client ('other_sensors', I2C_PRIORITY)
     humidity_temperature_reading = adafruit_shtc3.SHTC3 (i2c)
     pressure_reading = adafruit_lps2x.LPS25 (i2c)
-    acceleration_reading = adafruit_msa301.MSA301 (i2c)
-    # get values
-    gas_co_value_1 = gas_co_reading_1.voltage
-    gas_co_value_2 = gas_co_reading_2.voltage
-    gas_no2_value_1 = gas_no2_reading_1.voltage
-    gas_no2_value_2 = gas_no2_reading_2.voltage
-    power_supply_value = power_supply_reading.voltage * 2.0
+    if not configuration.ADC_CONTINUOUS:
+        ads = adafruit_ads1x15.ads1115.ADS1115 (i2c)
+        adc_channels = [
+            adafruit_ads1x15.analog_in.AnalogIn (ads, pin)
+            for pin in (
+                adafruit_ads1x15.ads1115.P0,
+                adafruit_ads1x15.ads1115.P1,
+                adafruit_ads1x15.ads1115.P2,
+                adafruit_ads1x15.ads1115.P3,
+            )
+        ]
+
+
+def get_values ():
+    if configuration.ADC_CONTINUOUS:
+        adc_statistics = adc_sensor.get_values ()
+    else:
+        adc_statistics = [(a_channel.voltage, 0, 1) for a_channel in adc_channels]
+    (gas_co_value_1, gas_co_std_1, gas_co_count_1), \
+        (gas_co_value_2, gas_co_std_2, gas_co_count_2), \
+        (gas_no2_value_1, gas_no2_std_1, gas_no2_count_1), \
+        (gas_no2_value_2, gas_no2_std_2, gas_no2_count_2) = adc_statistics
+    # the power supply is read on the same channel as the second NO2 value
+    power_supply_value = gas_no2_value_2 * 2.0
     temperature_value, relative_humidity_value = humidity_temperature_reading.measurements
     pressure_value = pressure_reading.pressure
-    acceleration_value_1, acceleration_value_2, acceleration_value_3 = acceleration_reading.acceleration
+    acceleration_rms, acceleration_peak, acceleration_frequency, moving = accelerometer_sensor.get_values ()
     # return values
-    return gas_co_value_1, gas_co_value_2, gas_no2_value_1, gas_no2_value_2, temperature_value, pressure_value, relative_humidity_value, power_supply_value, acceleration_value_1, acceleration_value_2, acceleration_value_3
+    return gas_co_value_1, gas_co_value_2, gas_no2_value_1, gas_no2_value_2, temperature_value, pressure_value, relative_humidity_value, power_supply_value, acceleration_rms, acceleration_peak, acceleration_frequency, moving, \
+        gas_co_std_1, gas_co_std_2, gas_no2_std_1, gas_no2_std_2, gas_co_count_1, gas_co_count_2, gas_no2_count_1, gas_no2_count_2
@@ -1,187 +1,414 @@
+"""
+This module handles the OPC-N3 optical particle counter, which returns the PM1, PM2.5 and PM10 values.
+
+A single worker thread owns the SPI bus and runs the sensor through the states off, starting, warming, sampling,
+degraded and restarting.  No other thread talks to the sensor: get_values, set_power and the MQTT commands only set
+flags and wake the worker, so a restart never overlaps a sample.
+
+* off: the fan and laser are off, either because the sensor is duty-cycled by the sampling policy or because of the
+  STOP_SENSORS command;
+* starting: the SPI bus is opened;
+* warming: the fan and laser are switched on and a first histogram is read and discarded;
+* sampling: a sample is read whenever get_values asks for one;
+* degraded: the last sample failed, sampling goes on;
+* restarting: after MAX_FAILED_SAMPLES failed samples in a row, or a failed start, the fan and laser are switched off,
+  the SPI bus is closed and the worker waits a backoff that doubles from RESTART_MIN up to RESTART_MAX seconds before
+  starting again.
+
+The time spent in each state is counted.  The recovery time is the time from the first failure until the next valid
+sample.
+"""
 import struct
 import paho.mqtt.client as mqtt
-import spidev
 import threading
-from time import sleep
+from time import monotonic, sleep
+from typing import Optional, Tuple
 
+import backends
 import configuration
 import pms_sensor_kalman
 
 
-# noinspection PyTypeChecker
-spi = None  # type: spidev.SpiDev
-
-pm_1 = -1
-pm_2_5 = -1
-pmC = -1
-
-opc_start_thread_done = False
-opc_sample_thread_done = False
+OFF, STARTING, WARMING, SAMPLING, DEGRADED, RESTARTING = range (6)
+STATE_NAMES = ['off', 'starting', 'warming', 'sampling', 'degraded', 'restarting']
 
-iteration = 0
+# noinspection PyTypeChecker
+spi = None
+"""The SPI bus, only used by the worker thread."""
+
+state = OFF
+state_since = 0.0
+"""Monotonic clock time at which the worker entered the current state."""
+state_time = [0.0] * len (STATE_NAMES)
+"""Time in seconds spent in each state, not counting the current stay."""
+state_entries = [0] * len (STATE_NAMES)
+
+opc_powered = True
+"""Whether the OPC-N3 fan and laser should be on, see function set_power."""
+enabled = True
+"""False after the STOP_SENSORS command, until the START_SENSORS command."""
+
+worker_thread = None  # type: threading.Thread
+stop_worker = False
+wake = threading.Event ()
+"""Set to wake the worker when a sample is requested, the power changes or the worker must stop."""
+last_progress = 0.0
+"""Monotonic clock time at which the worker last went through its loop."""
+
+sample_requested = False
+sample_ready = threading.Event ()
+sample_lock = threading.Lock ()
+sample_sequence = 0
+"""Number of valid samples read by the worker."""
+sample_values = (-1, -1, -1)
+"""PM1, PM2.5 and PM10 values of the last valid sample."""
+returned_sequence = 0
+"""Sequence number of the last sample returned by get_values."""
+
+failed_samples = 0
+"""Number of failed samples in a row."""
+restart_time = 0.0
+backoff = 0.0
+failed_since = None  # type: Optional[float]
+"""Monotonic clock time of the first failure not yet recovered, or None."""
+
+number_samples = 0
+number_failed_samples = 0
+number_restarts = 0
+number_recoveries = 0
+last_recovery_time = 0.0
+total_recovery_time = 0.0
+max_recovery_time = 0.0
+
+MAX_FAILED_SAMPLES = 3
+"""Number of failed samples in a row after which the sensor is restarted."""
+
+RESTART_MIN = 5.0
+RESTART_MAX = 300.0
+
+SAMPLE_WAIT = 0.15
+"""Time in seconds get_values waits for the worker to read the sample it asked for."""
+
+IDLE_PERIOD = 1.0
+"""Time in seconds the worker waits for a request before going through its loop again."""
+
+HEALTH_TIMEOUT = 60.0
+"""Time in seconds the worker may spend in a single step, such as switching the fan on, before it is stuck."""
+
+STOP_TIMEOUT = 30.0
+"""Time in seconds function stop waits for the worker to switch the fan and laser off."""
+
+TASK_PERIOD = 1
+"""Period of the scheduler task that reads the sensor, in acquisition periods."""
+TASK_BUDGET = 0.2
+"""Time in seconds the scheduler task is expected to take."""
+TASK_FIELDS = ['pm1_opc', 'pm25_opc', 'pm10_opc', 'pm1_opc_filtered', 'pm25_opc_filtered', 'pm10_opc_filtered']
+"""Sample fields set from the values returned by get_values."""
+
+verbose = 1
 
 
 def init_sensor ():
     """
     Initialise the OPC-N3 sensor that return the PM measurements.
     """
+    global backoff
     pms_sensor_kalman.init_kalman_filters ()
-    threading.Thread (target=thread_opc_start_run).start ()
+    backoff = RESTART_MIN
+    start_worker ()
 
 
-def thread_opc_start_run ():
-    global opc_start_thread_done
-    global spi
-    opc_start_thread_done = False
+def start_worker ():
+    global worker_thread, stop_worker, last_progress, state, state_since
+    stop_worker = False
+    last_progress = monotonic ()
+    state = OFF
+    state_since = last_progress
+    worker_thread = threading.Thread (target=thread_opc_run, daemon=True)
+    worker_thread.start ()
 
-    # preparing SPI communications for OPC-N3
-    spi = spidev.SpiDev ()
-    spi.open (0, 0)
-    spi.mode = 1
-    spi.max_speed_hz = 500000
-    # spi.cshigh = False
-    # sleep(0.1)
-    # spi.cshigh = True
-    # sleep(0.1)
-    # spi.cshigh = False
-    sleep (1)
 
-    print ('OPC done')
+def stop ():
+    """
+    Stop the worker, which switches the fan and laser off and closes the SPI bus.
+    """
+    global stop_worker
+    stop_worker = True
+    wake.set ()
+    if worker_thread is not None:
+        worker_thread.join (STOP_TIMEOUT)
+
+
+def is_healthy ():
+    """
+    Return whether the worker is running and not stuck.  The sensor itself is restarted by the worker.
+    """
+    return worker_thread is not None and worker_thread.is_alive () and monotonic () - last_progress < HEALTH_TIMEOUT
+
+
+def restart ():
+    """
+    Start a new worker.  Called by the supervisor, which waits for it to return.
+
+    :raises RuntimeError: if the worker is stuck.
+    """
+    stop ()
+    if worker_thread is not None and worker_thread.is_alive ():
+        raise RuntimeError ('OPC worker did not stop')
+    start_worker ()
+
+
+def set_power (on: bool):
+    """
+    Ask the worker to switch the OPC-N3 fan and laser on or off, to duty-cycle the sensor.
+    While the sensor is not sampling, get_values returns -1 values.
+    """
+    global opc_powered
+    if on == opc_powered:
+        return
+    opc_powered = on
+    wake.set ()
 
-    # turn on OPC-N3 fan and laser
-    fan_on ()
-    sleep (1)
-    print ('OPC fan on')
 
-    laser_on ()
+def enter (new_state: int):
+    global state, state_since
+    now = monotonic ()
+    state_time [state] += now - state_since
+    state_entries [new_state] += 1
+    state = new_state
+    state_since = now
+    if verbose > 0:
+        print ('OPC {}'.format (STATE_NAMES [new_state]))
+
+
+def fail ():
+    """
+    Start the recovery of the sensor after a failed start or too many failed samples.
+    """
+    global restart_time, backoff, failed_since, number_restarts
+    now = monotonic ()
+    if failed_since is None:
+        failed_since = now
+    number_restarts += 1
+    restart_time = now + backoff
+    backoff = min (backoff * 2, RESTART_MAX)
+    enter (RESTARTING)
+
+
+def thread_opc_run ():
+    global last_progress, sample_requested, failed_since
+    while not stop_worker:
+        last_progress = monotonic ()
+        should_run = opc_powered and enabled
+        if state == OFF:
+            if should_run:
+                enter (STARTING if spi is None else WARMING)
+            else:
+                wait (IDLE_PERIOD)
+        elif state == STARTING:
+            try:
+                open_bus ()
+                enter (WARMING)
+            except OSError as e:
+                print ('Failed to open the OPC SPI bus: {}'.format (e))
+                fail ()
+        elif state == WARMING:
+            if fan_on () and laser_on () and read_sample () is not None:
+                enter (SAMPLING)
+            else:
+                fail ()
+        elif state == RESTARTING:
+            if spi is not None:
+                switch_off ()
+                close_bus ()
+            if not should_run:
+                # a failure while duty-cycled off is not waited for
+                failed_since = None
+                enter (OFF)
+            elif monotonic () >= restart_time:
+                enter (STARTING)
+            else:
+                wait (min (restart_time - monotonic (), IDLE_PERIOD))
+        elif not should_run:
+            switch_off ()
+            enter (OFF)
+        else:
+            wait (IDLE_PERIOD)
+            if sample_requested and not stop_worker and opc_powered and enabled:
+                sample_requested = False
+                step_sample ()
+    if spi is not None:
+        switch_off ()
+        close_bus ()
+    enter (OFF)
+
+
+def wait (timeout: float):
+    wake.wait (timeout)
+    wake.clear ()
+
+
+def step_sample ():
+    """
+    Read a sample in the sampling or degraded state and update the failure counters.
+    """
+    global sample_sequence, sample_values, failed_samples, failed_since, backoff
+    global number_samples, number_failed_samples, number_recoveries
+    global last_recovery_time, total_recovery_time, max_recovery_time
+    number_samples += 1
+    values = read_sample ()
+    # a zero PM1 value means the fan or laser is not working
+    if values is None or values [0] == 0:
+        number_failed_samples += 1
+        failed_samples += 1
+        if failed_since is None:
+            failed_since = monotonic ()
+        if failed_samples >= MAX_FAILED_SAMPLES:
+            fail ()
+        elif state == SAMPLING:
+            enter (DEGRADED)
+        return
+    with sample_lock:
+        sample_sequence += 1
+        sample_values = values
+    sample_ready.set ()
+    failed_samples = 0
+    backoff = RESTART_MIN
+    if failed_since is not None:
+        recovery_time = monotonic () - failed_since
+        failed_since = None
+        number_recoveries += 1
+        last_recovery_time = recovery_time
+        total_recovery_time += recovery_time
+        max_recovery_time = max (max_recovery_time, recovery_time)
+        print ('OPC recovered in {:.1f} s'.format (recovery_time))
+    if state == DEGRADED:
+        enter (SAMPLING)
+
+
+def open_bus ():
+    global spi
+    # preparing SPI communications for OPC-N3
+    spi = backends.open_spi ('opc', 0, 0, 1, 500000)
     sleep (1)
-    print ('OPC laser on')
 
-    opc_start_thread_done = True
 
-    # # now we can sample the OPC_N3 sensors
-    # threading.Thread (target=thread_sample_opc_run).start ()
+def close_bus ():
+    global spi
+    try:
+        spi.close ()
+    except OSError:
+        pass
+    spi = None
+
+
+def switch_off ():
+    laser_off ()
+    fan_off ()
 
 
 # start OPC-N3 fan
 def fan_on (debug=False):
-    talk_device (0x03, 'fan on', debug)
+    return talk_device (0x03, 'fan on', debug)
 
 
 # start OPC-N3 laser
 def laser_on (debug=False):
-    talk_device (0x07, 'laser on', debug)
+    return talk_device (0x07, 'laser on', debug)
 
 
 # stop OPC-N3 fan
 def fan_off (debug=False):
-    talk_device (0x02, 'fan off', debug)
+    return talk_device (0x02, 'fan off', debug)
 
 
 # stop OPC-N3 laser
 def laser_off (debug=False):
-    talk_device (0x06, 'laser off', debug)
+    return talk_device (0x06, 'laser off', debug)
 
 
-def talk_device (message, action='act device', debug=False):
+def select_command (command, action, debug=False):
+    """
+    Send a command byte until the sensor answers that it is ready.
+
+    :return: whether the sensor is ready to receive the command data.
+    """
     count_x = 0
     ctr = 0
     while True:
         count_x = count_x + 1
         if count_x > 3:
             if debug:
-                print ('{}: failed!'.format(action))
-            return
-        a = spi.xfer ([0x03])[0]
+                print ('{}: failed!'.format (action))
+            return False
+        a = spi.xfer ([command])[0]
         if debug:
             print ('{}: CMD1 {} {}'.format (action, hex (a), a))
         count = 0
-        while a is not int ('0xf3', 16) and count != 20:
+        while a != 0xF3 and count != 20:
             sleep (0.02)
             ctr = 1
-            a = spi.xfer ([0x03])[0]
+            a = spi.xfer ([command])[0]
             if debug:
                 print ('{}: CMD2 {} {}'.format (action, hex (a), a))
             count = count + 1
-        if a is int ('0xf3', 16):
+        if a == 0xF3:
             break
         if debug:
             print ('{}: resetting spi'.format (action))
         sleep (3)
     if ctr == 0:
         sleep (0.02)
-        _dummy = spi.xfer ([0x03])[0]
-    sleep (0.00002)
-    a = spi.xfer ([message])[0]
+        _dummy = spi.xfer ([command])[0]
+    return True
+
+
+def talk_device (message, action='act device', debug=False):
+    """
+    Send a peripheral power command and wait for the sensor to carry it out.
+
+    :return: whether the sensor received the command.
+    """
+    try:
+        if not select_command (0x03, action, debug):
+            return False
+        sleep (0.00002)
+        a = spi.xfer ([message])[0]
+    except OSError as e:
+        print ('{}: {}'.format (action, e))
+        return False
     if debug:
         print ('{}: done, {} {}'.format (action, hex (a), a))
     sleep (3)
+    return True
 
 
-def thread_sample_opc_run (debug=False):
-    global pm_1
-    global pm_2_5
-    global pmC
-    global opc_sample_thread_done
+def read_sample (debug=False) -> Optional[Tuple[float, float, float]]:
+    """
+    Read the PM values computed by the sensor since the previous read.
 
-    opc_sample_thread_done = False
-    ctr = 0
-    count_x = 0
-    while True:
-        count_x = count_x + 1
-        if count_x > 3:
-            if debug:
-                print ('fail to sample OPC')
-            break
-        a = spi.xfer ([0x32])[0]
-        if debug:
-            print ("CMD1: ", hex (a), a)
-        count = 0
-        while a is not int ('0xf3', 16) and count != 20:  # [0xf3]: #49
-            ctr = 1
-            sleep (0.02)
-            a = spi.xfer ([0x32])[0]
-            if debug:
-                print ("CMD2: ", hex (a), a)
-            count = count + 1
-        if a is int ('0xf3', 16):
-            break
-        if debug:
-            print ("resetting spi")
-        sleep (3)
-    if ctr == 0:
-        sleep (0.02)
-        _a = spi.xfer ([0x32])[0]
-    output = []
-    for _i in range (14):
-        sleep (0.00002)
-        a = spi.xfer ([0x32])[0]
-        output.append (a)
+    :return: the PM1, PM2.5 and PM10 values, or None if the sensor did not answer or the CRC is wrong.
+    """
+    try:
+        if not select_command (0x32, 'sample', debug):
+            return None
+        output = []
+        for _i in range (14):
+            sleep (0.00002)
+            output.append (spi.xfer ([0x32])[0])
+    except OSError as e:
+        print ('Failed to sample OPC: {}'.format (e))
+        return None
     pm_1 = struct.unpack ('f', bytes (output[0:4]))[0]
     pm_2_5 = struct.unpack ('f', bytes (output[4:8]))[0]
     pmC = struct.unpack ('f', bytes (output[8:12]))[0]
     check = combine_bytes (output[12], output[13])
-
-    # check = combine_bytes (output[13], output[12])
-    # pm_1a = struct.unpack ('f', bytes (output[0:3]))[0]
-    
-    print ('OPC 14 bytes:', end='')
-    for idx, ab in enumerate (output):
-        if idx % 4 == 0:
-            print (' ', end='')
-        print ('{:02X}'.format (ab), end='')
-    print (' {:10.7} {:10.7f} {:10.7f}'.format (pm_1, pm_2_5, pmC))
-    
-    if True or debug:
-        print ("CRC ", check, "Dif ", check - calc_crc (output, 12))
-    if check - calc_crc (output, 12) != 0:
+    if verbose > 1:
+        print ('OPC 14 bytes: {} {:10.7} {:10.7f} {:10.7f}'.format (bytes (output).hex (), pm_1, pm_2_5, pmC))
+    if check != calc_crc (output, 12):
         print ('---> Error in CRC {} {} {}'.format (pm_1, pm_2_5, pmC))
-        pm_1 = -1
-        pm_2_5 = -1
-        pmC = -1
-    if debug:
-        print ("PMA ", pm_1, "PMB ", pm_2_5, "PMC ", pmC)
-    opc_sample_thread_done = True
+        return None
+    return pm_1, pm_2_5, pmC
 
 
 # make an int from two bytes
@@ -204,67 +431,53 @@ def calc_crc (data, number_of_bytes):
 
 
 def get_values (debug=True, sampling_period=1):
-    global iteration
-    if opc_start_thread_done:
-        threading.Thread (
-            target=thread_sample_opc_run,
-            args=(False, )
-        ).start ()
-        sleep (0.1)
-        if opc_sample_thread_done and pm_1 != -1 and pm_1 != 0:
-            pm1_filtered, pm2_5_filtered, pm10_filtered = pms_sensor_kalman.step_kalman_filters (pm_1, pm_2_5, pmC, sampling_period)
-            result = (pm_1, pm_2_5, pmC, pm1_filtered, pm2_5_filtered, pm10_filtered)
-        else:
-            iteration += 1
-            if iteration == 3:
-                print ('Algo esquisito aconteceu ?!@#%&*?!!\nVou fazer restart ao OPC')
-                threading.Thread (target=thread_opc_start_run).start ()
-                iteration = 0
-            result = (-1, -1, -1, -1, -1, -1)
-    else:
-        result = (-1, -1, -1, -1, -1, -1)
-
-    return result
-        
-
-def get_values__ (debug=True):
-    global iteration
+    """
+    Ask the worker for a sample and wait at most SAMPLE_WAIT seconds for it.  A sample read after the wait is returned
+    by the next call.
 
-    if opc_start_thread_done and opc_sample_thread_done and iteration > 60 and pm_1 == -1:
-        if debug:
-            print ('OPC with issues: restarting sensor     {} {} {}'.format (pm_1, pm_2_5, pmC))
-        threading.Thread (target=thread_opc_start_run).start ()
-        if debug:
-            print ('retried')
-        iteration = 1
-        result = (-1, -1, -1, -1, -1, -1)
-    elif opc_start_thread_done and opc_sample_thread_done:
-        if debug:
-            pass
-            # print ('OPC has already finished sampling')
-        pm1_filtered, pm2_5_filtered, pm10_filtered = pms_sensor_kalman.step_kalman_filters (pm_1, pm_2_5, pmC)
-        result = (pm_1, pm_2_5, pmC, pm1_filtered, pm2_5_filtered, pm10_filtered)
-        threading.Thread (
-            target=thread_sample_opc_run,
-            args=(False, )
-        ).start ()
-    else:
-        if debug:
-            print (
-                "OPC hasn't finished (re)starting" if not opc_start_thread_done else
-                "OPC hasn't finished sampling")
-        result = (-1, -1, -1, -1, -1, -1)
-    iteration = iteration + 1
+    :return: the PM1, PM2.5 and PM10 values followed by their filtered values, or -1 values if there is no new sample.
+    """
+    global sample_requested, returned_sequence
+    if state not in (SAMPLING, DEGRADED):
+        return -1, -1, -1, -1, -1, -1
+    sample_ready.clear ()
+    sample_requested = True
+    wake.set ()
+    sample_ready.wait (SAMPLE_WAIT)
+    with sample_lock:
+        sequence, (pm_1, pm_2_5, pmC) = sample_sequence, sample_values
+    if sequence == returned_sequence:
+        return -1, -1, -1, -1, -1, -1
+    returned_sequence = sequence
+    pm1_filtered, pm2_5_filtered, pm10_filtered = pms_sensor_kalman.step_kalman_filters (pm_1, pm_2_5, pmC, sampling_period)
+    return pm_1, pm_2_5, pmC, pm1_filtered, pm2_5_filtered, pm10_filtered
+
+
+def statistics () -> str:
+    """
+    Return the state of the sensor, the time in seconds spent in each state and the recovery counters as text for the
+    telemetry topic.
+    """
+    times = list (state_time)
+    times [state] += monotonic () - state_since
+    result = 'state={} '.format (STATE_NAMES [state])
+    result += ' '.join ('{}={:.0f}'.format (name, times [index]) for index, name in enumerate (STATE_NAMES))
+    result += ' samples={} failed_samples={} restarts={} recoveries={} last={:.1f} mean={:.1f} max={:.1f}'.format (
+        number_samples, number_failed_samples, number_restarts, number_recoveries,
+        last_recovery_time, total_recovery_time / number_recoveries if number_recoveries > 0 else 0.0,
+        max_recovery_time)
     return result
 
 
 def command_stop_sensors (mqtt_client: mqtt.Client):
+    global enabled
     mqtt_client.publish (configuration.TOPIC_LOG, 'received stop sensors', qos=2)
-    fan_off ()
-    laser_off ()
+    enabled = False
+    wake.set ()
 
 
 def command_start_sensors (mqtt_client: mqtt.Client):
+    global enabled
     mqtt_client.publish (configuration.TOPIC_LOG, 'received start sensors', qos=2)
-    fan_on ()
-    laser_on ()
+    enabled = True
+    wake.set ()
@@ -0,0 +1,265 @@
+"""Provides commands to profile the running sensor node process and trace its
+memory allocations.
+
+All profiling runs for a bounded window and turns itself off when the window
+ends.  Results are written as text files to the profiles folder in the backup
+pen and can be fetched compressed with gzip through the profiles MQTT topic.
+
+Two profilers are available:
+
+cprofile
+    Deterministic profiler of the main loop.  ``cProfile`` only sees the
+    thread where it is enabled, so the command only requests the profile and
+    function step_profiling, called by the main loop at every iteration,
+    enables and disables it.  The statistics are written by a separate thread.
+
+sampling
+    A background thread samples the stack of the main loop thread every
+    SAMPLING_INTERVAL seconds and counts the collapsed stacks.  The main loop
+    is not instrumented at all.
+
+Command Functions
+-----------------
+
+command_start_profile
+    Starts a profiler for a number of seconds.
+
+command_stop_profile
+    Stops the running profiler before its window ends.
+
+command_trace_memory
+    Starts or stops ``tracemalloc``, takes a snapshot or compares a snapshot
+    with the previous one.
+
+command_get_profile
+    Publishes a result file compressed with gzip.
+"""
+
+import collections
+import cProfile
+import datetime
+import gzip
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+import paho.mqtt.client as mqtt
+
+import configuration
+
+PROFILES_FOLDER = os.path.join (configuration.STORAGE_FOLDER, 'profiles/')
+
+MAX_WINDOW = 600
+"""Maximum duration in seconds of a profiling window."""
+
+SAMPLING_INTERVAL = 0.01
+"""Time in seconds between samples of the sampling profiler."""
+
+TRACEMALLOC_FRAMES = 10
+TOP_STATISTICS = 50
+
+profile_mode = None  # type: Optional[str]
+"""The running profiler, or None."""
+profile_deadline = 0.0
+"""Monotonic clock time at which the running profiler stops."""
+profiler = None  # type: Optional[cProfile.Profile]
+"""The cProfile profiler, enabled in the main loop thread."""
+main_thread_id = threading.main_thread ().ident
+"""Identifier of the thread that runs the main loop, updated by step_profiling."""
+mutex = threading.Lock ()
+
+memory_snapshot = None  # type: Optional[tracemalloc.Snapshot]
+memory_timer = None  # type: Optional[threading.Timer]
+
+last_result = None  # type: Optional[str]
+"""Filename of the most recent result."""
+
+
+def result_filename (kind: str) -> str:
+    os.makedirs (PROFILES_FOLDER, exist_ok=True)
+    return os.path.join (PROFILES_FOLDER, '{}_{}.txt'.format (
+        kind, datetime.datetime.now ().strftime ('%Y_%m_%d__%H_%M_%S_%f')))
+
+
+def write_result (kind: str, content: str) -> str:
+    global last_result
+    filename = result_filename (kind)
+    with open (filename, 'w') as fd:
+        fd.write (content)
+    last_result = filename
+    print ('Profiling result written to {}'.format (filename))
+    return filename
+
+
+def step_profiling () -> None:
+    """Enables or disables the cProfile profiler in the main loop thread.
+
+    Called by the main loop at every iteration.  Costs a comparison when no
+    profiler was requested.
+    """
+    global profiler, main_thread_id
+    main_thread_id = threading.get_ident ()
+    if profile_mode != 'cprofile':
+        return
+    if time.monotonic () >= profile_deadline:
+        stop_cprofile ()
+    elif profiler is None:
+        profiler = cProfile.Profile ()
+        profiler.enable ()
+
+
+def stop_cprofile () -> None:
+    """Disables the profiler and writes its statistics in a separate thread.
+
+    Must be called from the main loop thread.
+    """
+    global profiler, profile_mode
+    with mutex:
+        finished = profiler
+        profiler = None
+        profile_mode = None
+    if finished is not None:
+        finished.disable ()
+        threading.Thread (target=thread_write_cprofile_run, args=(finished,), daemon=True).start ()
+
+
+def thread_write_cprofile_run (finished: cProfile.Profile) -> None:
+    stream = io.StringIO ()
+    pstats.Stats (finished, stream=stream).sort_stats ('cumulative').print_stats (TOP_STATISTICS)
+    write_result ('cprofile', stream.getvalue ())
+
+
+def thread_sampling_run () -> None:
+    """Samples the stack of the main loop thread until the window ends."""
+    global profile_mode
+    stacks = collections.Counter ()
+    number_samples = 0
+    while profile_mode == 'sampling' and time.monotonic () < profile_deadline:
+        frame = sys._current_frames ().get (main_thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append ('{}:{}'.format (os.path.basename (code.co_filename), code.co_name))
+            frame = frame.f_back
+        stacks [';'.join (reversed (stack))] += 1
+        number_samples += 1
+        time.sleep (SAMPLING_INTERVAL)
+    with mutex:
+        if profile_mode == 'sampling':
+            profile_mode = None
+    # collapsed stacks format, which can be converted to a flame graph
+    lines = ['# {} samples every {} s'.format (number_samples, SAMPLING_INTERVAL)]
+    lines.extend ('{} {}'.format (stack, count) for stack, count in stacks.most_common ())
+    write_result ('sampling', '\n'.join (lines) + '\n')
+
+
+def command_start_profile (mqtt_client: mqtt.Client, seconds: str = '60', mode: str = 'cprofile') -> None:
+    """Starts a profiler.
+
+    :param mqtt_client: mqtt client where log messages are published.
+    :param seconds: duration of the profiling window.
+    :param mode: either ``cprofile`` or ``sampling``.
+    """
+    global profile_mode, profile_deadline
+    if mode not in ('cprofile', 'sampling'):
+        mqtt_client.publish (configuration.TOPIC_LOG, 'unknown profiler {}'.format (mode), qos=2)
+        return
+    with mutex:
+        if profile_mode is not None:
+            mqtt_client.publish (configuration.TOPIC_LOG, 'profiler {} already running'.format (profile_mode), qos=2)
+            return
+        profile_deadline = time.monotonic () + min (float (seconds), MAX_WINDOW)
+        profile_mode = mode
+    if mode == 'sampling':
+        threading.Thread (target=thread_sampling_run, daemon=True).start ()
+    mqtt_client.publish (configuration.TOPIC_LOG, 'started {} profiler'.format (mode), qos=2)
+
+
+def command_stop_profile (mqtt_client: mqtt.Client) -> None:
+    """Stops the running profiler at the next iteration of the main loop.
+
+    :param mqtt_client: mqtt client where log messages are published.
+    """
+    global profile_deadline
+    profile_deadline = 0.0
+    mqtt_client.publish (configuration.TOPIC_LOG, 'stopping profiler', qos=2)
+
+
+def stop_memory_trace () -> None:
+    global memory_snapshot, memory_timer
+    if tracemalloc.is_tracing ():
+        write_memory_snapshot ()
+        tracemalloc.stop ()
+    memory_snapshot = None
+    memory_timer = None
+
+
+def write_memory_snapshot () -> str:
+    """Takes a snapshot of the traced allocations and writes the top
+    allocation sites and the difference to the previous snapshot."""
+    global memory_snapshot
+    snapshot = tracemalloc.take_snapshot ().filter_traces ((
+        tracemalloc.Filter (False, tracemalloc.__file__),
+    ))
+    current, peak = tracemalloc.get_traced_memory ()
+    lines = ['# traced memory {} bytes, peak {} bytes'.format (current, peak), '# top allocations']
+    lines.extend (str (s) for s in snapshot.statistics ('lineno') [:TOP_STATISTICS])
+    if memory_snapshot is not None:
+        lines.append ('# difference to previous snapshot')
+        lines.extend (str (s) for s in snapshot.compare_to (memory_snapshot, 'lineno') [:TOP_STATISTICS])
+    memory_snapshot = snapshot
+    return write_result ('memory', '\n'.join (lines) + '\n')
+
+
+def command_trace_memory (mqtt_client: mqtt.Client, action: str = 'snapshot', seconds: str = '600') -> None:
+    """Controls the memory allocation tracer.
+
+    :param mqtt_client: mqtt client where log messages are published.
+    :param action: ``start`` starts tracing for the given number of seconds,
+        ``snapshot`` writes the top allocations and the difference to the
+        previous snapshot, ``stop`` writes a last snapshot and stops tracing.
+    :param seconds: duration of the tracing window.
+    """
+    global memory_timer
+    if action == 'start':
+        if tracemalloc.is_tracing ():
+            mqtt_client.publish (configuration.TOPIC_LOG, 'memory tracing already running', qos=2)
+            return
+        tracemalloc.start (TRACEMALLOC_FRAMES)
+        memory_timer = threading.Timer (min (float (seconds), MAX_WINDOW), stop_memory_trace)
+        memory_timer.daemon = True
+        memory_timer.start ()
+        mqtt_client.publish (configuration.TOPIC_LOG, 'started memory tracing', qos=2)
+    elif not tracemalloc.is_tracing ():
+        mqtt_client.publish (configuration.TOPIC_LOG, 'memory tracing is not running', qos=2)
+    elif action == 'snapshot':
+        filename = write_memory_snapshot ()
+        mqtt_client.publish (configuration.TOPIC_LOG, 'memory snapshot {}'.format (os.path.basename (filename)), qos=2)
+    elif action == 'stop':
+        if memory_timer is not None:
+            memory_timer.cancel ()
+        stop_memory_trace ()
+        mqtt_client.publish (configuration.TOPIC_LOG, 'stopped memory tracing', qos=2)
+    else:
+        mqtt_client.publish (configuration.TOPIC_LOG, 'unknown memory trace action {}'.format (action), qos=2)
+
+
+def command_get_profile (mqtt_client: mqtt.Client, name: str = None) -> None:
+    """Publishes a result file compressed with gzip on the profiles topic.
+
+    :param mqtt_client: mqtt client where the file is published.
+    :param name: the result file name, by default the most recent result.
+    """
+    filename = last_result if name is None else os.path.join (PROFILES_FOLDER, os.path.basename (name))
+    if filename is None or not os.path.exists (filename):
+        mqtt_client.publish (configuration.TOPIC_LOG, 'profile {} not found'.format (name), qos=2)
+        return
+    with open (filename, 'rb') as fd:
+        content = gzip.compress (fd.read ())
+    mqtt_client.publish (configuration.TOPIC_PROFILES, content, qos=1)
+    mqtt_client.publish (configuration.TOPIC_LOG, 'sent profile {}'.format (os.path.basename (filename)), qos=2)
@@ -0,0 +1,182 @@
+"""
+The sensor data gathered in one iteration of the main loop.
+
+A Sample is filled once per iteration.  The field table FIELDS describes how each field is converted to text and the
+type of its value.  The order of the fields in the MQTT message and in the CSV log is given by MQTT_FIELDS and CSV_FIELDS.
+Function format_sample converts each field to text once and builds both the MQTT message and the CSV row from the same
+strings.
+
+Data order in the MQTT message is important and should match the ExpoLIS server daemon script responsible for saving
+sensor data in the database.
+"""
+import collections
+import datetime
+
+
+class Sample:
+    __slots__ = (
+        'sensor_node_id', 'iteration', 'timestamp',
+        'latitude', 'longitude', 'gps_error', 'gps_fix_age', 'gps_speed',
+        'co_1', 'co_2', 'no2_1', 'no2_2',
+        'co_1_std', 'co_2_std', 'no2_1_std', 'no2_2_std',
+        'co_1_count', 'co_2_count', 'no2_1_count', 'no2_2_count',
+        'pm1_opc', 'pm25_opc', 'pm10_opc', 'pm1_opc_filtered', 'pm25_opc_filtered', 'pm10_opc_filtered',
+        'temperature', 'pressure', 'humidity', 'power',
+        'kp_base', 'kd_base',
+        'acceleration_rms', 'acceleration_peak', 'acceleration_frequency', 'moving',
+        'pm1_honeywell', 'pm25_honeywell', 'pm4_honeywell', 'pm10_honeywell',
+        'sampling_period',
+        'event', 'image_file', 'ip',
+    )
+
+    def __init__ (self):
+        for name in Sample.__slots__:
+            setattr (self, name, -1)
+
+    def set_gps_values (self, values):
+        self.latitude, self.longitude, self.gps_error, self.gps_fix_age, self.gps_speed = values
+
+    def set_other_values (self, values):
+        self.co_1, self.co_2, self.no2_1, self.no2_2, \
+            self.temperature, self.pressure, self.humidity, self.power, \
+            self.acceleration_rms, self.acceleration_peak, self.acceleration_frequency, self.moving, \
+            self.co_1_std, self.co_2_std, self.no2_1_std, self.no2_2_std, \
+            self.co_1_count, self.co_2_count, self.no2_1_count, self.no2_2_count = values
+
+    def set_pms_values (self, values):
+        self.pm1_opc, self.pm25_opc, self.pm10_opc, \
+            self.pm1_opc_filtered, self.pm25_opc_filtered, self.pm10_opc_filtered = values
+
+    def set_honeywell_values (self, values):
+        self.pm1_honeywell, self.pm25_honeywell, self.pm4_honeywell, self.pm10_honeywell = values
+
+
+Field = collections.namedtuple ('Field', ['name', 'attribute', 'to_text', 'binary_format', 'decimal_comma'])
+"""
+Description of a field.
+
+name
+    The field name, also used as the CSV header.
+attribute
+    The Sample attribute holding the field value.
+to_text
+    Function that converts the value to text.
+binary_format
+    The struct format of the value, which gives the type of its column in the sample history, or None if the field is
+    not numeric.
+decimal_comma
+    Whether the decimal point is replaced by a comma in the CSV log.
+"""
+
+
+def number (name, binary_format='f', decimal_comma=True):
+    return Field (name, name, str, binary_format, decimal_comma)
+
+
+FIELDS = [
+    number ('sensor_node_id', 'h'),
+    Field ('sample', 'iteration', str, 'I', True),
+    # the MQTT message uses the default datetime format, which has a space between date and time
+    Field ('date_time_mqtt', 'timestamp', lambda t: str (datetime.datetime.fromtimestamp (t)), 'd', False),
+    Field (
+        'date_time', 'timestamp',
+        lambda t: datetime.datetime.fromtimestamp (t).isoformat (timespec='seconds'), None, False),
+    number ('latitude', 'd'),
+    number ('longitude', 'd'),
+    number ('gps_error'),
+    number ('gps_fix_age'),
+    number ('gps_speed'),
+    number ('co_1'),
+    number ('co_2'),
+    number ('no2_1'),
+    number ('no2_2'),
+    number ('co_1_std'),
+    number ('co_2_std'),
+    number ('no2_1_std'),
+    number ('no2_2_std'),
+    number ('co_1_count', 'i'),
+    number ('co_2_count', 'i'),
+    number ('no2_1_count', 'i'),
+    number ('no2_2_count', 'i'),
+    number ('pm1_opc'),
+    number ('pm25_opc'),
+    number ('pm10_opc'),
+    Field ('pm1_opc_filt', 'pm1_opc_filtered', str, 'f', True),
+    Field ('pm2_opc_filt', 'pm25_opc_filtered', str, 'f', True),
+    Field ('pm_10_opc_filt', 'pm10_opc_filtered', str, 'f', True),
+    number ('temperature'),
+    number ('pressure'),
+    number ('humidity'),
+    number ('power'),
+    number ('kp_base'),
+    number ('kd_base'),
+    number ('acceleration_rms'),
+    number ('acceleration_peak'),
+    number ('acceleration_frequency'),
+    number ('moving', 'b'),
+    Field ('pm1_honwell', 'pm1_honeywell', str, 'h', True),
+    Field ('pm25_honwell', 'pm25_honeywell', str, 'h', True),
+    Field ('pm4_honwell', 'pm4_honeywell', str, 'h', True),
+    Field ('pm10_honwell', 'pm10_honeywell', str, 'h', True),
+    number ('sampling_period', 'i', False),
+    Field ('event', 'event', str, None, True),
+    Field ('image_file', 'image_file', str, None, True),
+    Field ('ip', 'ip', str, None, False),
+]
+
+FIELD_INDEX = {f.name: index for index, f in enumerate (FIELDS)}
+
+MQTT_FIELDS = [
+    'sensor_node_id', 'sample', 'date_time_mqtt',
+    'latitude', 'longitude',
+    'co_1', 'co_2', 'no2_1', 'no2_2',
+    'pm1_opc', 'pm25_opc', 'pm10_opc', 'pm1_opc_filt', 'pm2_opc_filt', 'pm_10_opc_filt',
+    'temperature', 'pressure', 'humidity',
+    'gps_error',
+    'power',
+    'kp_base', 'kd_base',
+    'acceleration_rms', 'acceleration_peak', 'acceleration_frequency', 'moving',
+    'pm1_honwell', 'pm25_honwell', 'pm4_honwell', 'pm10_honwell',
+    'sampling_period',
+    'gps_fix_age', 'gps_speed',
+    'co_1_std', 'co_2_std', 'no2_1_std', 'no2_2_std',
+    'co_1_count', 'co_2_count', 'no2_1_count', 'no2_2_count',
+]
+
+CSV_FIELDS = [
+    'sample', 'date_time',
+    'latitude', 'longitude', 'gps_error',
+    'co_1', 'co_2', 'no2_1', 'no2_2',
+    'pm1_opc', 'pm25_opc', 'pm10_opc', 'pm1_opc_filt', 'pm2_opc_filt', 'pm_10_opc_filt',
+    'temperature', 'pressure', 'humidity',
+    'power', 'kp_base', 'kd_base', 'event', 'image_file',
+    'acceleration_rms', 'acceleration_peak', 'acceleration_frequency', 'moving',
+    'pm1_honwell', 'pm25_honwell', 'pm4_honwell', 'pm10_honwell',
+    'ip', 'sampling_period',
+    'gps_fix_age', 'gps_speed',
+    'co_1_std', 'co_2_std', 'no2_1_std', 'no2_2_std',
+    'co_1_count', 'co_2_count', 'no2_1_count', 'no2_2_count',
+]
+
+CSV_HEADER = ' '.join (CSV_FIELDS)
+
+MQTT_INDEXES = [FIELD_INDEX [name] for name in MQTT_FIELDS]
+CSV_INDEXES = [FIELD_INDEX [name] for name in CSV_FIELDS]
+
+BINARY_FIELDS = [f for f in FIELDS if f.binary_format is not None]
+"""The numeric fields of a sample, in the order of the field table."""
+
+
+def format_sample (sample: Sample):
+    """
+    Convert each field of a sample to text once.
+
+    :return: a tuple with the MQTT message and the CSV row.
+    """
+    texts = [f.to_text (getattr (sample, f.attribute)) for f in FIELDS]
+    message = ' '.join ([texts [index] for index in MQTT_INDEXES])
+    row = ' '.join ([
+        texts [index].replace ('.', ',') if FIELDS [index].decimal_comma else texts [index]
+        for index in CSV_INDEXES
+    ])
+    return message, row
@@ -0,0 +1,115 @@
+"""
+Keeps the most recent samples in memory so that they can be resent when a client misses them.
+
+Samples are stored as numbers in a preallocated column store, one NumPy array per numeric field of the sample field
+table, instead of as formatted MQTT messages.  Float fields are stored as float64, whatever their binary format, so
+that a resent message has the same text as the published one.  A sample takes about 270 bytes, so a day of samples
+fits in about 23 MB.  Messages are formatted only when a sample is resent.  The columns also allow vectorised queries over recent
+data, such as the means of the last hour.
+"""
+import math
+import threading
+import time
+
+import numpy as np
+
+import configuration
+import sample
+
+DTYPES = {
+    'b': np.int8,
+    'h': np.int16,
+    'i': np.int32,
+    'I': np.uint32,
+    'f': np.float64,
+    'd': np.float64,
+}
+
+FIELDS = sample.BINARY_FIELDS
+
+columns = {}
+"""Array with the values of each field indexed by the sample attribute."""
+capacity = 0
+number_samples = 0
+"""Total number of samples appended to the history."""
+mutex = threading.Lock ()
+
+
+def init_history () -> None:
+    global columns, capacity, number_samples
+
+    capacity = int (configuration.HISTORY_HOURS * 3600)
+    columns = {f.attribute: np.zeros (capacity, dtype=DTYPES [f.binary_format]) for f in FIELDS}
+    number_samples = 0
+
+
+def append (a_sample: sample.Sample) -> None:
+    global number_samples
+
+    with mutex:
+        index = number_samples % capacity
+        for f in FIELDS:
+            value = getattr (a_sample, f.attribute)
+            columns [f.attribute][index] = math.nan if value is None else value
+        number_samples += 1
+
+
+def get_sample (iteration: int):
+    """
+    Return the stored sample with the given iteration number, or None if it is no longer in the history.
+    """
+    with mutex:
+        if number_samples == 0:
+            return None
+        last = number_samples - 1
+        # samples are appended with consecutive iteration numbers
+        offset = int (columns ['iteration'][last % capacity]) - iteration
+        if offset < 0 or offset > min (last, capacity - 1):
+            return None
+        index = (last - offset) % capacity
+        if columns ['iteration'][index] != iteration:
+            return None
+        result = sample.Sample ()
+        for f in FIELDS:
+            value = columns [f.attribute][index]
+            if f.binary_format in 'fd':
+                # missing readings are formatted as in the original message
+                value = None if np.isnan (value) else -1 if value == -1 else float (value)
+            else:
+                value = int (value)
+            setattr (result, f.attribute, value)
+    result.timestamp = float (result.timestamp)
+    return result
+
+
+def format_message (iteration: int):
+    """
+    Return the MQTT message of the stored sample with the given iteration number, or None if it is no longer in the
+    history.
+    """
+    a_sample = get_sample (iteration)
+    if a_sample is None:
+        return None
+    message, _row = sample.format_sample (a_sample)
+    return message
+
+
+def means (attributes, seconds: float):
+    """
+    Return the mean of the valid values of the given fields in the samples of the last seconds.
+
+    Values equal to -1, which the sensor modules return when they have no reading, and NaN are ignored.
+
+    :return: a dictionary with the mean of each field, or None if the field has no valid values.
+    """
+    with mutex:
+        count = min (number_samples, capacity)
+        timestamps = columns ['timestamp'][:count]
+        recent = timestamps >= time.time () - seconds
+        selected = {a: columns [a][:count][recent] for a in attributes}
+    result = {}
+    for attribute, values in selected.items ():
+        values = values.astype (np.float64)
+        valid = values [(values != -1) & ~np.isnan (values)]
+        result [attribute] = float (valid.mean ()) if len (valid) > 0 else None
+    return result
@@ -0,0 +1,92 @@
+"""
+Adapts the acquisition and publish periods, and the OPC-N3 duty cycle, to what the vehicle is doing.
+
+The policy has three modes:
+
+moving
+    The vehicle moved recently.  The sensors are read every second and samples are published every
+    publish_rate_period seconds.  The OPC-N3 is always on.
+parked
+    Neither the GPS speed nor the accelerometer showed movement for PARKED_DELAY seconds.  The sensors are read every
+    PARKED_ACQUISITION_PERIOD seconds and samples are published every PARKED_PUBLISH_PERIOD seconds.  The OPC-N3 is
+    on for the first OPC_DUTY_ON seconds of every OPC_DUTY_PERIOD seconds.
+low power
+    The power supply value is below LOW_POWER_VOLTAGE.  The periods are the ones of the parked mode and the OPC-N3 is
+    off.  The mode ends when the power supply value rises LOW_POWER_HYSTERESIS above the threshold.
+
+The mode is updated by function update with the readings of each acquisition.  When adaptive sampling is disabled,
+the mode is always moving.
+"""
+import time
+
+import configuration
+import pms_sensor
+
+MOVING, PARKED, LOW_POWER = range (3)
+MODE_NAMES = ['moving', 'parked', 'low_power']
+
+LOW_POWER_HYSTERESIS = 0.1
+"""Volts above the low power threshold that end the low power mode."""
+
+mode = MOVING
+last_motion = time.monotonic ()
+"""Monotonic clock time of the last reading that showed movement."""
+mode_start = time.monotonic ()
+"""Monotonic clock time at which the current mode started."""
+
+number_mode_changes = 0
+
+
+def acquisition_period () -> int:
+    if mode == MOVING:
+        return 1
+    return configuration.PARKED_ACQUISITION_PERIOD
+
+
+def publish_period () -> int:
+    """
+    Return the publish period, which is always a multiple of the acquisition period.
+    """
+    if mode == MOVING:
+        return configuration.PUBLISH_RATE_PERIOD
+    period = max (configuration.PARKED_PUBLISH_PERIOD, configuration.PUBLISH_RATE_PERIOD)
+    return period - period % acquisition_period () or acquisition_period ()
+
+
+def update (gps_speed, moving, power) -> bool:
+    """
+    Update the mode with the readings of an acquisition and switch the OPC-N3 on or off.
+
+    :param gps_speed: the GPS speed in metres per second, or -1 if there is no fix.
+    :param moving: 1 if the accelerometer detected movement, 0 if not, or -1 if there is no reading.
+    :param power: the power supply value, or -1 if there is no reading.
+    :return: whether the mode changed.
+    """
+    global mode, last_motion, mode_start, number_mode_changes
+
+    if not configuration.ADAPTIVE_SAMPLING:
+        return False
+    now = time.monotonic ()
+    if moving == 1 or (gps_speed is not None and gps_speed > configuration.PARKED_SPEED):
+        last_motion = now
+    if power != -1 and power is not None and power < configuration.LOW_POWER_VOLTAGE:
+        new_mode = LOW_POWER
+    elif mode == LOW_POWER and (power == -1 or power is None or
+                                power < configuration.LOW_POWER_VOLTAGE + LOW_POWER_HYSTERESIS):
+        new_mode = LOW_POWER
+    elif now - last_motion < configuration.PARKED_DELAY:
+        new_mode = MOVING
+    else:
+        new_mode = PARKED
+    changed = new_mode != mode
+    if changed:
+        mode = new_mode
+        mode_start = now
+        number_mode_changes += 1
+    if mode == MOVING:
+        pms_sensor.set_power (True)
+    elif mode == PARKED:
+        pms_sensor.set_power ((now - mode_start) % configuration.OPC_DUTY_PERIOD < configuration.OPC_DUTY_ON)
+    else:
+        pms_sensor.set_power (False)
+    return changed
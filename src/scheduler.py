@@ -0,0 +1,158 @@
+"""
+Runs the periodic tasks of the sensor node on a timer wheel driven by the main loop tick.
+
+Each task is registered with its period in ticks, its cost budget in seconds and the sample fields of its output.  A
+task period may be a function, so that it can follow the acquisition and publish periods chosen by the
+sampling_policy module.  Tasks are kept in the slot of the wheel of the next tick at which they are due, so a tick
+only looks at the tasks of one slot.  Due tasks run in registration order and are rescheduled at the next multiple of
+their period.
+
+The last output of each sensor task is kept.  Function assemble sets the fields of a sample from these outputs, so
+a sample can be assembled at any tick from the latest reading of each sensor, whatever their rates.  An output older
+than the current period of its task, for instance after the sampling policy shortened the period, is left out.
+Sensors that sample faster than the tick, such as the accelerometer, run in their own thread and register a task that
+reduces their samples.
+
+A task that takes longer than its budget is counted as an overrun.  An exception raised by a task is counted and
+printed, and the task output is cleared, so a failing sensor only leaves its fields missing.  The supervisor module
+looks at the consecutive errors of a task to decide whether to restart its sensor.
+"""
+import time
+
+import timing
+
+WHEEL_SIZE = 64
+"""Number of slots of the timer wheel.  Tasks whose period is longer wait several turns of the wheel."""
+
+
+class Task:
+    __slots__ = (
+        'name', 'function', 'period', 'budget', 'fields', 'stage', 'index',
+        'next_tick', 'value', 'value_tick',
+        'runs', 'overruns', 'total_time', 'max_time', 'errors', 'consecutive_errors',
+    )
+
+    def __init__ (self, name, function, period, budget, fields, stage, index):
+        self.name = name
+        self.function = function
+        self.period = period
+        self.budget = budget
+        self.fields = fields
+        self.stage = stage
+        self.index = index
+        self.next_tick = 0
+        self.value = None
+        self.value_tick = -1
+        self.runs = 0
+        self.overruns = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.errors = 0
+        self.consecutive_errors = 0
+
+    def current_period (self) -> int:
+        return max (1, self.period () if callable (self.period) else self.period)
+
+
+wheel = [[] for _ in range (WHEEL_SIZE)]
+tasks = {}
+"""The registered tasks indexed by name."""
+current_tick = 0
+"""The last tick passed to function run."""
+
+verbose = 1
+
+
+def register (name: str, function, period=1, budget=0.1, fields=(), stage=None, first_tick=None) -> Task:
+    """
+    Register a periodic task.
+
+    :param name: the task name.
+    :param function: function without arguments called when the task is due.  Its result is the task output.
+    :param period: the period in ticks, or a function returning the period.
+    :param budget: the time in seconds the task is expected to take.
+    :param fields: names of the sample attributes set by function assemble from the task output, which must be a
+    sequence with a value per field.
+    :param stage: the timing stage where the task duration is recorded, if any.
+    :param first_tick: the tick at which the task runs for the first time, by default the next tick.
+    """
+    if name in tasks:
+        unregister (name)
+    if first_tick is None:
+        first_tick = current_tick + 1
+    task = Task (name, function, period, budget, tuple (fields), stage, len (tasks))
+    task.next_tick = first_tick
+    tasks [name] = task
+    wheel [first_tick % WHEEL_SIZE].append (task)
+    return task
+
+
+def unregister (name: str) -> None:
+    task = tasks.pop (name)
+    for slot in wheel:
+        if task in slot:
+            slot.remove (task)
+
+
+def run (tick: int) -> None:
+    """
+    Run the tasks due at the given tick.
+    """
+    global current_tick
+
+    current_tick = tick
+    slot = wheel [tick % WHEEL_SIZE]
+    due = [task for task in slot if task.next_tick <= tick]
+    if len (due) == 0:
+        return
+    slot [:] = [task for task in slot if task.next_tick > tick]
+    due.sort (key=lambda a_task: a_task.index)
+    for task in due:
+        time_start = time.perf_counter ()
+        try:
+            task.value = task.function ()
+            task.value_tick = tick
+            task.consecutive_errors = 0
+        except Exception as e:
+            task.value = None
+            task.errors += 1
+            task.consecutive_errors += 1
+            print ('Task {} failed: {!r}'.format (task.name, e))
+        finally:
+            duration = time.perf_counter () - time_start
+            task.runs += 1
+            task.total_time += duration
+            if duration > task.max_time:
+                task.max_time = duration
+            if duration > task.budget:
+                task.overruns += 1
+                if verbose > 1:
+                    print ('Task {} took {:.3f} s, budget {:.3f} s'.format (task.name, duration, task.budget))
+            if task.stage is not None:
+                timing.record (task.stage, time_start)
+            # aligning the next run on a multiple of the period keeps the tasks of equal periods together
+            period = task.current_period ()
+            task.next_tick = (tick // period + 1) * period
+            wheel [task.next_tick % WHEEL_SIZE].append (task)
+
+
+def assemble (a_sample) -> None:
+    """
+    Set the fields of a sample from the latest output of each task, unless it is older than the task period.
+    """
+    for task in tasks.values ():
+        if task.fields and task.value is not None and current_tick - task.value_tick < task.current_period ():
+            for name, value in zip (task.fields, task.value):
+                setattr (a_sample, name, value)
+
+
+def statistics ():
+    """
+    :return: a list with a tuple per task containing its name, number of runs, number of overruns, number of errors,
+    mean and maximum duration in seconds.
+    """
+    return [
+        (task.name, task.runs, task.overruns, task.errors,
+         task.total_time / task.runs if task.runs > 0 else 0.0, task.max_time)
+        for task in tasks.values ()
+    ]
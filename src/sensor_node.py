@@ -3,169 +3,400 @@ import pathlib
 
 import configuration as c
 # modules that manage sensors
+import accelerometer_sensor
+import adc_sensor
 import gps_sensor
 import other_sensors
 import pms_sensor
 import pms_sensor_kalman
 import camera_sensor
+import frame_store
 import honeywell_sensor
+import i2c_bus
 
 # other modules
+import aggregation
+import backends
+import brokers
+import bus_trace
+import sample
+import sample_history
 import log
 import commands
+import command_executor
+import compression
 import mqtt_interface
-
+import network_status
+import timing
+import profiling
+import sampling_policy
+import scheduler
+import supervisor
+
+import asyncio
 import collections
+import concurrent.futures
 import datetime
-import netifaces
 import paho.mqtt.client as mqtt
-import threading
+import signal
 import time
-import urllib.error
-import urllib.request
 
 iteration = 1
 iteration_sample = 1
 
-external_ip = ip = 'unknown'
+loop = None  # type: asyncio.AbstractEventLoop
+stop_event = None  # type: asyncio.Event
+"""Set to stop the main loop."""
+finished = False
+
+io_executor = concurrent.futures.ThreadPoolExecutor (max_workers=1, thread_name_prefix='sensor_io')
+"""Runs the main loop tick, so that the blocking sensor drivers do not block the event loop."""
 
-stop_main_thread = False
+THREAD_JOIN_TIMEOUT = 2.0
 
 events_description = collections.deque ()
 
 verbose = 3
 
-sensor_data_id = collections.deque (maxlen=3600)
-sensor_data_message = collections.deque (maxlen=3600)
+PING_MEANS = ['co_1', 'co_2', 'no2_1', 'no2_2', 'pm25_opc', 'temperature']
+"""Fields whose last hour mean is sent in the PING message."""
+
+PING_PERIOD = 10
+"""Period in seconds of the PING message."""
+
+background = {}
+"""The coroutines run in the background by the event loop, indexed by name."""
+
+last_tick_time = 0.0
+"""Monotonic clock time at which the last main loop tick ended."""
+
+sample_time = 0.0
+"""Monotonic clock time at which the current main loop tick started, the time the sensor readings are sampled at."""
+
+sample_timestamp = 0.0
+"""Unix time of the same instant as sample_time, the timestamp of the published sample."""
 
 path_do_not_sent_file = pathlib.Path ('/home/pi/SensorNode/do-not-sent-file')
 
 
 def main ():
-    global iteration
+    try:
+        asyncio.run (main_async ())
+    finally:
+        finish ()
+
+
+async def main_async ():
+    """
+    Run the sensor node on the event loop until a KILL command or a termination signal.
+
+    The main loop tick runs in the sensor I/O executor, as the sensor drivers block.  The MQTT clients, the network
+    monitor and the supervisor are coroutines of the event loop.  When the node stops, they are cancelled, and the MQTT
+    clients send their queued messages before disconnecting.
+    """
+    init_node ()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler (signal_number, stop_event.set)
+    start_background ('brokers', mqtt_interface.broker_monitor)
+    start_background ('network_status', network_status.monitor)
+    init_supervisor ()
+    supervisor_task = loop.create_task (supervisor.monitor ())
+    if verbose > 0:
+        print ('Entering main loop...')
+    try:
+        await tick_loop ()
+    finally:
+        await close_node (supervisor_task)
+
+
+def init_node ():
+    """
+    Open the devices with the configured backend, initialise the sensors, the log and the MQTT clients, register the
+    periodic tasks and start the MQTT clients in the running event loop.
+    """
+    global loop, stop_event
+    loop = asyncio.get_event_loop ()
+    stop_event = asyncio.Event ()
     if verbose > 0:
         print ('Initialising GPS sensor...')
+    bus_trace.init_trace (c.BUS_TRACE)
+    backends.init_backend (c.DEVICE_BACKEND, c.DEVICE_TRACE)
+    i2c_bus.init_bus ()
     gps_sensor.init_gps ()
+    accelerometer_sensor.init_sensor ()
+    adc_sensor.init_sensor ()
+    try:
+        other_sensors.init_sensors ()
+    except (OSError, ValueError) as e:
+        # the supervisor opens them again
+        print ('Failed to open the I2C sensors: {}'.format (e))
     pms_sensor.init_sensor ()
     camera_sensor.init_camera()
+    frame_store.init_frame_store ()
     honeywell_sensor.init_sensor()
     log.init_log ()
-    mqtt_interface.init_mqtt_interface (on_message)
-    if verbose > 0:
-        print ('Entering main loop...')
-    while not stop_main_thread:
-        if verbose > 2:
-            print ('Main loop {}'.format (iteration))
-        time_before = time.time ()
-        step ()
-        time_after = time.time ()
-        time_left = 1 - (time_after - time_before)
+    sample_history.init_history ()
+    mqtt_interface.init_mqtt_interface (on_message, loop)
+    init_tasks ()
+    start_background ('mqtt_private', mqtt_interface.network_loop, mqtt_interface.client_private)
+    start_background ('mqtt_public', mqtt_interface.network_loop, mqtt_interface.client_public)
+
+
+async def close_node (*tasks):
+    """
+    Cancel the given tasks and the background coroutines, and close the MQTT clients.
+    """
+    tasks = list (tasks) + list (background.values ())
+    for task in tasks:
+        task.cancel ()
+    await asyncio.gather (*tasks, return_exceptions=True)
+    await mqtt_interface.close ()
+
+
+def start_background (name, function, *args):
+    """
+    Run a coroutine in the background, replacing the previous run of the same name.
+    """
+    background [name] = loop.create_task (function (*args))
+
+
+def is_background_healthy (name):
+    """
+    Return whether a background coroutine is running or ended without an exception.
+    """
+    task = background [name]
+    return not task.done () or task.cancelled () or task.exception () is None
+
+
+async def tick_loop ():
+    global iteration
+    next_tick = loop.time ()
+    while not stop_event.is_set ():
+        await loop.run_in_executor (io_executor, tick)
+        iteration += 1
+        next_tick += 1
+        time_left = next_tick - loop.time ()
         if verbose > 4:
             print ('Time left in iteration {}.'.format (time_left))
-        if time_left > 0:
-            time.sleep (time_left)
-        iteration += 1
-    finish ()
+        if time_left < 0:
+            # we are late, do not try to catch up with a burst of ticks
+            next_tick = loop.time ()
+            time_left = 0
+        try:
+            await asyncio.wait_for (stop_event.wait (), time_left)
+        except asyncio.TimeoutError:
+            pass
+
+
+def tick ():
+    global last_tick_time, sample_time, sample_timestamp
+    sample_timestamp = time.time ()
+    sample_time = time.monotonic ()
+    if verbose > 2:
+        print ('Main loop {}'.format (iteration))
+    profiling.step_profiling ()
+    time_before = time.perf_counter ()
+    step ()
+    timing.record (timing.STAGE_STEP, time_before)
+    timing.step_timing (mqtt_interface.client_public, mqtt_interface.client_private)
+    last_tick_time = time.monotonic ()
+
+
+def init_tasks ():
+    """
+    Register the periodic tasks of the sensor node in the scheduler.
+
+    The sensor tasks run every acquisition period and are registered before the acquire and publish tasks, so that
+    these find the readings of the same tick.
+    """
+    def register_sensor (name, module, function, stage):
+        scheduler.register (
+            name, function,
+            period=lambda: module.TASK_PERIOD * sampling_policy.acquisition_period (),
+            budget=module.TASK_BUDGET, fields=module.TASK_FIELDS, stage=stage)
+
+    scheduler.register ('heartbeat', lambda: print ('sensor_node.step()'), period=60, budget=0.001, first_tick=60)
+    scheduler.register ('ping', task_ping, period=PING_PERIOD, budget=0.01, first_tick=PING_PERIOD)
+    register_sensor ('gps', gps_sensor, lambda: gps_sensor.get_values (sample_time), timing.STAGE_GPS)
+    register_sensor ('other_sensors', other_sensors, other_sensors.get_values, timing.STAGE_OTHER_SENSORS)
+    register_sensor (
+        'opc', pms_sensor,
+        lambda: pms_sensor.get_values (sampling_period=sampling_policy.acquisition_period ()),
+        timing.STAGE_OPC)
+    register_sensor (
+        'honeywell', honeywell_sensor, lambda: honeywell_sensor.get_values (debug=True), timing.STAGE_HONEYWELL)
+    scheduler.register ('acquire', task_acquire, period=sampling_policy.acquisition_period, budget=0.01)
+    scheduler.register ('publish', task_publish, period=sampling_policy.publish_period, budget=0.1)
+    scheduler.register (
+        'camera', lambda: camera_sensor.step_camera (iteration),
+        period=lambda: camera_sensor.capture_frames_period, budget=camera_sensor.TASK_BUDGET)
+    scheduler.register (
+        'task_telemetry', task_telemetry, period=c.TELEMETRY_PERIOD * 60, budget=0.01,
+        first_tick=c.TELEMETRY_PERIOD * 60)
+
+
+def init_supervisor ():
+    """
+    Register the subsystems watched by the supervisor.
+
+    Sensors with their own thread check the thread.  The I2C sensors read by the main loop are unhealthy when their
+    task failed.  The background coroutines are unhealthy when they ended with an exception, and are restarted in the
+    event loop.
+    """
+    def is_task_healthy (name):
+        return lambda: scheduler.tasks [name].consecutive_errors == 0
+
+    def restart_background (name, function, *args):
+        return lambda: loop.call_soon_threadsafe (start_background, name, function, *args)
+
+    supervisor.heartbeat = lambda: last_tick_time
+    supervisor.report = publish_log
+    supervisor.register ('gps', gps_sensor.is_healthy, gps_sensor.restart)
+    supervisor.register ('accelerometer', accelerometer_sensor.is_healthy, accelerometer_sensor.restart)
+    if c.ADC_CONTINUOUS:
+        supervisor.register ('adc', adc_sensor.is_healthy, adc_sensor.restart)
+    supervisor.register ('i2c_sensors', is_task_healthy ('other_sensors'), other_sensors.init_sensors)
+    supervisor.register (
+        'opc', lambda: pms_sensor.is_healthy () and scheduler.tasks ['opc'].consecutive_errors == 0,
+        pms_sensor.restart)
+    supervisor.register ('honeywell', honeywell_sensor.is_healthy, honeywell_sensor.restart)
+    supervisor.register ('log', log.is_healthy, log.restart_log)
+    supervisor.register (
+        'mqtt_private', lambda: is_background_healthy ('mqtt_private'),
+        restart_background ('mqtt_private', mqtt_interface.network_loop, mqtt_interface.client_private))
+    supervisor.register (
+        'mqtt_public', lambda: is_background_healthy ('mqtt_public'),
+        restart_background ('mqtt_public', mqtt_interface.network_loop, mqtt_interface.client_public))
+    supervisor.register (
+        'brokers', lambda: is_background_healthy ('brokers'),
+        restart_background ('brokers', mqtt_interface.broker_monitor))
+    supervisor.register (
+        'network_status', lambda: is_background_healthy ('network_status'),
+        restart_background ('network_status', network_status.monitor))
 
 
 def step ():
-    global iteration, iteration_sample
-
-    if iteration % 60 == 0:
-        print ('sensor_node.step()')
-    if iteration % 30 == 0:
-        threading.Thread (target=thread_get_ip_run).start ()
-    if iteration % 10 == 0:
-        # TODO: compute log_msg
-        msg = 'PING {} {} {}{}__id_{}'.format (
-            ip, external_ip,
-            '_csv' if log.log_data else '',
-            '_img' if camera_sensor.capture_frames else '',
-            iteration_sample)
-        mqtt_interface.client_public.publish (c.TOPIC_MANAGEMENT, msg, qos=2)
-        mqtt_interface.client_private.publish (c.TOPIC_MANAGEMENT, msg, qos=2)
-
-    if iteration % c.PUBLISH_RATE_PERIOD != 0:
-        return
-    
-    timestamp = datetime.datetime.timestamp (datetime.datetime.now ())
-    gps_values = gps_sensor.get_values ()
-    other_values = other_sensors.get_values ()
-    pms_values = pms_sensor.get_values (sampling_period=c.PUBLISH_RATE_PERIOD)
-    pm_honeywell_values = honeywell_sensor.get_values(debug=True)
-    #print(pm_honeywell_values)
-    if verbose > 2:
-        # print ('{} {} {}'.format (gps_values, other_values, pms_values))
-        pass
+    scheduler.run (iteration)
+
+
+def publish_log (msg):
+    mqtt_interface.client_public.publish (c.TOPIC_LOG, msg, qos=2)
+    mqtt_interface.client_private.publish (c.TOPIC_LOG, msg, qos=2)
+
+
+def task_ping ():
+    msg = 'PING {} {} {}{}__id_{}'.format (
+        network_status.ip, network_status.external_ip,
+        '_csv' if log.log_data else '',
+        '_img' if camera_sensor.capture_frames else '',
+        iteration_sample)
+    for name, value in sample_history.means (PING_MEANS, 3600).items ():
+        if value is not None:
+            msg += ' {}={:.3f}'.format (name, value)
+    mqtt_interface.client_public.publish (c.TOPIC_MANAGEMENT, msg, qos=2)
+    mqtt_interface.client_private.publish (c.TOPIC_MANAGEMENT, msg, qos=2)
+
+
+def task_telemetry ():
+    msg = 'TASKS ' + ' '.join (
+        '{}:n={},overruns={},errors={},mean={:.4f},max={:.4f}'.format (*task_statistics)
+        for task_statistics in scheduler.statistics ())
+    mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    msg = 'BROKERS ' + brokers.statistics ()
+    mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    msg = 'I2C timeouts={} '.format (i2c_bus.number_timeouts) + ' '.join (
+        '{}:n={},errors={},mean={:.5f},max={:.5f},wait_mean={:.5f},wait_max={:.5f}'.format (*device_statistics)
+        for device_statistics in i2c_bus.statistics ())
+    mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    gps_statistics = gps_sensor.parser_statistics ()
+    if gps_statistics is not None:
+        msg = 'GPS bytes={bytes_received} parsed={sentences_parsed} dropped={sentences_dropped} ' \
+              'parse_time={parse_time:.3f} rate={sentences_per_second:.0f}'.format (**gps_statistics)
+        mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+        mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    if bus_trace.enabled:
+        msg = 'BUS ' + ' '.join (
+            '{}:n={},bytes_out={},bytes_in={},errors={},timeouts={},idle={},mean={:.6f},p50={},p95={},'
+            'max={:.6f}'.format (*device_statistics)
+            for device_statistics in bus_trace.statistics ())
+        mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+        mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    if c.COMPRESSION:
+        msg = 'COMPRESSION ' + compression.statistics ()
+        mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+        mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    msg = 'OPC ' + pms_sensor.statistics ()
+    mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    msg = 'SUPERVISOR ' + ' '.join (
+        '{}:state={},failures={},restarts={},restart_errors={},last={:.1f},mean={:.1f},max={:.1f}'.format (
+            *subsystem_statistics)
+        for subsystem_statistics in supervisor.statistics ())
+    mqtt_interface.client_public.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+    mqtt_interface.client_private.publish (c.TOPIC_TELEMETRY, msg, qos=1)
+
+
+def task_acquire ():
+    """
+    Assemble a sub-sample from the sensor readings, update the sampling policy and aggregate the sub-sample when the
+    publish period is longer than the acquisition period.
+    """
+    sub_sample = sample.Sample ()
+    scheduler.assemble (sub_sample)
+    if sampling_policy.update (sub_sample.gps_speed, sub_sample.moving, sub_sample.power):
+        msg = 'sampling mode {}'.format (sampling_policy.MODE_NAMES [sampling_policy.mode])
+        mqtt_interface.client_public.publish (c.TOPIC_LOG, msg, qos=2)
+        mqtt_interface.client_private.publish (c.TOPIC_LOG, msg, qos=2)
+    if sampling_policy.publish_period () > sampling_policy.acquisition_period () or aggregation.number_sub_samples > 0:
+        aggregation.add (sub_sample)
+
+
+def task_publish ():
+    global iteration_sample
+
+    t = time.perf_counter ()
+    a_sample = sample.Sample ()
+    scheduler.assemble (a_sample)
+    statistics = aggregation.reduce (a_sample) if aggregation.number_sub_samples > 0 else None
+    a_sample.sensor_node_id = c.SENSOR_NODE_ID
+    a_sample.iteration = iteration_sample
+    a_sample.timestamp = sample_timestamp
+    a_sample.kp_base = pms_sensor_kalman.kp_base
+    a_sample.kd_base = pms_sensor_kalman.kd_base
+    a_sample.sampling_period = sampling_policy.publish_period ()
+    a_sample.event = events_description.pop () if len (events_description) > 0 else 'none'
+    a_sample.image_file = camera_sensor.image_file
+    a_sample.ip = network_status.external_ip
     # region publish sensor data
-    latitude, longitude, gps_error = gps_values
-    gas_co_value_1, gas_co_value_2, gas_no2_value_1, gas_no2_value_2, temperature_value, pressure_value, humidity_value, power_supply_value, acceleration_value_1, acceleration_value_2, acceleration_value_3 = other_values
-    fields_new = [
-        c.SENSOR_NODE_ID,
-        iteration_sample,
-        datetime.datetime.fromtimestamp (timestamp),
-        latitude, longitude,
-        gas_co_value_1, gas_co_value_2, gas_no2_value_1, gas_no2_value_2,
-    ] + list (pms_values) + [
-        temperature_value, pressure_value, humidity_value,
-        gps_error,
-        power_supply_value,
-        pms_sensor_kalman.kp_base, pms_sensor_kalman.kd_base,
-        acceleration_value_1, acceleration_value_2, acceleration_value_3,
-    ] + list(pm_honeywell_values) + [
-        c.PUBLISH_RATE_PERIOD
-    ]
-    fields = fields_new
-    msg = ' '.join ([str (e) for e in fields])
-    mqtt_interface.client_public.publish (c.TOPIC_SENSOR_DATA, msg, qos=2)
-    mqtt_interface.client_private.publish (c.TOPIC_SENSOR_DATA, msg, qos=2)
+    msg, csv_row = sample.format_sample (a_sample)
+    topic = c.TOPIC_SENSOR_DATA
+    msg_publish = msg
+    if c.COMPRESSION:
+        is_keyframe, msg_publish = compression.encode (msg, c.KEYFRAME_PERIOD)
+        if not is_keyframe:
+            topic = c.TOPIC_SENSOR_DELTAS
+    t = timing.record (timing.STAGE_FORMAT, t)
+    mqtt_interface.client_public.publish (topic, msg_publish, qos=2)
+    t = timing.record (timing.STAGE_PUBLISH_PUBLIC, t)
+    mqtt_interface.client_private.publish (topic, msg_publish, qos=2)
+    t = timing.record (timing.STAGE_PUBLISH_PRIVATE, t)
+    if statistics is not None:
+        msg_aggregates = aggregation.format_aggregates (a_sample, statistics)
+        mqtt_interface.client_public.publish (c.TOPIC_SENSOR_AGGREGATES, msg_aggregates, qos=2)
+        mqtt_interface.client_private.publish (c.TOPIC_SENSOR_AGGREGATES, msg_aggregates, qos=2)
     # endregion
-    sensor_data_id.append (iteration_sample)
-    sensor_data_message.append (msg)
-    log.step_log_csv (
-        iteration=iteration_sample,
-        step_timestamp=timestamp,
-        gps_data=gps_values,
-        pms_data=pms_values,
-        pm_honeywell_data=pm_honeywell_values,
-        other_sensor_data=other_values,
-        event=events_description.pop () if len (events_description) > 0 else 'none',
-        image_file=camera_sensor.image_file,
-        ip=external_ip,
-        sampling_period=c.PUBLISH_RATE_PERIOD)
+    sample_history.append (a_sample)
+    log.step_log_csv (csv_row)
+    timing.record (timing.STAGE_LOG_CSV, t)
     iteration_sample += 1
 
 
-def thread_get_ip_run ():
-    global ip
-    global external_ip
-
-    if verbose > 2 and 'wlan0' in netifaces.interfaces ():
-        r = netifaces.ifaddresses ('wlan0')
-        print (r)
-    # noinspection SpellCheckingInspection
-    if 'uap0' in netifaces.interfaces () and netifaces.AF_INET in netifaces.ifaddresses ('uap0'):
-        ip = netifaces.ifaddresses ('uap0')[netifaces.AF_INET][0]['addr']
-    else:
-        ip = 'unavailable'
-
-    external_ip = 'unavailable'
-    try:
-        # external_ip = urllib.request.urlopen ('https://ident.me').read ().decode ('utf8')
-        external_ip = urllib.request.urlopen ('https://v4.ident.me').read ().decode ('utf8')
-    except urllib.error.URLError:
-        pass
-    except Exception as e:
-        print ('????')
-        print (e)
-        print (type (e))
-    if verbose > 0:
-        print ("IP: " + ip + " Public IP: " + external_ip)
-
-
-def thread_resend_run (*intervals):
+def command_resend (_mqtt_client: mqtt.Client, *intervals):
     if verbose > 0:
-        print ('Thread resend')
+        print ('Resend')
     for an_interval in intervals:
         limits = an_interval.split ('-')
         if int (limits[0]) > iteration:
@@ -175,21 +406,12 @@ def thread_resend_run (*intervals):
             index_from = int (limits [0])
             index_to = int (limits [1])
             for an_index in range (index_from, index_to + 1):
-                try:
-                    msg = sensor_data_message[sensor_data_id.index (an_index)]
+                msg = sample_history.format_message (an_index)
+                if msg is not None:
                     if verbose > 1:
                         print ('Resending: {}'.format (msg))
                     mqtt_interface.client_public.publish (c.TOPIC_SENSOR_DATA, msg, qos=2)
                     mqtt_interface.client_private.publish (c.TOPIC_SENSOR_DATA, msg, qos=2)
-                except ValueError:
-                    pass
-
-
-def command_resend (_mqtt_client: mqtt.Client, *intervals):
-    threading.Thread (
-        target=thread_resend_run,
-        args=intervals
-    ).start ()
 
 
 def command_register_event (mqtt_client: mqtt.Client, an_event_description):
@@ -199,11 +421,18 @@ def command_register_event (mqtt_client: mqtt.Client, an_event_description):
     mqtt_client.publish (c.TOPIC_LOG, 'received event register', qos=2)
 
 
+def command_dump_bus_trace (mqtt_client: mqtt.Client):
+    if not bus_trace.enabled:
+        mqtt_client.publish (c.TOPIC_LOG, 'bus trace is disabled', qos=2)
+        return
+    filename = bus_trace.dump (c.TRACES_FOLDER)
+    mqtt_client.publish (c.TOPIC_LOG, 'bus trace written to {}'.format (filename), qos=2)
+
+
 def command_kill (mqtt_client: mqtt.Client):
-    global stop_main_thread
     print("received kill command")
     mqtt_client.publish (c.TOPIC_LOG, 'received process kill', qos=2)
-    stop_main_thread = True
+    loop.call_soon_threadsafe (stop_event.set)
 
 
 def command_change_sample_period (mqtt_client: mqtt.Client, new_sample_period):
@@ -232,59 +461,82 @@ def on_message (mqtt_client, _user_data, message):
         if function is None:
             print ('Command {} not implemented!'.format (cmd))
         else:
-            if verbose > 0:
-                print ('*************** Running [{}]...'.format (' '.join (command_line)))
-            try:
-                function (mqtt_client, *args)
-            except TypeError as e:
-                print ('--------------- error {}'.format (e))
+            command_executor.submit (mqtt_client, cmd, function, args)
     else:
         print ('Unknown command: {}.'.format (cmd))
 
 
 def finish ():
-    pms_sensor.laser_off ()
-    pms_sensor.fan_off ()
+    """
+    Stop the sensor threads and wait for them, switch off the OPC-N3 and close the log.
+
+    Called once, after the event loop has stopped, or if the initialisation failed.
+    """
+    global finished
+    if finished:
+        return
+    finished = True
     gps_sensor.stop_update_gps_thread = True
-    print ('Stopped sensor node.')
-    mqtt_interface.client_private.loop_stop ()
-    mqtt_interface.client_public.loop_stop ()
+    accelerometer_sensor.stop_sample_thread = True
+    adc_sensor.stop_sample_thread = True
+    honeywell_sensor.stop_read_thread = True
+    io_executor.shutdown (wait=True)
+    for a_thread in (
+            gps_sensor.update_thread,
+            accelerometer_sensor.sample_thread,
+            adc_sensor.sample_thread,
+            honeywell_sensor.read_thread):
+        if a_thread is not None:
+            a_thread.join (THREAD_JOIN_TIMEOUT)
+    pms_sensor.stop ()
+    if bus_trace.recording is not None:
+        print ('Bus recording written to {}'.format (bus_trace.write_recording (c.TRACES_FOLDER)))
+    elif bus_trace.enabled:
+        print ('Bus trace written to {}'.format (bus_trace.dump (c.TRACES_FOLDER)))
     log.finish_log ()
+    command_executor.shutdown ()
+    print ('Stopped sensor node.')
 
 
-if __name__ == '__main__':
-    # noinspection SpellCheckingInspection
-    MQTT_COMMANDS = {
-        'PING': commands.command_ping,
-        'SET_TIMEDATE': commands.command_set_time,
-        'RESEND': command_resend,
-        'TEST_FILTER': pms_sensor_kalman.command_test_filter,
-        'SAVE_FILTER': pms_sensor_kalman.command_save_filter,
-        'REGISTER_EVENT': command_register_event,
-        'DELETE_FRAMES': None,
-        'DELETE_LOGS': log.command_delete_logs,
-        'POWER_OFF': commands.command_power_off,
-        'REBOOT': commands.command_reboot,
-        'SET_WIFI': commands.command_set_wifi,
-        'KILL': command_kill,
-        'START_CAPTURE_FRAMES': command_change_sample_period, # ...
-        'STOP_CAPTURE_FRAMES': None,
-        'GET_ONE_FRAME': camera_sensor.command_get_one_frame,
-        'GET_NEXT_FRAME': None,
-        'GET_PREVIOUS_FRAME': None,
-        'GET_NEXT_LOG': log.command_get_next_log,
-        'GET_PREVIOUS_LOG': log.command_get_previous_log,
-        'GET_ALL_FRAMES': None,
-        'GET_ALL_LOGS': log.command_get_all_logs,
-        'PUBLISH_PRIVATE': None,
-        'PUBLISH_PUBLIC': None,
-        'STOP_SENSORS': pms_sensor.command_start_sensors,
-        'START_SENSORS': pms_sensor.command_stop_sensors,
-        'STOP_LOGGING': log.command_stop_logging,
-        'START_LOGGING': start_log_command,
-        'SET_SAMPLING_PERIOD': set_sampling_period,
-    }
+# noinspection SpellCheckingInspection
+MQTT_COMMANDS = {
+    'PING': commands.command_ping,
+    'SET_TIMEDATE': commands.command_set_time,
+    'RESEND': command_resend,
+    'TEST_FILTER': pms_sensor_kalman.command_test_filter,
+    'SAVE_FILTER': pms_sensor_kalman.command_save_filter,
+    'REGISTER_EVENT': command_register_event,
+    'DELETE_FRAMES': frame_store.command_delete_frames,
+    'DELETE_LOGS': log.command_delete_logs,
+    'POWER_OFF': commands.command_power_off,
+    'REBOOT': commands.command_reboot,
+    'SET_WIFI': commands.command_set_wifi,
+    'KILL': command_kill,
+    'START_CAPTURE_FRAMES': command_change_sample_period, # ...
+    'STOP_CAPTURE_FRAMES': None,
+    'GET_ONE_FRAME': camera_sensor.command_get_one_frame,
+    'GET_NEXT_FRAME': frame_store.command_get_next_frame,
+    'GET_PREVIOUS_FRAME': frame_store.command_get_previous_frame,
+    'GET_NEXT_LOG': log.command_get_next_log,
+    'GET_PREVIOUS_LOG': log.command_get_previous_log,
+    'GET_ALL_FRAMES': frame_store.command_get_all_frames,
+    'GET_ALL_LOGS': log.command_get_all_logs,
+    'PUBLISH_PRIVATE': None,
+    'PUBLISH_PUBLIC': None,
+    'STOP_SENSORS': pms_sensor.command_stop_sensors,
+    'START_SENSORS': pms_sensor.command_start_sensors,
+    'STOP_LOGGING': log.command_stop_logging,
+    'START_LOGGING': start_log_command,
+    'SET_SAMPLING_PERIOD': set_sampling_period,
+    'START_PROFILE': profiling.command_start_profile,
+    'DUMP_BUS_TRACE': command_dump_bus_trace,
+    'STOP_PROFILE': profiling.command_stop_profile,
+    'TRACE_MEMORY': profiling.command_trace_memory,
+    'GET_PROFILE': profiling.command_get_profile,
+}
+
 
+if __name__ == '__main__':
     try:
         main ()
     except (InterruptedError, KeyboardInterrupt):
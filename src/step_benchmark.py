@@ -0,0 +1,119 @@
+"""
+Runs the sensor node on a computer against a recording of its devices and measures the main loop.
+
+The devices are opened with the replay backend of module backends, which answers with the transfers of the given trace
+file, written by a sensor node with option device_backend set to record.  Both MQTT clients connect to an MQTT
+stand-in listening on the given port of this computer, by default 18830, so that the messages the node publishes are
+sent over a socket as on the sensor node.  The port is not the standard MQTT port, so that the stand-in does not clash
+with a local MQTT broker.  The storage folder is a temporary folder.
+
+The script runs the given number of main loop ticks, one every tick_ms milliseconds, or back to back if tick_ms is 0.
+It prints the 50th, 95th and 99th percentiles and the maximum of the tick duration in milliseconds, the number of ticks
+per second, the messages and bytes per second received by the stand-in, the statistics of the scheduler tasks and the
+number of replayed transfers.
+
+Usage:
+
+    python3 step_benchmark.py trace_file [ticks [tick_ms [port]]]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import mqtt_standin
+
+CONNECT_TIMEOUT = 5.0
+
+CONFIGURATION = """[BASE]
+mqtt_broker = 127.0.0.1:{port}
+storage = {storage}
+sensor_node_id = 0
+publish_rate_period = 1
+kp = 20.0
+kd = 50.0
+log_csv_boot = False
+log_img_boot = False
+device_backend = replay
+device_trace = {trace_file}
+"""
+
+
+def percentile (values, fraction: float) -> float:
+    return values [min (len (values) - 1, int (fraction * len (values)))]
+
+
+async def run (trace_file: str, ticks: int, tick: float, port: int, storage: str) -> None:
+    for folder in ('logs', 'images'):
+        os.makedirs (os.path.join (storage, folder))
+    config_path = os.path.join (storage, 'Sensor_Node.ini')
+    with open (config_path, 'w') as fd:
+        fd.write (CONFIGURATION.format (port=port, storage=storage, trace_file=os.path.abspath (trace_file)))
+    os.environ ['SENSOR_NODE_CONFIG'] = config_path
+    # the configuration is read when the sensor node modules are imported
+    import backends
+    import mqtt_interface
+    import scheduler
+    import sensor_node
+
+    sensor_node.verbose = 0
+    stand_in = mqtt_standin.StandIn (port)
+    await stand_in.start ()
+    sensor_node.init_node ()
+    loop = asyncio.get_event_loop ()
+    deadline = loop.time () + CONNECT_TIMEOUT
+    clients = (mqtt_interface.client_private, mqtt_interface.client_public)
+    while not all (mqtt_client.is_connected () for mqtt_client in clients) and loop.time () < deadline:
+        await asyncio.sleep (0.05)
+    received = len (stand_in.messages)
+    durations = []
+    start = time.perf_counter ()
+    next_tick = loop.time ()
+    try:
+        for _ in range (ticks):
+            before = time.perf_counter ()
+            await loop.run_in_executor (sensor_node.io_executor, sensor_node.tick)
+            durations.append (time.perf_counter () - before)
+            sensor_node.iteration += 1
+            next_tick += tick
+            await asyncio.sleep (max (0.0, next_tick - loop.time ()))
+        elapsed = time.perf_counter () - start
+        messages = stand_in.messages [received:]
+    finally:
+        await sensor_node.close_node ()
+        await stand_in.stop ()
+    durations.sort ()
+    print ('{:>8} {:>8} {:>8} {:>8} {:>8}'.format ('p50', 'p95', 'p99', 'max', 'ticks/s'))
+    print ('{:8.3f} {:8.3f} {:8.3f} {:8.3f} {:8.2f}'.format (
+        *(1000 * percentile (durations, fraction) for fraction in (0.5, 0.95, 0.99, 1.0)), len (durations) / elapsed))
+    print ('{:.1f} messages/s {:.0f} bytes/s'.format (
+        len (messages) / elapsed, sum (len (payload) for _topic, payload, _qos in messages) / elapsed))
+    print ()
+    print ('{:16} {:>6} {:>8} {:>6} {:>8} {:>8}'.format ('task', 'runs', 'overruns', 'errors', 'mean', 'max'))
+    for name, runs, overruns, errors, mean, maximum in scheduler.statistics ():
+        print ('{:16} {:6d} {:8d} {:6d} {:8.3f} {:8.3f}'.format (
+            name, runs, overruns, errors, 1000 * mean, 1000 * maximum))
+    print ()
+    print ('transfers replayed={} skipped={} exhausted={}'.format (
+        backends.number_replayed, backends.number_skipped, backends.number_exhausted))
+
+
+def main ():
+    if len (sys.argv) < 2:
+        print (__doc__)
+        sys.exit (1)
+    trace_file = sys.argv [1]
+    ticks = int (sys.argv [2]) if len (sys.argv) > 2 else 60
+    tick = float (sys.argv [3]) / 1000 if len (sys.argv) > 3 else 1.0
+    port = int (sys.argv [4]) if len (sys.argv) > 4 else 18830
+    with tempfile.TemporaryDirectory () as storage:
+        try:
+            asyncio.run (run (trace_file, ticks, tick, port, storage))
+        finally:
+            import sensor_node
+            sensor_node.finish ()
+
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,157 @@
+"""
+Watches the subsystems of the sensor node and restarts the ones that fail, without restarting the others.
+
+Each subsystem is registered with a health check and a restart function.  Coroutine monitor, run by the event loop of
+the sensor node, calls the health checks every CHECK_PERIOD seconds.  Health checks run in the event loop thread, so
+they must only look at flags, counters and timestamps kept by the subsystem.  A subsystem that is unhealthy for longer
+than its grace time is restarted in the default executor, as restarts open devices and wait for them.  If it is still
+unhealthy after a restart, it is restarted again after a backoff that doubles up to RESTART_MAX seconds.  The time from
+the failure until the subsystem is healthy again is its recovery time.
+
+The monitor also touches the watchdog file while the main loop is ticking.  The cron script only kills the process when
+the file is not touched, that is, when the main loop or the event loop is stuck.
+"""
+import asyncio
+import time
+from typing import Callable, Optional
+
+import configuration
+
+CHECK_PERIOD = 2.0
+"""Time in seconds between health checks."""
+
+RESTART_MIN = 5.0
+RESTART_MAX = 300.0
+
+WATCHDOG_TIMEOUT = 30.0
+"""Time in seconds without a main loop tick after which the watchdog file is no longer touched."""
+
+OK, FAILED, RESTARTING = range (3)
+STATE_NAMES = ['ok', 'failed', 'restarting']
+
+
+class Subsystem:
+    __slots__ = (
+        'name', 'check', 'restart', 'grace',
+        'state', 'failed_since', 'next_restart', 'backoff',
+        'number_failures', 'number_restarts', 'number_restart_errors',
+        'last_recovery_time', 'total_recovery_time', 'max_recovery_time',
+    )
+
+    def __init__ (self, name, check, restart, grace):
+        self.name = name
+        self.check = check
+        self.restart = restart
+        self.grace = grace
+        self.state = OK
+        self.failed_since = 0.0
+        self.next_restart = 0.0
+        self.backoff = RESTART_MIN
+        self.number_failures = 0
+        self.number_restarts = 0
+        self.number_restart_errors = 0
+        self.last_recovery_time = 0.0
+        self.total_recovery_time = 0.0
+        self.max_recovery_time = 0.0
+
+
+subsystems = {}
+"""The registered subsystems indexed by name."""
+
+heartbeat = None  # type: Optional[Callable[[], float]]
+"""Function returning the monotonic clock time of the last main loop tick."""
+
+report = print
+"""Function called with a message when a subsystem fails, is restarted or recovers."""
+
+verbose = 1
+
+
+def register (name: str, check, restart, grace: float = 0.0) -> Subsystem:
+    """
+    Register a subsystem.
+
+    :param name: the subsystem name.
+    :param check: function without arguments returning whether the subsystem is healthy.
+    :param restart: function without arguments that restarts the subsystem, or None if it cannot be restarted.  It
+    may block, and raises an exception if the restart failed.
+    :param grace: time in seconds the subsystem may be unhealthy before it is restarted.
+    """
+    subsystem = Subsystem (name, check, restart, grace)
+    subsystems [name] = subsystem
+    return subsystem
+
+
+async def monitor () -> None:
+    """
+    Check the subsystems every CHECK_PERIOD seconds until the coroutine is cancelled.
+    """
+    while True:
+        now = time.monotonic ()
+        for subsystem in subsystems.values ():
+            if subsystem.state != RESTARTING:
+                check (subsystem, now)
+        if heartbeat is not None and now - heartbeat () < WATCHDOG_TIMEOUT:
+            configuration.WATCHDOG_PATH.touch ()
+        await asyncio.sleep (CHECK_PERIOD)
+
+
+def check (subsystem: Subsystem, now: float) -> None:
+    try:
+        healthy = subsystem.check ()
+    except Exception as e:
+        print ('Health check of {} failed: {}'.format (subsystem.name, e))
+        healthy = False
+    if healthy:
+        if subsystem.state == FAILED:
+            recovery_time = now - subsystem.failed_since
+            subsystem.state = OK
+            subsystem.backoff = RESTART_MIN
+            subsystem.last_recovery_time = recovery_time
+            subsystem.total_recovery_time += recovery_time
+            subsystem.max_recovery_time = max (subsystem.max_recovery_time, recovery_time)
+            report ('{} recovered in {:.1f} s'.format (subsystem.name, recovery_time))
+        return
+    if subsystem.state == OK:
+        subsystem.state = FAILED
+        subsystem.failed_since = now
+        subsystem.next_restart = now + subsystem.grace
+        subsystem.number_failures += 1
+        report ('{} failed'.format (subsystem.name))
+    if subsystem.restart is not None and now >= subsystem.next_restart:
+        subsystem.state = RESTARTING
+        asyncio.get_event_loop ().create_task (restart (subsystem))
+
+
+async def restart (subsystem: Subsystem) -> None:
+    """
+    Restart a subsystem in the default executor and schedule the next restart after the backoff.
+    """
+    subsystem.number_restarts += 1
+    if verbose > 0:
+        print ('Restarting {}'.format (subsystem.name))
+    try:
+        await asyncio.get_event_loop ().run_in_executor (None, subsystem.restart)
+    except Exception as e:
+        subsystem.number_restart_errors += 1
+        report ('restart of {} failed: {}'.format (subsystem.name, e))
+    subsystem.next_restart = time.monotonic () + subsystem.backoff
+    subsystem.backoff = min (subsystem.backoff * 2, RESTART_MAX)
+    subsystem.state = FAILED
+
+
+def statistics ():
+    """
+    :return: a list with a tuple per subsystem containing its name, state, number of failures, restarts and failed
+    restarts, and the last, mean and maximum recovery time in seconds.
+    """
+    result = []
+    for subsystem in subsystems.values ():
+        recoveries = subsystem.number_failures - (subsystem.state != OK)
+        result.append ((
+            subsystem.name, STATE_NAMES [subsystem.state],
+            subsystem.number_failures, subsystem.number_restarts, subsystem.number_restart_errors,
+            subsystem.last_recovery_time,
+            subsystem.total_recovery_time / recoveries if recoveries > 0 else 0.0,
+            subsystem.max_recovery_time))
+    return result
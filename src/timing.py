@@ -0,0 +1,143 @@
+"""
+Measures the time spent in each stage of the main loop step.
+
+The duration of each stage is counted in a fixed-bucket latency histogram stored in preallocated arrays, so recording
+a duration only costs a clock read, a bisection and an increment.  Function record is used as follows:
+
+    t = time.perf_counter ()
+    ...
+    t = timing.record (timing.STAGE_GPS, t)
+
+Every TELEMETRY_PERIOD minutes, function step_timing publishes a summary of the durations since the previous summary
+on the telemetry topic and writes the cumulative histograms to a Prometheus textfile in the backup pen.
+"""
+import array
+import bisect
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import configuration
+
+STAGES = [
+    'step',
+    'gps',
+    'other_sensors',
+    'opc',
+    'honeywell',
+    'format',
+    'publish_public',
+    'publish_private',
+    'log_csv',
+]
+STAGE_STEP, STAGE_GPS, STAGE_OTHER_SENSORS, STAGE_OPC, STAGE_HONEYWELL, STAGE_FORMAT, STAGE_PUBLISH_PUBLIC, \
+    STAGE_PUBLISH_PRIVATE, STAGE_LOG_CSV = range (len (STAGES))
+
+BUCKET_LIMITS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0]
+"""Upper limit in seconds of each histogram bucket.  The last bucket has no upper limit."""
+
+NUMBER_BUCKETS = len (BUCKET_LIMITS) + 1
+
+counts = [array.array ('Q', [0] * NUMBER_BUCKETS) for _ in STAGES]
+"""Number of durations in each bucket of each stage since the program started."""
+sums = array.array ('d', [0.0] * len (STAGES))
+maximums = array.array ('d', [0.0] * len (STAGES))
+"""Maximum duration of each stage since the previous summary."""
+
+previous_counts = [array.array ('Q', [0] * NUMBER_BUCKETS) for _ in STAGES]
+previous_sums = array.array ('d', [0.0] * len (STAGES))
+last_summary = time.monotonic ()
+
+PROMETHEUS_FILE = os.path.join (configuration.STORAGE_FOLDER, 'sensor_node.prom')
+
+
+def record (stage: int, time_start: float) -> float:
+    """
+    Count the time elapsed since the given time in the histogram of a stage.
+
+    :param stage: the stage index.
+    :param time_start: the value of ``time.perf_counter`` when the stage started.
+    :return: the current value of ``time.perf_counter``, to be used as the start of the next stage.
+    """
+    now = time.perf_counter ()
+    duration = now - time_start
+    counts [stage][bisect.bisect_left (BUCKET_LIMITS, duration)] += 1
+    sums [stage] += duration
+    if duration > maximums [stage]:
+        maximums [stage] = duration
+    return now
+
+
+def percentile (histogram, total: int, fraction: float) -> float:
+    """
+    Return the upper limit of the bucket that contains the given percentile.
+    """
+    target = total * fraction
+    accumulated = 0
+    for index, count in enumerate (histogram):
+        accumulated += count
+        if accumulated >= target:
+            return BUCKET_LIMITS [index] if index < len (BUCKET_LIMITS) else float ('inf')
+    return float ('inf')
+
+
+def step_timing (*mqtt_clients: mqtt.Client) -> None:
+    """
+    Publish the timing summary in the given clients if the telemetry period has elapsed.
+    """
+    global last_summary
+
+    now = time.monotonic ()
+    if now - last_summary < configuration.TELEMETRY_PERIOD * 60:
+        return
+    last_summary = now
+    parts = []
+    for stage, name in enumerate (STAGES):
+        histogram = [c - p for c, p in zip (counts [stage], previous_counts [stage])]
+        total = sum (histogram)
+        if total > 0:
+            parts.append ('{}:n={},mean={:.4f},p50={},p95={},max={:.4f}'.format (
+                name,
+                total,
+                (sums [stage] - previous_sums [stage]) / total,
+                percentile (histogram, total, 0.5),
+                percentile (histogram, total, 0.95),
+                maximums [stage],
+            ))
+        previous_counts [stage][:] = counts [stage]
+        previous_sums [stage] = sums [stage]
+        maximums [stage] = 0.0
+    msg = 'TIMING ' + ' '.join (parts)
+    for mqtt_client in mqtt_clients:
+        mqtt_client.publish (configuration.TOPIC_TELEMETRY, msg, qos=1)
+    snapshot = [array.array ('Q', c) for c in counts], array.array ('d', sums)
+    threading.Thread (target=write_prometheus_file, args=snapshot, daemon=True).start ()
+
+
+def write_prometheus_file (snapshot_counts, snapshot_sums) -> None:
+    """
+    Write the cumulative histograms in the Prometheus text format.
+
+    The file is written to a temporary file and renamed, so that a collector never reads a partial file.
+    """
+    lines = [
+        '# HELP sensor_node_stage_seconds Duration of each stage of the sensor node main loop step.',
+        '# TYPE sensor_node_stage_seconds histogram',
+    ]
+    for stage, name in enumerate (STAGES):
+        accumulated = 0
+        for index, limit in enumerate (BUCKET_LIMITS):
+            accumulated += snapshot_counts [stage][index]
+            lines.append ('sensor_node_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format (name, limit, accumulated))
+        accumulated += snapshot_counts [stage][-1]
+        lines.append ('sensor_node_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format (name, accumulated))
+        lines.append ('sensor_node_stage_seconds_sum{{stage="{}"}} {}'.format (name, snapshot_sums [stage]))
+        lines.append ('sensor_node_stage_seconds_count{{stage="{}"}} {}'.format (name, accumulated))
+    try:
+        with open (PROMETHEUS_FILE + '.tmp', 'w') as fd:
+            fd.write ('\n'.join (lines) + '\n')
+        os.replace (PROMETHEUS_FILE + '.tmp', PROMETHEUS_FILE)
+    except OSError as e:
+        print ('Could not write {}: {}'.format (PROMETHEUS_FILE, e))